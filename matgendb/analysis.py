@@ -0,0 +1,311 @@
+"""
+Structure analyses for task docs, computed once per structure.
+
+Building a task doc runs several analyses of the final structure of a run
+(space group, bond valence, Voronoi coordination numbers, validity). An
+:class:`AnalysisContext` holds that structure, so it is built only once
+per task doc, and looks up every analysis in a :class:`StructureCache`
+keyed by a hash of the structure. Identical final structures, which are
+common across reruns of the same calculation, are then analyzed only once
+per process::
+
+    ctx = AnalysisContext(vasprun.final_structure)
+    d["spacegroup"] = ctx.spacegroup()
+    d["analysis"]["bv_structure"] = ctx.bv_structure()
+
+The optional steps of building a task doc are named *stages*, listed in a
+registry. Stages can be skipped, and each one is timed by a
+:class:`StageTimer`; the timings of a run are stored in its task doc.
+More stages can be added with :func:`register_stage`.
+"""
+
+import copy
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from pymatgen.analysis.bond_valence import BVAnalyzer
+from pymatgen.analysis.structure_analyzer import VoronoiCoordFinder
+from pymatgen.core.structure import Structure
+from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+
+_log = logging.getLogger("mg.analysis")
+
+#: Number of decimals of lattice vectors and coordinates used in the hash
+KEY_DECIMALS = 6
+
+
+def structure_key(structure):
+    """Hash of a structure, for use as a cache key.
+
+    Two structures have the same key if they have the same lattice, species
+    and fractional coordinates (to `KEY_DECIMALS` decimals) and magnetic
+    moments.
+
+    :param structure: Structure
+    :type structure: pymatgen.core.structure.Structure
+    :return: Hex digest
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    lattice = np.round(np.asarray(structure.lattice.matrix, dtype=float),
+                       KEY_DECIMALS)
+    coords = np.round(np.asarray(structure.frac_coords, dtype=float),
+                      KEY_DECIMALS)
+    # Avoid distinct hashes for 0.0 and -0.0
+    h.update((lattice + 0.0).tobytes())
+    h.update((coords + 0.0).tobytes())
+    h.update(",".join(str(sp) for sp in structure.species).encode("utf-8"))
+    magmom = structure.site_properties.get("magmom")
+    if magmom is not None:
+        h.update(repr(list(magmom)).encode("utf-8"))
+    return h.hexdigest()
+
+
+class Stage(object):
+    """An optional step of building a task doc.
+    """
+    def __init__(self, name, description, func=None):
+        """Constructor.
+
+        :param name: Name, used to enable/disable and time the stage
+        :type name: str
+        :param description: Short description
+        :type description: str
+        :param func: For stages that are not built into the drone, function
+                     called with (dir_name, doc) after post-processing, to
+                     add fields to the doc
+        :type func: callable
+        """
+        self.name = name
+        self.description = description
+        self.func = func
+
+
+_stages = OrderedDict()
+
+
+def register_stage(name, description="", func=None):
+    """Add a stage to the registry, or replace one with the same name.
+
+    :return: The stage
+    :rtype: Stage
+    """
+    stage = Stage(name, description, func=func)
+    _stages[name] = stage
+    return stage
+
+
+def get_stages():
+    """All registered stages, built-in ones first.
+
+    :rtype: list of Stage
+    """
+    return list(_stages.values())
+
+
+def get_stage_names():
+    return list(_stages.keys())
+
+
+for _name, _desc in (
+        ("cif", "CIF string of each final structure"),
+        ("spacegroup", "Space group of the final structure (spglib)"),
+        ("bond_valence", "Oxidation states of the final structure "
+                         "(BVAnalyzer)"),
+        ("coordination_numbers", "Voronoi coordination numbers of the final "
+                                 "structure"),
+        ("outcar", "Parsed OUTCAR of each calculation"),
+        ("run_stats", "Timing and memory stats from the OUTCARs")):
+    register_stage(_name, _desc)
+
+
+class StageTimer(object):
+    """Runs the enabled stages of one task doc and records their times.
+    """
+    def __init__(self, skip=(), timings=None):
+        """Constructor.
+
+        :param skip: Names of stages not to run
+        :type skip: iterable of str
+        :param timings: Dict to add the timings to, in seconds per stage
+        :type timings: dict
+        """
+        self.skip = frozenset(skip)
+        self.timings = {} if timings is None else timings
+
+    def enabled(self, name):
+        return name not in self.skip
+
+    def run(self, name, func, *args, **kwargs):
+        """Call `func` with the remaining arguments as stage `name`.
+
+        :return: Result of `func`, or None if the stage is skipped
+        """
+        if name in self.skip:
+            return None
+        t0 = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + \
+                time.time() - t0
+
+
+def check_stage_names(names):
+    """Raise ValueError if any of `names` is not a registered stage."""
+    unknown = set(names).difference(_stages)
+    if unknown:
+        raise ValueError("Unknown analysis stage(s): {}".format(
+            ", ".join(sorted(unknown))))
+
+
+class StructureCache(object):
+    """Least-recently-used cache of analysis results, keyed by structure
+    hash and analysis name.
+    """
+    def __init__(self, maxsize=1000):
+        """Constructor.
+
+        :param maxsize: Max. number of results kept; 0 disables the cache
+        :type maxsize: int
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, name, func):
+        """Get the result of analysis `name` for the structure with hash
+        `key`, calling `func()` to compute it if it is not cached.
+
+        Results are copied on the way in and out, so callers may modify them.
+        """
+        k = (key, name)
+        with self._lock:
+            if k in self._data:
+                self.hits += 1
+                value = self._data.pop(k)
+                self._data[k] = value
+                return copy.deepcopy(value)
+            self.misses += 1
+        value = func()
+        if self.maxsize > 0:
+            with self._lock:
+                self._data[k] = copy.deepcopy(value)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+#: Cache shared by all contexts of this process, unless given another one
+default_cache = StructureCache()
+
+
+class AnalysisContext(object):
+    """The final structure of a run, shared by the analysis steps that build
+    a task doc, with cached analysis results.
+    """
+    def __init__(self, structure=None, cache=None, stages=None):
+        """Constructor.
+
+        :param structure: Final structure; can also be set later
+        :type structure: pymatgen.core.structure.Structure
+        :param cache: Cache for analysis results; default is `default_cache`
+        :type cache: StructureCache
+        :param stages: Stages to run, default is all of them
+        :type stages: StageTimer
+        """
+        self._structure = None
+        self._key = None
+        self.cache = default_cache if cache is None else cache
+        self.stages = StageTimer() if stages is None else stages
+        if structure is not None:
+            self.structure = structure
+
+    @property
+    def structure(self):
+        return self._structure
+
+    @structure.setter
+    def structure(self, value):
+        self._structure = value
+        self._key = None
+
+    @classmethod
+    def from_doc(cls, d, cache=None, stages=None):
+        """Context for the final structure of a task doc.
+        """
+        return cls(Structure.from_dict(d["output"]["crystal"]), cache=cache,
+                   stages=stages)
+
+    @property
+    def key(self):
+        if self._key is None:
+            self._key = structure_key(self._structure)
+        return self._key
+
+    def _get(self, name, func):
+        return self.cache.get(self.key, name, func)
+
+    def spacegroup(self, symprec=0.1):
+        """Space group info, as stored in the task doc "spacegroup" field."""
+        def func():
+            sg = SpacegroupAnalyzer(self._structure, symprec)
+            return {"symbol": sg.get_space_group_symbol(),
+                    "number": sg.get_space_group_number(),
+                    "point_group": sg.get_point_group_symbol(),
+                    "source": "spglib",
+                    "crystal_system": sg.get_crystal_system(),
+                    "hall": sg.get_hall()}
+        return self._get(("spacegroup", symprec), func)
+
+    def bv_structure(self):
+        """Dict of the structure decorated with oxidation states from
+        BVAnalyzer, or of the plain structure if they cannot be determined.
+        """
+        def func():
+            s = self._structure
+            try:
+                s = BVAnalyzer().get_oxi_state_decorated_structure(s)
+            except ValueError as e:
+                _log.error("Valence cannot be determined due to {e}."
+                           .format(e=e))
+            except Exception as ex:
+                _log.error("BVAnalyzer error {e}.".format(e=str(ex)))
+            return s.as_dict()
+        return self._get("bv_structure", func)
+
+    def is_valid(self):
+        """Whether no atoms are too close together."""
+        return self._get("is_valid", lambda: bool(self._structure.is_valid()))
+
+    def coordination_numbers(self):
+        """Voronoi coordination numbers of all sites, as a list of
+        ``{"site": site_dict, "coordination": number}``.
+        """
+        def func():
+            f = VoronoiCoordFinder(self._structure)
+            cn = []
+            for i, s in enumerate(self._structure.sites):
+                try:
+                    n = f.get_coordination_number(i)
+                    number = int(round(n))
+                    cn.append({"site": s.as_dict(), "coordination": number})
+                except Exception:
+                    _log.error("Unable to parse coordination errors")
+            return cn
+        return self._get("coordination_numbers", func)
@@ -0,0 +1,218 @@
+"""
+Runs inside tar and zip archives.
+
+Archived campaigns can be ingested without unpacking them first. Each
+archive is read in a single pass, as a stream for tar files. Only the files
+the drone reads (:data:`MEMBER_PATTERNS`) are extracted, one run at a time,
+into a scratch directory that is removed as soon as the run is parsed, so
+the disk space used stays that of a few runs' outputs::
+
+    for run in iter_archive_runs("/cold/campaign.tar.gz", runs=drone.runs):
+        d = drone.process_path(run.path, run_dir=run)
+
+Each run comes out as an :class:`ArchiveRun`, a
+:class:`matgendb.discovery.RunDir` whose path is the scratch directory. The
+drone stores it under a dir_name that points inside the archive,
+``host:/abs/campaign.tar.gz!/inner/path/of/run``.
+
+The members of a run must be contiguous in the archive, which holds for
+archives made by tar and zip from a directory tree.
+"""
+
+import logging
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+from collections import OrderedDict
+from fnmatch import fnmatch
+
+from matgendb.discovery import RunDir, is_archive
+
+_log = logging.getLogger("mg.archive")
+
+#: Separates the path of an archive from the path of a run inside it
+SEPARATOR = "!/"
+
+#: Files of a run that are extracted for the drone
+MEMBER_PATTERNS = ["vasprun.xml*", "OUTCAR*", "OSZICAR*", "INCAR*",
+                   "KPOINTS*", "POSCAR*", "POTCAR*", "CONTCAR*", "STOPCAR*",
+                   "custodian.json*", "transformations.json*"]
+
+
+class ArchiveRun(RunDir):
+    """A run directory inside an archive, extracted to a scratch directory.
+    """
+    def __init__(self, path, files, listing, runs, archive, inner):
+        """Constructor.
+
+        :param path: Scratch directory holding the extracted files
+        :type path: str
+        :param archive: Absolute path of the archive
+        :type archive: str
+        :param inner: Path of the run directory inside the archive
+        :type inner: str
+        """
+        RunDir.__init__(self, path, files, listing, runs=runs)
+        self.archive = archive
+        self.inner = inner
+
+    @property
+    def location(self):
+        """Path of the run: archive, SEPARATOR, path inside the archive."""
+        return self.archive + SEPARATOR + self.inner
+
+    def cleanup(self):
+        """Remove the scratch directory."""
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __repr__(self):
+        return "ArchiveRun({!r}, schema={})".format(self.location,
+                                                    self.schema)
+
+
+def _members(archive):
+    """Generate (name, size, mtime, file object) for the regular files of an
+    archive, in archive order. Each file object is only valid until the
+    next one is generated.
+    """
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if info.filename.endswith("/"):
+                    continue
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                with zf.open(info) as f:
+                    yield info.filename, info.file_size, mtime, f
+    else:
+        with tarfile.open(archive, mode="r|*") as tf:
+            for member in tf:
+                if not member.isfile():
+                    continue
+                f = tf.extractfile(member)
+                yield member.name, member.size, member.mtime, f
+
+
+class _Group(object):
+    """Files extracted so far for one candidate run directory."""
+    def __init__(self, inner, scratch):
+        self.inner = inner
+        self.path = tempfile.mkdtemp(prefix="mgdb-", dir=scratch)
+        self.files = []
+        self.listing = {}
+
+
+def iter_archive_runs(archive, runs=("relax1", "relax2"), scratch=None,
+                      patterns=None):
+    """Generate the runs in an archive, in one pass over it.
+
+    The scratch directory of each run is removed by the drone once the run
+    is parsed (see :meth:`ArchiveRun.cleanup`), so the runs can be parsed
+    later, e.g. by another process, as long as the caller cleans up the
+    ones it does not parse.
+
+    :param archive: Path of a .tar, .tar.gz, .tgz, .tar.bz2 or .zip file
+    :type archive: str
+    :param runs: Names of the parts of a multi-part run, as for the drone
+    :type runs: list of str
+    :param scratch: Directory in which to extract runs, default is the
+                    system's temporary directory
+    :type scratch: str
+    :param patterns: Names of the files to extract, default MEMBER_PATTERNS
+    :type patterns: list of str
+    :return: Runs
+    :rtype: generator of ArchiveRun
+    """
+    archive = os.path.abspath(archive)
+    patterns = patterns or MEMBER_PATTERNS
+    runs = list(runs)
+    groups = OrderedDict()
+    done = set()
+    try:
+        for name, size, mtime, f in _members(archive):
+            name = posixpath.normpath(name)
+            if name.startswith("/") or name.startswith(".."):
+                _log.warning("Skipping {} in {}".format(name, archive))
+                continue
+            dirname, basename = posixpath.split(name)
+            if not any(fnmatch(basename, p) for p in patterns):
+                continue
+            sub = posixpath.basename(dirname)
+            if sub in runs:
+                inner = posixpath.dirname(dirname)
+            else:
+                inner, sub = dirname, ""
+            # Groups outside the tree of this member are complete.
+            for key in list(groups):
+                if not _is_within(dirname, key):
+                    run = _finish(groups.pop(key), archive, runs)
+                    done.add(key)
+                    if run is not None:
+                        yield run
+            if inner in done:
+                _log.warning("Files of {} are not contiguous in {}; "
+                             "{} is parsed on its own".format(
+                                 inner, archive, name))
+            group = groups.get(inner)
+            if group is None:
+                group = groups[inner] = _Group(inner, scratch)
+            _extract(group, sub, basename, f, mtime)
+        for key in list(groups):
+            run = _finish(groups.pop(key), archive, runs)
+            if run is not None:
+                yield run
+    finally:
+        # Runs not handed out yet, if the caller stopped early
+        for group in groups.values():
+            shutil.rmtree(group.path, ignore_errors=True)
+
+
+def _is_within(path, root):
+    return root == "" or root == "." or path == root or \
+        path.startswith(root + "/")
+
+
+def _extract(group, sub, basename, f, mtime):
+    target_dir = os.path.join(group.path, sub)
+    if sub and sub not in group.listing:
+        os.mkdir(target_dir)
+        group.listing[sub] = []
+        group.files.append(sub)
+    filename = os.path.join(target_dir, basename)
+    with open(filename, "wb") as out:
+        shutil.copyfileobj(f, out, 1 << 20)
+    os.utime(filename, (mtime, mtime))
+    if sub:
+        group.listing[sub].append(basename)
+    else:
+        group.files.append(basename)
+
+
+def _finish(group, archive, runs):
+    """The ArchiveRun of a complete group, or None if it is not a run."""
+    is_run = bool(group.listing) or any(fnmatch(f, "vasprun.xml*")
+                                        for f in group.files)
+    if not is_run:
+        shutil.rmtree(group.path, ignore_errors=True)
+        return None
+    return ArchiveRun(group.path, group.files, group.listing, runs,
+                      archive, group.inner)
+
+
+def split_location(location):
+    """Split the location of a run in an archive, as from
+    :attr:`ArchiveRun.location`, into the archive path and inner path.
+
+    :return: (archive, inner path), or (location, None) if the location is
+             not inside an archive
+    :rtype: tuple
+    """
+    if SEPARATOR not in location:
+        return location, None
+    archive, inner = location.split(SEPARATOR, 1)
+    if not is_archive(archive):
+        return location, None
+    return archive, inner
@@ -0,0 +1,230 @@
+"""
+Streaming storage of large task doc payloads in GridFS.
+
+Serializing a large payload (a DOS, the projected eigenvalues or the ionic
+steps of a big supercell) with ``json.dumps`` and then ``zlib.compress``
+holds the whole JSON string and its compressed copy in memory next to the
+payload itself, which is what bounds the memory of an insert worker. The
+functions here encode the payload piece by piece with the C encoder of
+``json`` (see :func:`iter_json`), and compress and upload it chunk by chunk,
+so neither the whole JSON string nor its compressed copy is ever held::
+
+    fs = gridfs.GridFS(db, "payload_fs")
+    file_id = put_json(fs, calc["output"]["projected_eigenvalues"], compress=1)
+    peigen = get_json(fs, file_id)
+
+:func:`offload` moves the payload fields of a calculation into GridFS and
+leaves a ``<field>_fs_id`` reference in their place; :func:`restore` puts
+them back.
+"""
+
+import json
+import logging
+import zlib
+
+import numpy as np
+import six
+from monty.json import MontyEncoder
+
+_log = logging.getLogger("mg.blobs")
+
+#: GridFS collection for the payloads of calculations
+PAYLOAD_FS = "payload_fs"
+
+#: Fields of the "output" of a calculation that can be stored in GridFS
+PAYLOAD_FIELDS = ("ionic_steps", "eigenvalues", "projected_eigenvalues")
+
+#: Bytes of encoded JSON compressed and written at a time
+WRITE_BUFFER = 1 << 20
+
+#: Bytes assumed for the JSON of a number, in estimate_json_size()
+_NUMBER_BYTES = 20
+
+
+def estimate_json_size(obj):
+    """Rough size in bytes of the JSON of an object, without encoding it.
+    The items of a list are assumed to be the size of its first one.
+
+    :param obj: Object, as encoded by MontyEncoder
+    :return: Estimated size
+    :rtype: int
+    """
+    if isinstance(obj, dict):
+        return 2 + sum(len(str(k)) + 4 + estimate_json_size(v)
+                       for k, v in obj.items())
+    if isinstance(obj, np.ndarray):
+        return 2 + obj.size * (_NUMBER_BYTES + 1)
+    if isinstance(obj, (list, tuple)):
+        if not obj:
+            return 2
+        return 2 + len(obj) * (estimate_json_size(obj[0]) + 1)
+    if isinstance(obj, six.string_types):
+        return len(obj) + 2
+    if hasattr(obj, "as_dict"):
+        return estimate_json_size(obj.as_dict())
+    return _NUMBER_BYTES
+
+
+def iter_json(obj, encoder=None, size=None):
+    """Encode an object to JSON piece by piece.
+
+    The pieces joined are the output of ``encoder.encode(obj)``. Each part
+    of the object estimated (see :func:`estimate_json_size`) to be at most
+    `size` bytes, and each slice of a list of that many bytes, is encoded
+    in one go with the C encoder, so the pieces are about `size` bytes at
+    most and are produced at nearly the speed of ``json.dumps``, where
+    ``iterencode`` would fall back to the pure-Python encoder.
+
+    :param obj: Object to encode
+    :param encoder: Encoder, a MontyEncoder by default
+    :type encoder: json.JSONEncoder
+    :param size: Bytes of JSON encoded at a time, WRITE_BUFFER by default
+    :type size: int
+    :return: Generator of str
+    """
+    if encoder is None:
+        encoder = MontyEncoder()
+    return _iter_json(obj, encoder, size or WRITE_BUFFER)
+
+
+def _iter_json(obj, encoder, size):
+    if not isinstance(obj, (dict, list, tuple)) and not (
+            obj is None or isinstance(obj, (six.string_types, float) +
+                                       six.integer_types)):
+        # what the encoder would do with it, e.g. an array to a list
+        obj = encoder.default(obj)
+    if not isinstance(obj, (dict, list, tuple)) or \
+            estimate_json_size(obj) <= size:
+        yield encoder.encode(obj)
+    elif isinstance(obj, dict):
+        items = sorted(obj.items(), key=lambda kv: kv[0]) \
+            if encoder.sort_keys else obj.items()
+        yield "{"
+        for i, (k, v) in enumerate(items):
+            # the key as the encoder writes it, with the key separator
+            key = encoder.encode({k: 0})[1:-2]
+            yield key if i == 0 else encoder.item_separator + key
+            for piece in _iter_json(v, encoder, size):
+                yield piece
+        yield "}"
+    else:
+        item_size = estimate_json_size(obj[0])
+        yield "["
+        if item_size <= size:
+            step = max(1, size // (item_size + 1))
+            for i in range(0, len(obj), step):
+                if i:
+                    yield encoder.item_separator
+                yield encoder.encode(list(obj[i:i + step]))[1:-1]
+        else:
+            for i, item in enumerate(obj):
+                if i:
+                    yield encoder.item_separator
+                for piece in _iter_json(item, encoder, size):
+                    yield piece
+        yield "]"
+
+
+def put_json(fs, obj, compress=0, **kwargs):
+    """Write an object to a new GridFS file as JSON, encoding, compressing
+    and uploading it in chunks of about WRITE_BUFFER bytes.
+
+    :param fs: GridFS to write to
+    :type fs: gridfs.GridFS
+    :param obj: Object to encode with MontyEncoder
+    :param compress: zlib compression level, 0 for none
+    :type compress: int
+    :param kwargs: Extra fields of the GridFS file document
+    :return: Id of the file
+    """
+    compress = int(compress or 0)
+    if compress:
+        kwargs["compression"] = "zlib"
+    compressor = zlib.compressobj(compress) if compress else None
+    with fs.new_file(**kwargs) as f:
+        buf, buffered = [], 0
+        for piece in iter_json(obj):
+            buf.append(piece)
+            buffered += len(piece)
+            if buffered >= WRITE_BUFFER:
+                _write(f, compressor, buf)
+                buf, buffered = [], 0
+        _write(f, compressor, buf)
+        if compressor is not None:
+            f.write(compressor.flush())
+    return f._id
+
+
+def _write(f, compressor, pieces):
+    data = "".join(pieces).encode("utf-8")
+    if compressor is not None:
+        data = compressor.compress(data)
+    if data:
+        f.write(data)
+
+
+def get_json(fs, file_id):
+    """Read back an object written by :func:`put_json`, or any JSON file,
+    compressed with zlib or not.
+
+    :param fs: GridFS to read from
+    :type fs: gridfs.GridFS
+    :param file_id: Id of the file
+    :return: Decoded JSON
+    """
+    with fs.get(file_id) as f:
+        data = f.read()
+    try:
+        return json.loads(data.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError):
+        return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+def offload(fs, calc, fields=PAYLOAD_FIELDS, compress=0):
+    """Move payload fields of the output of a calculation into GridFS.
+
+    Each field present in ``calc["output"]`` is replaced by a
+    ``<field>_fs_id`` entry holding the id of its GridFS file.
+
+    :param fs: GridFS to write to
+    :type fs: gridfs.GridFS
+    :param calc: One of the "calculations" of a task doc, modified in place
+    :type calc: dict
+    :param fields: Names of the fields to move, from PAYLOAD_FIELDS
+    :type fields: list
+    :param compress: zlib compression level, 0 for none
+    :type compress: int
+    :return: Names of the fields moved
+    :rtype: list
+    """
+    output = calc.get("output", {})
+    moved = []
+    for field in fields:
+        if output.get(field) is None:
+            continue
+        output[field + "_fs_id"] = put_json(fs, output[field],
+                                            compress=compress, field=field)
+        del output[field]
+        moved.append(field)
+    return moved
+
+
+def restore(fs, calc, fields=PAYLOAD_FIELDS):
+    """Read payload fields moved by :func:`offload` back into the output
+    of a calculation.
+
+    :param fs: GridFS to read from
+    :type fs: gridfs.GridFS
+    :param calc: One of the "calculations" of a task doc, modified in place
+    :type calc: dict
+    :param fields: Names of the fields to read, if they were moved
+    :type fields: list
+    :return: The calculation
+    :rtype: dict
+    """
+    output = calc.get("output", {})
+    for field in fields:
+        file_id = output.pop(field + "_fs_id", None)
+        if file_id is not None:
+            output[field] = get_json(fs, file_id)
+    return calc
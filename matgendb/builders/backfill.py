@@ -0,0 +1,129 @@
+"""
+Backfill derived fields of task docs.
+
+The expensive analyses of a task doc (CIF strings, space group, bond valence,
+coordination numbers) can be skipped at insert time with the `skip_stages`
+option of :class:`matgendb.creator.VaspToDbTaskDrone`, or ``mgdb insert
+--skip-stage``. This builder computes them afterwards for the task docs that
+lack them, in parallel with the usual builder machinery. Run incrementally,
+it only looks at task docs inserted since its last run::
+
+    mgbuild run matgendb.builders.backfill -c DerivedFieldsBuilder \\
+        tasks=tasks.json -i other -n 8
+"""
+
+import logging
+
+from pymatgen.core.structure import Structure
+from pymatgen.io.cif import CifWriter
+
+from matgendb.analysis import AnalysisContext, StageTimer
+from matgendb.builders import core
+from matgendb.builders import util
+
+_log = util.get_builder_log("backfill")
+
+#: Task doc field filled in by each stage that can be backfilled
+STAGE_FIELDS = {
+    "cif": "cif",
+    "spacegroup": "spacegroup",
+    "bond_valence": "analysis.bv_structure",
+    "coordination_numbers": "analysis.coordination_numbers",
+}
+
+
+def _get_field(d, path):
+    for key in path.split("."):
+        if not isinstance(d, dict) or key not in d:
+            return None
+        d = d[key]
+    return d
+
+
+class DerivedFieldsBuilder(core.Builder):
+    """Compute derived fields that are missing from task docs.
+    """
+    def __init__(self, *args, **kwargs):
+        self._coll = None
+        self._stages = list(STAGE_FIELDS)
+        core.Builder.__init__(self, *args, **kwargs)
+
+    def get_items(self, tasks=None, stages=None, crit=None):
+        """Find the task docs that lack any of the fields.
+
+        :param tasks: Task collection, read and updated in place
+        :type tasks: QueryEngine
+        :param stages: Names of the stages whose fields are filled in, default is all of cif, spacegroup, bond_valence, coordination_numbers
+        :type stages: list
+        :param crit: Extra filter criteria, e.g. "{'state': 'successful'}"
+        :type crit: dict
+        """
+        stages = stages or list(STAGE_FIELDS)
+        unknown = set(stages).difference(STAGE_FIELDS)
+        if unknown:
+            raise ValueError("Cannot backfill stage(s): {}".format(
+                ", ".join(sorted(unknown))))
+        self._stages = stages
+        self._coll = tasks.collection
+        query = {"$or": [{STAGE_FIELDS[s]: {"$exists": False}}
+                         for s in stages],
+                 "output.crystal": {"$exists": True}}
+        if crit:
+            # $and keeps the $or of the missing fields if crit has one too
+            query = {"$and": [query, crit]}
+        # Fetch only what is needed to compute the fields, and to see which
+        # of them are there already.
+        projection = ["task_id", "output.crystal"] + \
+                     [STAGE_FIELDS[s] for s in stages]
+        if "cif" in stages:
+            projection += ["calculations.output.crystal", "calculations.cif"]
+        _log.info("backfill stages={} crit={}".format(stages, crit))
+        return self._coll.find(query, projection)
+
+    def process_item(self, item):
+        """Compute the missing fields of one task doc and store them.
+        """
+        assert self._coll is not None
+        context = AnalysisContext.from_doc(item, stages=StageTimer())
+        updates = {}
+        for name in self._stages:
+            if _get_field(item, STAGE_FIELDS[name]) is not None:
+                continue
+            if name == "cif":
+                updates.update(context.stages.run("cif", self._cifs, item))
+            elif name == "spacegroup":
+                updates["spacegroup"] = context.stages.run(
+                    "spacegroup", context.spacegroup, 0.1)
+            elif name == "bond_valence":
+                updates["analysis.bv_structure"] = context.stages.run(
+                    "bond_valence", context.bv_structure)
+            elif name == "coordination_numbers":
+                updates["analysis.coordination_numbers"] = context.stages.run(
+                    "coordination_numbers", context.coordination_numbers)
+        if not updates:
+            return 0
+        for name, seconds in context.stages.timings.items():
+            updates["analysis_timings." + name] = seconds
+        self._coll.update_one({"_id": item["_id"]}, {"$set": updates})
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug("backfilled task_id={} fields={}".format(
+                item.get("task_id"), sorted(updates)))
+        return 0
+
+    @staticmethod
+    def _cifs(item):
+        """CIF of the final structure of each calculation, and of the task."""
+        updates = {}
+        cif = None
+        for i, calc in enumerate(item.get("calculations", [])):
+            crystal = _get_field(calc, "output.crystal")
+            if crystal is None:
+                continue
+            cif = calc.get("cif")
+            if cif is None:
+                cif = str(CifWriter(Structure.from_dict(crystal)))
+                updates["calculations.{:d}.cif".format(i)] = cif
+        if cif is None:
+            cif = str(CifWriter(Structure.from_dict(item["output"]["crystal"])))
+        updates["cif"] = cif
+        return updates
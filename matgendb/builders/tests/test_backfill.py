@@ -0,0 +1,102 @@
+"""
+Test the builders.backfill module.
+
+These tests use `mongomock` instead of a real MongoDB server, and a fake
+analysis context instead of pymatgen analyses.
+"""
+import unittest
+
+import mongomock
+
+from matgendb.analysis import StageTimer
+from matgendb.builders import backfill
+
+
+class FakeContext(object):
+    calls = []
+
+    def __init__(self, d, stages):
+        self.d, self.stages = d, stages
+
+    @classmethod
+    def from_doc(cls, d, stages=None):
+        return cls(d, stages)
+
+    def spacegroup(self, symprec):
+        self.calls.append(("spacegroup", self.d["task_id"]))
+        return {"number": 225}
+
+    def bv_structure(self):
+        self.calls.append(("bond_valence", self.d["task_id"]))
+        return {"sites": []}
+
+    def coordination_numbers(self):
+        self.calls.append(("coordination_numbers", self.d["task_id"]))
+        return [6]
+
+
+class FakeQE(object):
+    def __init__(self, coll):
+        self.collection = coll
+
+
+class DerivedFieldsBuilderTestCase(unittest.TestCase):
+    def setUp(self):
+        self._context = backfill.AnalysisContext
+        backfill.AnalysisContext = FakeContext
+        FakeContext.calls = []
+        self.coll = mongomock.MongoClient().db.tasks
+        crystal = {"lattice": {}}
+        self.coll.insert_many([
+            {"task_id": 1, "output": {"crystal": crystal}},
+            {"task_id": 2, "output": {"crystal": crystal},
+             "spacegroup": {"number": 1}},
+            {"task_id": 3, "output": {"crystal": crystal},
+             "spacegroup": {"number": 1},
+             "analysis": {"bv_structure": {}, "coordination_numbers": []}},
+            {"task_id": 4, "state": "killed"}])
+
+    def tearDown(self):
+        backfill.AnalysisContext = self._context
+
+    def build(self, **kw):
+        builder = backfill.DerivedFieldsBuilder(ncores=1)
+        return builder.run(user_kw=dict(tasks=FakeQE(self.coll), **kw))
+
+    def test_backfill(self):
+        n = self.build(stages=["spacegroup", "bond_valence",
+                               "coordination_numbers"])
+        self.assertEqual(n, 2)
+        self.assertEqual(sorted(FakeContext.calls),
+                         [("bond_valence", 1), ("bond_valence", 2),
+                          ("coordination_numbers", 1),
+                          ("coordination_numbers", 2), ("spacegroup", 1)])
+        rec = self.coll.find_one({"task_id": 2})
+        self.assertEqual(rec["spacegroup"], {"number": 1})
+        self.assertEqual(rec["analysis"]["coordination_numbers"], [6])
+        self.assertIn("bond_valence", rec["analysis_timings"])
+        # nothing left to do
+        FakeContext.calls = []
+        self.build(stages=["spacegroup", "bond_valence",
+                           "coordination_numbers"])
+        self.assertEqual(FakeContext.calls, [])
+        self.assertIsNone(self.coll.find_one({"task_id": 4}).get("spacegroup"))
+
+    def test_crit(self):
+        n = self.build(stages=["spacegroup"], crit={"task_id": 1})
+        self.assertEqual(n, 1)
+        # an $or in crit does not replace the one of the missing fields,
+        # nor does crit on output.crystal let docs without one through
+        FakeContext.calls = []
+        self.build(stages=["spacegroup"],
+                   crit={"$or": [{"task_id": 2}, {"task_id": 3}]})
+        self.build(stages=["spacegroup"],
+                   crit={"output.crystal": {"$exists": False}})
+        self.assertEqual(FakeContext.calls, [])
+
+    def test_bad_stage(self):
+        self.assertRaises(ValueError, self.build, stages=["outcar"])
+
+
+if __name__ == '__main__':
+    unittest.main()
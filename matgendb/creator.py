@@ -10,35 +10,41 @@ from __future__ import division
 import os
 import re
 import glob
+import hashlib
 import logging
 import datetime
 import string
 import json
 import socket
+import threading
+import time
 import numpy as np
-import zlib
 import six
 from fnmatch import fnmatch
 from collections import OrderedDict
 
-from pymongo import MongoClient
 import gridfs
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 from pymatgen.apps.borg.hive import AbstractDrone
-from pymatgen.analysis.structure_analyzer import VoronoiCoordFinder
-from pymatgen.core.structure import Structure
-from pymatgen.core.composition import Composition
 from pymatgen.io.vasp import Vasprun, Incar, Kpoints, Potcar, Poscar, \
     Outcar, Oszicar
 from pymatgen.io.cif import CifWriter
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
-from pymatgen.analysis.bond_valence import BVAnalyzer
 from monty.io import zopen
 from pymatgen.ext.matproj import MPRester
-from pymatgen.entries.computed_entries import ComputedEntry
 from pymatgen.analysis.structure_analyzer import oxide_type
 from monty.json import MontyEncoder
 
+from matgendb import blobs, dbclient, dosio
+from matgendb.analysis import AnalysisContext, StageTimer, get_stages, \
+    check_stage_names
+from matgendb.archive import SEPARATOR, ArchiveRun
+from matgendb.discovery import find_vasprun_files
+from matgendb.query_engine import QueryEngine
+from matgendb.stability import StabilityService, entry_from_doc, \
+    get_compatibility, get_stability_service
+
 __author__ = "Shyue Ping Ong"
 __copyright__ = "Copyright 2012, The Materials Project"
 __version__ = "2.0.0"
@@ -76,7 +82,12 @@ class VaspToDbTaskDrone(AbstractDrone):
                  user=None, password=None, collection="tasks",
                  parse_dos=False, compress_dos=False,parse_projected_eigen=False,
                  simulate_mode=False, additional_fields=None, update_duplicates=True,
-                 mapi_key=None, use_full_uri=True, runs=None):
+                 mapi_key=None, use_full_uri=True, runs=None,
+                 batch_size=1, flush_interval=None, taskid_block_size=1,
+                 fingerprint=None, skip_stages=None, dos_format="json",
+                 gridfs_payloads=None, ingest_profile=None,
+                 stability_ref=None, skip_unchanged=False,
+                 stability_compat="MaterialsProjectCompatibility"):
         """Constructor.
 
         Args:
@@ -108,6 +119,12 @@ class VaspToDbTaskDrone(AbstractDrone):
             compress_dos:
                 Whether to compress the DOS data. Valid options are integers 1-9,
                 corresponding to zlib compression level. 1 is usually adequate.
+            dos_format:
+                How the DOS data is stored in gridfs. "json" (the default)
+                stores the JSON of CompleteDos.as_dict(). "binary" stores the
+                energies and densities as arrays of float64 in the format of
+                :mod:`matgendb.dosio`, which is much smaller and faster to
+                read; "binary32" uses float32. QueryEngine reads all of them.
             simulate_mode:
                 Allows one to simulate db insertion without actually performing
                 the insertion.
@@ -139,6 +156,77 @@ class VaspToDbTaskDrone(AbstractDrone):
                 Ordered list of runs to look for e.g. ["relax1", "relax2"].
                 Automatically detects whether the runs are stored in the
                 subfolder or file extension schema.
+            batch_size:
+                Number of task docs to buffer before writing them to the
+                db with a single unordered bulk write. Defaults to 1, which
+                means every doc is written as soon as it is parsed. In
+                buffered mode, call :meth:`flush` when done to write the
+                remaining docs.
+            flush_interval:
+                In buffered mode, also write the buffered docs once the
+                oldest one has waited this many seconds. Defaults to None,
+                i.e. only flush when the buffer is full.
+            taskid_block_size:
+                Number of task_ids each process reserves at once from the
+                counter collection. Defaults to 1, i.e. one counter update
+                per new doc. Larger blocks take the counter document out of
+                the critical path of parallel inserts, at the price of
+                unused ids (gaps) when a process exits; task_ids stay unique
+                and increase within each block.
+            fingerprint:
+                If set, store a fingerprint of the output files of each run
+                (see :func:`get_fingerprint`) in the task doc, and skip
+                directories whose fingerprint matches the one in the db
+                without parsing them. "stat" fingerprints files by path,
+                size and mtime; "hash" also hashes their contents. Defaults
+                to None, i.e. always parse.
+            skip_stages:
+                Names of analysis stages not to run, e.g.
+                ["bond_valence", "coordination_numbers"]. The fields they
+                fill in are left out of the task docs. See
+                :mod:`matgendb.analysis` for the list of stages. Defaults to
+                None, i.e. run all stages.
+            gridfs_payloads:
+                Fields of the output of each calculation to store in the
+                gridfs collection "payload_fs" instead of in the task doc,
+                from "ionic_steps", "eigenvalues" and
+                "projected_eigenvalues". Each is streamed to gridfs, zlib
+                compressed at the compress_dos level, and replaced by a
+                "<field>_fs_id" reference; see :mod:`matgendb.blobs`.
+                Defaults to None, i.e. keep everything in the task doc.
+            ingest_profile:
+                What to keep of each vasprun.xml: the name of one of
+                INGEST_PROFILES ("full", "compact", "minimal"), a dict of
+                :class:`IngestProfile` arguments, or an IngestProfile. E.g.
+                "compact" keeps the last 10 ionic steps, without their
+                electronic steps, and no eigenvalues. With a profile, the
+                DOS is only parsed when it is stored, and the task doc
+                records in "ingest_profile" how many bytes of JSON were
+                dropped. Defaults to None, i.e. keep everything.
+            stability_ref:
+                Reference entries to compute the stability (e_above_hull and
+                decomposes_to) of successful runs locally, instead of with
+                the Materials API: a file of ComputedEntries (see
+                :meth:`matgendb.stability.StabilityService.from_file`), or
+                the name of a collection of task docs in the same database.
+                A value that looks like a path (see
+                :func:`get_stability_ref_file`) must be an existing file.
+                Stability is computed for each batch of docs as it is
+                written, and convex hulls are reused across batches.
+                Defaults to None.
+            skip_unchanged:
+                Store a hash of the contents of each task doc (see
+                :func:`get_field_hashes`), and when updating a duplicate,
+                write only the top-level fields whose contents changed, or
+                nothing at all if none did. last_updated is then only
+                changed along with the contents. Defaults to False:
+                duplicates are always rewritten in full.
+            stability_compat:
+                Name of the compatibility scheme of
+                pymatgen.entries.compatibility that corrects the energies of
+                the reference entries and of the runs for stability_ref, as
+                the Materials API does. "none" for no corrections. Defaults
+                to "MaterialsProjectCompatibility".
         """
         self.host = host
         self.database = database
@@ -151,19 +239,39 @@ class VaspToDbTaskDrone(AbstractDrone):
             raise ValueError('Invalid value for parse_dos')
         if isinstance(parse_projected_eigen, six.string_types) and parse_projected_eigen != 'final':
             raise ValueError('Invalid value for parse_projected_eigen')
+        if fingerprint not in (None, "stat", "hash"):
+            raise ValueError('Invalid value for fingerprint')
+        check_stage_names(skip_stages or [])
+        if dos_format != "json" and dos_format not in dosio.FORMATS:
+            raise ValueError('Invalid value for dos_format')
+        if set(gridfs_payloads or []).difference(blobs.PAYLOAD_FIELDS):
+            raise ValueError('Invalid value for gridfs_payloads')
         self.parse_projected_eigen = parse_projected_eigen
         self.parse_dos = parse_dos
         self.compress_dos = compress_dos
+        self.dos_format = dos_format
+        self.gridfs_payloads = gridfs_payloads
+        self.ingest_profile = IngestProfile.get(ingest_profile)
+        if stability_ref is not None:
+            get_stability_ref_file(stability_ref)
+            get_compatibility(stability_compat)
+        self.stability_ref = stability_ref
+        self.stability_compat = stability_compat
+        self.skip_unchanged = skip_unchanged
         self.additional_fields = additional_fields or {}
         self.update_duplicates = update_duplicates
         self.mapi_key = mapi_key
         self.use_full_uri = use_full_uri
         self.runs = runs or ["relax1", "relax2"]
+        self.batch_size = max(int(batch_size), 1)
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._buffer_start = None
+        self.taskid_block_size = max(int(taskid_block_size), 1)
+        self.fingerprint = fingerprint
+        self.skip_stages = sorted(skip_stages or [])
         if not simulate_mode:
-            conn = MongoClient(self.host, self.port)
-            db = conn[self.database]
-            if self.user:
-                db.authenticate(self.user, self.password)
+            db = self._get_database()
             if db.counter.find({"_id": "taskid"}).count() == 0:
                 db.counter.insert_one({"_id": "taskid", "c": 1})
 
@@ -175,11 +283,16 @@ class VaspToDbTaskDrone(AbstractDrone):
         Returns:
             If in simulate_mode, the entire doc is returned for debugging
             purposes. Else, only the task_id of the inserted doc is returned.
+            In buffered mode (batch_size > 1), the doc is only queued and
+            the task_ids of any docs written by a resulting flush are
+            returned as a list, which may be empty.
         """
         try:
-            d = self.get_task_doc(path)
-            if self.mapi_key is not None and d["state"] == "successful":
-                self.calculate_stability(d)
+            d = self.process_path(path)
+            if d is None:
+                return False
+            if self.batch_size > 1 and not self.simulate:
+                return self._buffer_doc(d)
             tid = self._insert_doc(d)
             return tid
         except Exception as ex:
@@ -187,98 +300,368 @@ class VaspToDbTaskDrone(AbstractDrone):
             logger.error(traceback.format_exc())
             return False
 
+    def process_path(self, path, run_dir=None):
+        """
+        Get the task doc for a path, with stability data if a Materials API
+        key was given, ready for insertion.
+
+        Args:
+            path:
+                Run directory.
+            run_dir:
+                The :class:`matgendb.discovery.RunDir` for `path`, if any.
+                For a :class:`matgendb.archive.ArchiveRun`, the doc is stored
+                under the location of the run in its archive, and the
+                extracted files are removed once parsed.
+
+        Returns:
+            The task doc, or None if fingerprints are used and the run is
+            unchanged since it was last inserted.
+        """
+        try:
+            fp = None
+            if self.fingerprint:
+                fp = get_fingerprint(path, self.runs,
+                                     hash_contents=(self.fingerprint == "hash"),
+                                     run_dir=run_dir)
+                if self.is_unchanged(path, fp, run_dir=run_dir):
+                    logger.info("Skipping unchanged {}".format(
+                        self.get_dir_name(path, run_dir=run_dir)))
+                    return None
+            d = self.get_task_doc(path, run_dir=run_dir)
+            if isinstance(run_dir, ArchiveRun):
+                relocate_doc(d, run_dir,
+                             self.get_dir_name(path, run_dir=run_dir))
+        finally:
+            if isinstance(run_dir, ArchiveRun):
+                run_dir.cleanup()
+        if fp is not None:
+            d["fingerprint"] = fp
+        if self.mapi_key is not None and d["state"] == "successful":
+            self.calculate_stability(d)
+        return d
+
+    def get_dir_name(self, path, run_dir=None):
+        """
+        The dir_name under which the run in `path` is stored.
+
+        Args:
+            path:
+                Run directory.
+            run_dir:
+                The :class:`matgendb.discovery.RunDir` for `path`, if any.
+                The dir_name of an :class:`matgendb.archive.ArchiveRun` is
+                its location in the archive, e.g.
+                host:/data/runs.tar.gz!/Li2O/relax.
+        """
+        if isinstance(run_dir, ArchiveRun):
+            if self.use_full_uri:
+                return get_uri(run_dir.archive) + SEPARATOR + run_dir.inner
+            return run_dir.location
+        if self.use_full_uri:
+            return get_uri(path)
+        return os.path.abspath(path)
+
+    def is_unchanged(self, path, fp, run_dir=None):
+        """
+        Whether the run in `path` is already in the db with fingerprint `fp`
+        (or at all, if duplicates are not updated).
+        """
+        if self.simulate:
+            return False
+        coll = self._get_database()[self.collection]
+        result = coll.find_one({"dir_name": self.get_dir_name(path, run_dir)},
+                               ["fingerprint.digest"])
+        if result is None:
+            return False
+        if not self.update_duplicates:
+            return True
+        return result.get("fingerprint", {}).get("digest") == fp["digest"]
+
+    def _buffer_doc(self, d):
+        if not self._buffer:
+            self._buffer_start = time.time()
+        self._buffer.append(d)
+        if len(self._buffer) >= self.batch_size or (
+                self.flush_interval is not None and
+                time.time() - self._buffer_start >= self.flush_interval):
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        Write all buffered task docs to the db.
+
+        Returns:
+            List of task_ids of the inserted or updated docs.
+        """
+        docs, self._buffer = self._buffer, []
+        self._buffer_start = None
+        if not docs:
+            return []
+        return self.insert_docs(docs)
+
     def calculate_stability(self, d):
         m = MPRester(self.mapi_key)
-        functional = d["pseudo_potential"]["functional"]
-        syms = ["{} {}".format(functional, l)
-                for l in d["pseudo_potential"]["labels"]]
-        entry = ComputedEntry(Composition(d["unit_cell_formula"]),
-                              d["output"]["final_energy"],
-                              parameters={"hubbards": d["hubbards"],
-                                          "potcar_symbols": syms})
-        data = m.get_stability([entry])[0]
+        data = m.get_stability([entry_from_doc(d)])[0]
         for k in ("e_above_hull", "decomposes_to"):
             d["analysis"][k] = data[k]
 
-    def get_task_doc(self, path):
+    def _get_stability_service(self):
+        ref, compat = self.stability_ref, self.stability_compat
+
+        def factory():
+            filename = get_stability_ref_file(ref)
+            compatibility = get_compatibility(compat)
+            if filename is not None:
+                return StabilityService.from_file(
+                    filename, compatibility=compatibility)
+            return StabilityService(qe=QueryEngine(
+                host=self.host, port=self.port, database=self.database,
+                user=self.user, password=self.password, collection=ref),
+                compatibility=compatibility)
+        return get_stability_service(
+            (self.host, self.port, self.database, ref, compat), factory)
+
+    def add_stability(self, docs):
+        """
+        Compute the stability of the successful docs of a batch that lack
+        it, against the local reference set of the stability_ref option.
+
+        Args:
+            docs:
+                List of task docs, modified in place.
+        """
+        if self.stability_ref is None:
+            return
+        docs = [d for d in docs if d.get("state") == "successful" and
+                "e_above_hull" not in d.get("analysis", {})]
+        if not docs:
+            return
+        service = self._get_stability_service()
+        results = service.get_stability([entry_from_doc(d) for d in docs])
+        for d, data in zip(docs, results):
+            if data is None:
+                logger.warning("No stability for {}".format(d["dir_name"]))
+                continue
+            for k in ("e_above_hull", "decomposes_to"):
+                d["analysis"][k] = data[k]
+
+    def get_task_doc(self, path, run_dir=None):
         """
         Get the entire task doc for a path, including any post-processing.
+
+        Args:
+            path:
+                Run directory.
+            run_dir:
+                The :class:`matgendb.discovery.RunDir` for `path`, if it was
+                found with :mod:`matgendb.discovery`. Its file listing is used
+                instead of listing the directory again.
         """
         logger.info("Getting task doc for base dir :{}".format(path))
-        files = os.listdir(path)
-        vasprun_files = OrderedDict()
+        if run_dir is not None:
+            files = run_dir.files
+            vasprun_files = run_dir.vasprun_files
+        else:
+            files = os.listdir(path)
+            listing = {r: os.listdir(os.path.join(path, r))
+                       for r in self.runs if r in files}
+            vasprun_files = find_vasprun_files(files, self.runs, listing)
         if "STOPCAR" in files:
             #Stopped runs. Try to parse as much as possible.
             logger.info(path + " contains stopped run")
-        for r in self.runs:
-            if r in files: #try subfolder schema
-                for f in os.listdir(os.path.join(path, r)):
-                    if fnmatch(f, "vasprun.xml*"):
-                        vasprun_files[r] = os.path.join(r, f)
-            else: #try extension schema
-                for f in files:
-                    if fnmatch(f, "vasprun.xml.{}*".format(r)):
-                        vasprun_files[r] = f
-        if len(vasprun_files) == 0:
-            for f in files: #get any vasprun from the folder
-                if fnmatch(f, "vasprun.xml*") and \
-                        f not in vasprun_files.values():
-                    vasprun_files['standard'] = f
 
         if len(vasprun_files) > 0:
             d = self.generate_doc(path, vasprun_files)
             if not d:
-                d = self.process_killed_run(path)
-            self.post_process(path, d)
+                d = self.process_killed_run(path, run_dir=run_dir)
+            self.post_process(path, d, run_dir=run_dir)
         elif (not (path.endswith("relax1") or
-              path.endswith("relax2"))) and contains_vasp_input(path):
+              path.endswith("relax2"))) and \
+                (run_dir.has_vasp_input if run_dir is not None
+                 else contains_vasp_input(path)):
             #If not Materials Project style, process as a killed run.
             logger.warning(path + " contains killed run")
-            d = self.process_killed_run(path)
-            self.post_process(path, d)
+            d = self.process_killed_run(path, run_dir=run_dir)
+            self.post_process(path, d, run_dir=run_dir)
         else:
             raise ValueError("No VASP files found!")
 
         return d
 
+    def _get_database(self):
+        # Db connections cannot be pickled, so the drone only keeps the
+        # connection settings and gets the shared client of the current
+        # (possibly forked worker) process every time it needs one.
+        return dbclient.get_database(self.host, self.port, self.database,
+                                     user=self.user, password=self.password)
+
+    def _put_dos(self, db, d):
+        # Insert dos data into gridfs and then remove it from the dict.
+        # DOS data tends to be above the 4Mb limit for mongo docs. A ref
+        # to the dos file is in the dos_fs_id. The data is encoded and
+        # written to gridfs in chunks, never held as one big string.
+        if self.parse_dos and "calculations" in d:
+            for calc in d["calculations"]:
+                if "dos" in calc:
+                    fs = gridfs.GridFS(db, "dos_fs")
+                    if self.dos_format in dosio.FORMATS:
+                        with fs.new_file() as f:
+                            dosio.write_dos(
+                                calc["dos"], f,
+                                dtype=dosio.FORMATS[self.dos_format],
+                                compress=self.compress_dos)
+                        dosid = f._id
+                        calc["dos_format"] = self.dos_format
+                    else:
+                        dosid = blobs.put_json(fs, calc["dos"],
+                                               compress=self.compress_dos)
+                        if self.compress_dos:
+                            calc["dos_compression"] = "zlib"
+                    calc["dos_fs_id"] = dosid
+                    del calc["dos"]
+
+    def _put_payloads(self, db, d):
+        # Move the large outputs of the calculations to gridfs.
+        if self.gridfs_payloads and "calculations" in d:
+            fs = gridfs.GridFS(db, blobs.PAYLOAD_FS)
+            for calc in d["calculations"]:
+                blobs.offload(fs, calc, self.gridfs_payloads,
+                              compress=self.compress_dos)
+
+    def _is_unchanged(self, d, result):
+        """
+        Whether the contents of task doc `d` are those of the doc `result`
+        in the db. Sets the content hashes of `d`.
+        """
+        if not self.skip_unchanged:
+            return False
+        d["field_hashes"] = get_field_hashes(d)
+        d["content_hash"] = get_content_hash(d["field_hashes"])
+        return result.get("content_hash") == d["content_hash"]
+
+    def _get_update(self, db, d, result=None):
+        """
+        The update that writes task doc `d` over the doc `result` in the db
+        (None for a new doc): a $set of the fields whose contents changed,
+        and an $unset of the fields that are gone. The DOS and payloads are
+        only written to gridfs if the calculations changed.
+        """
+        if self.skip_unchanged and "field_hashes" not in d:
+            d["field_hashes"] = get_field_hashes(d)
+            d["content_hash"] = get_content_hash(d["field_hashes"])
+        fields = list(d)
+        unset = []
+        if self.skip_unchanged:
+            old = (result or {}).get("field_hashes")
+            if old is not None:
+                new = d["field_hashes"]
+                fields = [k for k in d if k not in new or
+                          old.get(k) != new[k]]
+                unset = [k for k in old if k not in new]
+        if "calculations" in fields:
+            self._put_dos(db, d)
+            self._put_payloads(db, d)
+        d["last_updated"] = datetime.datetime.today()
+        update = {"$set": {k: d[k] for k in set(fields).union(
+            ["last_updated", "task_id"])}}
+        if unset:
+            update["$unset"] = dict.fromkeys(unset, "")
+        return update
+
+    def _next_task_ids(self, db, n=1):
+        """
+        Get `n` new task_ids, as a list, from the task_id allocator of
+        this process.
+        """
+        allocator = get_task_id_allocator(
+            (self.host, self.port, self.database), self.taskid_block_size)
+        return allocator.allocate(db.counter, n)
+
+    def insert_docs(self, docs):
+        """
+        Insert or update a batch of task docs. Duplicates are looked up with
+        one query over the dir_names of the batch, new task_ids are reserved
+        with one counter update and all docs are written with one unordered
+        bulk write of upserts.
+
+        Args:
+            docs:
+                List of task docs, as returned by get_task_doc.
+
+        Returns:
+            List of task_ids of the inserted or updated docs. In
+            simulate_mode, the docs themselves are returned.
+        """
+        self.add_stability(docs)
+        if self.simulate:
+            return [self._insert_doc(d) for d in docs]
+        db = self._get_database()
+        coll = db[self.collection]
+        # Only the last doc for a given dir_name counts; two upserts
+        # for the same dir_name in one unordered bulk write could both
+        # end up inserting.
+        by_dir = OrderedDict((d["dir_name"], d) for d in docs)
+        existing = {r["dir_name"]: r for r in coll.find(
+            {"dir_name": {"$in": list(by_dir.keys())}},
+            ["dir_name", "task_id", "content_hash", "field_hashes"])}
+        to_write = []
+        for dir_name, d in by_dir.items():
+            result = existing.get(dir_name, None)
+            if result is None:
+                to_write.append(d)
+            elif not self.update_duplicates:
+                logger.info("Skipping duplicate {}".format(dir_name))
+            elif self._is_unchanged(d, result):
+                logger.info("Skipping unchanged {}".format(dir_name))
+            else:
+                d["task_id"] = result["task_id"]
+                logger.info("Updating {} with taskid = {}"
+                            .format(dir_name, d["task_id"]))
+                to_write.append(d)
+        new_docs = [d for d in to_write if d["dir_name"] not in existing and
+                    not d.get("task_id")]
+        if new_docs:
+            for d, tid in zip(new_docs, self._next_task_ids(db, len(new_docs))):
+                d["task_id"] = tid
+                logger.info("Inserting {} with taskid = {}"
+                            .format(d["dir_name"], d["task_id"]))
+        if not to_write:
+            return []
+        requests = []
+        for d in to_write:
+            update = self._get_update(db, d, existing.get(d["dir_name"]))
+            requests.append(UpdateOne({"dir_name": d["dir_name"]}, update,
+                                      upsert=True))
+        failed = set()
+        try:
+            coll.bulk_write(requests, ordered=False)
+        except BulkWriteError as err:
+            for werr in err.details.get("writeErrors", []):
+                failed.add(werr["index"])
+                logger.error("Failed to write {}: {}".format(
+                    to_write[werr["index"]]["dir_name"], werr.get("errmsg")))
+        return [d["task_id"] for i, d in enumerate(to_write)
+                if i not in failed]
+
     def _insert_doc(self, d):
+        self.add_stability([d])
         if not self.simulate:
-            # Perform actual insertion into db. Because db connections cannot
-            # be pickled, every insertion needs to create a new connection
-            # to the db.
-            conn = MongoClient(self.host, self.port)
-            db = conn[self.database]
-            if self.user:
-                db.authenticate(self.user, self.password)
+            # Perform actual insertion into db.
+            db = self._get_database()
             coll = db[self.collection]
 
-            # Insert dos data into gridfs and then remove it from the dict.
-            # DOS data tends to be above the 4Mb limit for mongo docs. A ref
-            # to the dos file is in the dos_fs_id.
             result = coll.find_one({"dir_name": d["dir_name"]},
-                                   ["dir_name", "task_id"])
-            if result is None or self.update_duplicates:
-                if self.parse_dos and "calculations" in d:
-                    for calc in d["calculations"]:
-                        if "dos" in calc:
-                            dos = json.dumps(calc["dos"], cls=MontyEncoder)
-                            if self.compress_dos:
-                                dos = zlib.compress(dos.encode('utf-8'),
-                                                    self.compress_dos)
-                                calc["dos_compression"] = "zlib"
-                            fs = gridfs.GridFS(db, "dos_fs")
-                            dosid = fs.put(dos)
-                            calc["dos_fs_id"] = dosid
-                            del calc["dos"]
-
-                d["last_updated"] = datetime.datetime.today()
+                                   ["dir_name", "task_id", "content_hash",
+                                    "field_hashes"])
+            if result is not None and self.update_duplicates and \
+                    self._is_unchanged(d, result):
+                logger.info("Skipping unchanged {}".format(d["dir_name"]))
+            elif result is None or self.update_duplicates:
                 if result is None:
                     if ("task_id" not in d) or (not d["task_id"]):
-                        result = db.counter.find_one_and_update(
-                            filter={"_id": "taskid"},
-                            update={"$inc": {"c": 1}}
-                            )
-                        d["task_id"] = result["c"]
+                        d["task_id"] = self._next_task_ids(db)[0]
                     logger.info("Inserting {} with taskid = {}"
                                 .format(d["dir_name"], d["task_id"]))
                 elif self.update_duplicates:
@@ -286,8 +669,8 @@ class VaspToDbTaskDrone(AbstractDrone):
                     logger.info("Updating {} with taskid = {}"
                                 .format(d["dir_name"], d["task_id"]))
 
-                coll.update_one({"dir_name": d["dir_name"]}, {"$set": d},
-                                upsert=True)
+                coll.update_one({"dir_name": d["dir_name"]},
+                                self._get_update(db, d, result), upsert=True)
                 return d["task_id"]
             else:
                 logger.info("Skipping duplicate {}".format(d["dir_name"]))
@@ -297,7 +680,7 @@ class VaspToDbTaskDrone(AbstractDrone):
                         .format(d["dir_name"], d["task_id"]))
             return d
 
-    def post_process(self, dir_name, d):
+    def post_process(self, dir_name, d, run_dir=None):
         """
         Simple post-processing for various files other than the vasprun.xml.
         Called by generate_task_doc. Modify this if your runs have other
@@ -308,10 +691,16 @@ class VaspToDbTaskDrone(AbstractDrone):
                 The dir_name.
             d:
                 Current doc generated.
+            run_dir:
+                The :class:`matgendb.discovery.RunDir` for dir_name, if any.
+                Its file listing is used instead of listing the directory
+                again.
         """
         logger.info("Post-processing dir:{}".format(dir_name))
 
         fullpath = os.path.abspath(dir_name)
+        stages = StageTimer(self.skip_stages,
+                            timings=d.setdefault("analysis_timings", {}))
 
         # VASP input generated by pymatgen's alchemy has a
         # transformations.json file that keeps track of the origin of a
@@ -319,7 +708,7 @@ class VaspToDbTaskDrone(AbstractDrone):
         # result. If such a file is found, it is inserted into the task doc
         # as d["transformations"]
         transformations = {}
-        filenames = glob.glob(os.path.join(fullpath, "transformations.json*"))
+        filenames = find_files(fullpath, "transformations.json*", run_dir)
         if len(filenames) >= 1:
             with zopen(filenames[0], "rt") as f:
                 transformations = json.load(f)
@@ -355,55 +744,85 @@ class VaspToDbTaskDrone(AbstractDrone):
         # This is useful for tracking what has actually be done to get a
         # result. If such a file is found, it is inserted into the task doc
         # as d["custodian"]
-        filenames = glob.glob(os.path.join(fullpath, "custodian.json*"))
+        filenames = find_files(fullpath, "custodian.json*", run_dir)
         if len(filenames) >= 1:
             with zopen(filenames[0], "rt") as f:
                 d["custodian"] = json.load(f)
 
         # Parse OUTCAR for additional information and run stats that are
-        # generally not in vasprun.xml.
-        try:
-            run_stats = {}
-            for filename in glob.glob(os.path.join(fullpath, "OUTCAR*")):
+        # generally not in vasprun.xml. The run stats come from the OUTCARs,
+        # so they are parsed if either stage is enabled.
+        run_stats = {}
+
+        def parse_outcars():
+            for filename in find_files(fullpath, "OUTCAR*", run_dir):
                 outcar = Outcar(filename)
                 i = 1 if re.search("relax2", filename) else 0
                 taskname = "relax2" if re.search("relax2", filename) else \
                     "relax1"
-                d["calculations"][i]["output"]["outcar"] = outcar.as_dict()
+                if stages.enabled("outcar"):
+                    d["calculations"][i]["output"]["outcar"] = \
+                        outcar.as_dict()
                 run_stats[taskname] = outcar.run_stats
+
+        try:
+            stages.run("outcar" if stages.enabled("outcar") else "run_stats",
+                       parse_outcars)
         except:
             logger.error("Bad OUTCAR for {}.".format(fullpath))
 
-        try:
+        def get_overall_run_stats():
             overall_run_stats = {}
             for key in ["Total CPU time used (sec)", "User time (sec)",
                         "System time (sec)", "Elapsed time (sec)"]:
                 overall_run_stats[key] = sum([v[key]
                                               for v in run_stats.values()])
             run_stats["overall"] = overall_run_stats
+            d["run_stats"] = run_stats
+
+        try:
+            stages.run("run_stats", get_overall_run_stats)
         except:
             logger.error("Bad run stats for {}.".format(fullpath))
+            d["run_stats"] = run_stats
 
-        d["run_stats"] = run_stats
+        # Stages registered by users
+        for stage in get_stages():
+            if stage.func is not None:
+                try:
+                    stages.run(stage.name, stage.func, dir_name, d)
+                except Exception:
+                    logger.error("Stage {} failed for {}.".format(
+                        stage.name, fullpath))
 
         #Convert to full uri path.
         if self.use_full_uri:
             d["dir_name"] = get_uri(dir_name)
+        # Note that get_dir_name() must give the same result.
 
         if new_tags:
             d["tags"] = new_tags
 
         logger.info("Post-processed " + fullpath)
 
-    def process_killed_run(self, dir_name):
+    def process_killed_run(self, dir_name, run_dir=None):
         """
         Process a killed vasp run.
+
+        Args:
+            dir_name:
+                Run directory.
+            run_dir:
+                The :class:`matgendb.discovery.RunDir` for dir_name, if any.
+                Its file listing is used instead of listing the directory
+                again.
         """
         fullpath = os.path.abspath(dir_name)
         logger.info("Processing Killed run " + fullpath)
         d = {"dir_name": fullpath, "state": "killed", "oszicar": {}}
 
-        for f in os.listdir(dir_name):
+        files = run_dir.files if run_dir is not None else os.listdir(dir_name)
+        for f in files:
             filename = os.path.join(dir_name, f)
             if fnmatch(f, "INCAR*"):
                 try:
@@ -479,9 +898,20 @@ class VaspToDbTaskDrone(AbstractDrone):
                                      "run in {}.".format(dir_name))
         return d
 
-    def process_vasprun(self, dir_name, taskname, filename):
+    def process_vasprun(self, dir_name, taskname, filename, context=None):
         """
         Process a vasprun.xml file.
+
+        Args:
+            dir_name:
+                Run directory.
+            taskname:
+                Name of the part of the run, e.g. "relax1".
+            filename:
+                Path of the vasprun.xml file relative to dir_name.
+            context:
+                If given, the :class:`matgendb.analysis.AnalysisContext`
+                whose structure is set to the final structure of the run.
         """
         vasprun_file = os.path.join(dir_name, filename)
         if self.parse_projected_eigen and (self.parse_projected_eigen != 'final' or \
@@ -489,16 +919,31 @@ class VaspToDbTaskDrone(AbstractDrone):
             parse_projected_eigen = True
         else:
             parse_projected_eigen = False
-        r = Vasprun(vasprun_file,parse_projected_eigen=parse_projected_eigen)
-        d = r.as_dict()
+        parse_dos = self.parse_dos and (self.parse_dos != 'final'
+                                        or taskname == self.runs[-1])
+        profile = self.ingest_profile
+        if profile is None:
+            r = Vasprun(vasprun_file,
+                        parse_projected_eigen=parse_projected_eigen)
+            d = r.as_dict()
+        else:
+            r = profile.parse(vasprun_file, parse_dos=parse_dos,
+                              parse_projected_eigen=parse_projected_eigen)
+            d = profile.vasprun_to_dict(r)
+        if context is not None:
+            context.structure = r.final_structure
+            stages = context.stages
+        else:
+            stages = StageTimer(self.skip_stages)
         d["dir_name"] = os.path.abspath(dir_name)
         d["completed_at"] = \
             str(datetime.datetime.fromtimestamp(os.path.getmtime(
                 vasprun_file)))
-        d["cif"] = str(CifWriter(r.final_structure))
+        cif = stages.run("cif", lambda: str(CifWriter(r.final_structure)))
+        if cif is not None:
+            d["cif"] = cif
         d["density"] = r.final_structure.density
-        if self.parse_dos and (self.parse_dos != 'final' \
-                               or taskname == self.runs[-1]):
+        if parse_dos:
             try:
                 d["dos"] = r.complete_dos.as_dict()
             except Exception:
@@ -524,8 +969,12 @@ class VaspToDbTaskDrone(AbstractDrone):
             d = {k: v for k, v in self.additional_fields.items()}
             d["dir_name"] = fullpath
             d["schema_version"] = VaspToDbTaskDrone.__version__
+            # Holds the final structure of the last calculation, which is
+            # the output crystal, for all the analyses below.
+            context = AnalysisContext(stages=StageTimer(self.skip_stages))
             d["calculations"] = [
-                self.process_vasprun(dir_name, taskname, filename)
+                self.process_vasprun(dir_name, taskname, filename,
+                                     context=context)
                 for taskname, filename in vasprun_files.items()]
             d1 = d["calculations"][0]
             d2 = d["calculations"][-1]
@@ -533,9 +982,11 @@ class VaspToDbTaskDrone(AbstractDrone):
             # Now map some useful info to the root level.
             for root_key in ["completed_at", "nsites", "unit_cell_formula",
                              "reduced_cell_formula", "pretty_formula",
-                             "elements", "nelements", "cif", "density",
+                             "elements", "nelements", "density",
                              "is_hubbard", "hubbards", "run_type"]:
                 d[root_key] = d2[root_key]
+            if "cif" in d2:
+                d["cif"] = d2["cif"]
             d["chemsys"] = "-".join(sorted(d2["elements"]))
 
             # store any overrides to the exchange correlation functional
@@ -566,18 +1017,21 @@ class VaspToDbTaskDrone(AbstractDrone):
                     else "unsuccessful"
             else:
                 d["state"] = "stopped"
-            d["analysis"] = get_basic_analysis_and_error_checks(d)
-
-            sg = SpacegroupAnalyzer(Structure.from_dict(d["output"]["crystal"]),
-                                    0.1)
-            d["spacegroup"] = {"symbol": sg.get_space_group_symbol(),
-                               "number": sg.get_space_group_number(),
-                               "point_group": sg.get_point_group_symbol(),
-                               "source": "spglib",
-                               "crystal_system": sg.get_crystal_system(),
-                               "hall": sg.get_hall()}
+            d["analysis"] = get_basic_analysis_and_error_checks(
+                d, context=context)
+            sg = context.stages.run("spacegroup", context.spacegroup, 0.1)
+            if sg is not None:
+                d["spacegroup"] = sg
             d["oxide_type"] = d2["oxide_type"]
             d["last_updated"] = datetime.datetime.today()
+            d["analysis_timings"] = context.stages.timings
+            if self.ingest_profile is not None:
+                saved = sum(c["ingest_profile"]["bytes_saved"]
+                            for c in d["calculations"])
+                d["ingest_profile"] = {"name": self.ingest_profile.name,
+                                       "bytes_saved": saved}
+                logger.info("Profile {} dropped {:d} bytes from {}".format(
+                    self.ingest_profile.name, saved, fullpath))
             return d
         except Exception as ex:
             import traceback
@@ -602,7 +1056,7 @@ class VaspToDbTaskDrone(AbstractDrone):
         if set(self.runs).intersection(subdirs):
             return [parent]
         if not any([parent.endswith(os.sep + r) for r in self.runs]) and \
-                len(glob.glob(os.path.join(parent, "vasprun.xml*"))) > 0:
+                any(fnmatch(f, "vasprun.xml*") for f in files):
             return [parent]
         return []
 
@@ -624,20 +1078,134 @@ class VaspToDbTaskDrone(AbstractDrone):
                      "parse_dos": self.parse_dos,
                      "simulate_mode": self.simulate,
                      "additional_fields": self.additional_fields,
-                     "update_duplicates": self.update_duplicates}
+                     "update_duplicates": self.update_duplicates,
+                     "batch_size": self.batch_size,
+                     "flush_interval": self.flush_interval,
+                     "taskid_block_size": self.taskid_block_size,
+                     "fingerprint": self.fingerprint,
+                     "skip_stages": self.skip_stages,
+                     "dos_format": self.dos_format,
+                     "gridfs_payloads": self.gridfs_payloads,
+                     "ingest_profile": self.ingest_profile.as_dict()
+                     if self.ingest_profile else None,
+                     "stability_ref": self.stability_ref,
+                     "stability_compat": self.stability_compat,
+                     "skip_unchanged": self.skip_unchanged}
         output = {"name": self.__class__.__name__,
                   "init_args": init_args, "version": __version__}
         return output
 
 
+class TaskIdAllocator(object):
+    """
+    Hands out task_ids from blocks reserved in the counter collection.
+
+    Each block is reserved with one atomic $inc of the "taskid" counter, so
+    task_ids are unique across all processes that share the counter, and
+    increasing within a block. Use :func:`get_task_id_allocator` to get the
+    allocator of the current process.
+    """
+
+    def __init__(self, block_size=1000):
+        """
+        Args:
+            block_size:
+                Number of task_ids to reserve per counter update.
+        """
+        self.block_size = block_size
+        self._next = self._end = 0
+        self._lock = threading.Lock()
+
+    @property
+    def remaining(self):
+        """Number of task_ids left in the current block."""
+        return self._end - self._next
+
+    def allocate(self, counter, n=1):
+        """
+        Get `n` task_ids, reserving new blocks in `counter` as needed.
+
+        Args:
+            counter:
+                The counter collection.
+            n:
+                Number of task_ids.
+
+        Returns:
+            List of task_ids.
+        """
+        ids = []
+        with self._lock:
+            while len(ids) < n:
+                if self._next >= self._end:
+                    size = max(self.block_size, n - len(ids))
+                    result = counter.find_one_and_update(
+                        filter={"_id": "taskid"},
+                        update={"$inc": {"c": size}})
+                    self._next, self._end = result["c"], result["c"] + size
+                m = min(n - len(ids), self._end - self._next)
+                ids.extend(range(self._next, self._next + m))
+                self._next += m
+        return ids
+
+
+_task_id_allocators = {}
+_task_id_allocators_pid = None
+
+
+def get_task_id_allocator(key, block_size):
+    """
+    Get the TaskIdAllocator of the current process for a counter.
+
+    A forked child must not hand out the rest of its parent's block, so the
+    allocators are dropped whenever the process id changes.
+
+    Args:
+        key:
+            Hashable identifying the counter, e.g. (host, port, database).
+        block_size:
+            Number of task_ids to reserve per counter update.
+    """
+    global _task_id_allocators, _task_id_allocators_pid
+    if _task_id_allocators_pid != os.getpid():
+        _task_id_allocators = {}
+        _task_id_allocators_pid = os.getpid()
+    key = (key, block_size)
+    if key not in _task_id_allocators:
+        _task_id_allocators[key] = TaskIdAllocator(block_size)
+    return _task_id_allocators[key]
+
+
 def get_basic_analysis_and_error_checks(d, max_force_threshold=0.5,
-                                        volume_change_threshold=0.2):
+                                        volume_change_threshold=0.2,
+                                        context=None):
+    """
+    Basic analysis of a task doc: volume change, band gap, coordination
+    numbers, bond valence, and checks for too large forces and volume
+    changes and bad structures. May set d["state"] to "error".
+
+    Args:
+        d:
+            Task doc generated by VaspToDbTaskDrone.
+        max_force_threshold:
+            Max. final force in eV/A for a successful run.
+        volume_change_threshold:
+            Fractional volume change above which a warning is added.
+        context:
+            :class:`matgendb.analysis.AnalysisContext` holding the final
+            structure, and the stages to run. Built from
+            d["output"]["crystal"] if not given.
+    """
+    if context is None:
+        context = AnalysisContext.from_doc(d)
 
     initial_vol = d["input"]["crystal"]["lattice"]["volume"]
     final_vol = d["output"]["crystal"]["lattice"]["volume"]
     delta_vol = final_vol - initial_vol
     percent_delta_vol = delta_vol / initial_vol
-    coord_num = get_coordination_numbers(d)
+    coord_num = context.stages.run("coordination_numbers",
+                                   get_coordination_numbers, d,
+                                   context=context)
     calc = d["calculations"][-1]
     gap = calc["output"]["bandgap"]
     cbm = calc["output"]["cbm"]
@@ -651,15 +1219,7 @@ def get_basic_analysis_and_error_checks(d, max_force_threshold=0.5,
         warning_msgs.append("Volume change > {}%"
                             .format(volume_change_threshold * 100))
 
-    bv_struct = Structure.from_dict(d["output"]["crystal"])
-    try:
-        bva = BVAnalyzer()
-        bv_struct = bva.get_oxi_state_decorated_structure(bv_struct)
-    except ValueError as e:
-        logger.error("Valence cannot be determined due to {e}."
-                     .format(e=e))
-    except Exception as ex:
-        logger.error("BVAnalyzer error {e}.".format(e=str(ex)))
+    bv_struct = context.stages.run("bond_valence", context.bv_structure)
 
     max_force = None
     if d["state"] == "successful" and \
@@ -674,20 +1234,46 @@ def get_basic_analysis_and_error_checks(d, max_force_threshold=0.5,
                               .format(max_force_threshold))
             d["state"] = "error"
 
-        s = Structure.from_dict(d["output"]["crystal"])
-        if not s.is_valid():
+        if not context.is_valid():
             error_msgs.append("Bad structure (atoms are too close!)")
             d["state"] = "error"
 
-    return {"delta_volume": delta_vol,
-            "max_force": max_force,
-            "percent_delta_volume": percent_delta_vol,
-            "warnings": warning_msgs,
-            "errors": error_msgs,
-            "coordination_numbers": coord_num,
-            "bandgap": gap, "cbm": cbm, "vbm": vbm,
-            "is_gap_direct": is_direct,
-            "bv_structure": bv_struct.as_dict()}
+    analysis = {"delta_volume": delta_vol,
+                "max_force": max_force,
+                "percent_delta_volume": percent_delta_vol,
+                "warnings": warning_msgs,
+                "errors": error_msgs,
+                "bandgap": gap, "cbm": cbm, "vbm": vbm,
+                "is_gap_direct": is_direct}
+    # Left out if their stages are skipped
+    if coord_num is not None:
+        analysis["coordination_numbers"] = coord_num
+    if bv_struct is not None:
+        analysis["bv_structure"] = bv_struct
+    return analysis
+
+
+def find_files(dir_name, pattern, run_dir=None):
+    """
+    Finds the files of a run directory matching a glob pattern.
+
+    Args:
+        dir_name:
+            Run directory.
+        pattern:
+            Glob pattern of the file names, e.g. "OUTCAR*".
+        run_dir:
+            The :class:`matgendb.discovery.RunDir` for dir_name, if any. The
+            names are then matched against its file listing, without listing
+            the directory again.
+
+    Returns:
+        Paths of the matching files, in dir_name.
+    """
+    if run_dir is None:
+        return glob.glob(os.path.join(dir_name, pattern))
+    return [os.path.join(dir_name, f) for f in run_dir.files
+            if fnmatch(f, pattern)]
 
 
 def contains_vasp_input(dir_name):
@@ -709,7 +1295,7 @@ def contains_vasp_input(dir_name):
     return True
 
 
-def get_coordination_numbers(d):
+def get_coordination_numbers(d, context=None):
     """
     Helper method to get the coordination number of all sites in the final
     structure from a run.
@@ -717,22 +1303,164 @@ def get_coordination_numbers(d):
     Args:
         d:
             Run dict generated by VaspToDbTaskDrone.
+        context:
+            :class:`matgendb.analysis.AnalysisContext` holding the final
+            structure. Built from d["output"]["crystal"] if not given.
 
     Returns:
         Coordination numbers as a list of dict of [{"site": site_dict,
         "coordination": number}, ...].
     """
-    structure = Structure.from_dict(d["output"]["crystal"])
-    f = VoronoiCoordFinder(structure)
-    cn = []
-    for i, s in enumerate(structure.sites):
-        try:
-            n = f.get_coordination_number(i)
-            number = int(round(n))
-            cn.append({"site": s.as_dict(), "coordination": number})
-        except Exception:
-            logger.error("Unable to parse coordination errors")
-    return cn
+    if context is None:
+        context = AnalysisContext.from_doc(d)
+    return context.coordination_numbers()
+
+
+#: Files that make up the fingerprint of a run
+FINGERPRINT_PATTERNS = ["vasprun.xml*", "OUTCAR*", "OSZICAR*", "custodian.json*",
+                        "transformations.json*"]
+
+
+def get_fingerprint(dir_name, runs=("relax1", "relax2"), hash_contents=False,
+                    run_dir=None):
+    """
+    Fingerprint the output files of a run, to detect whether it changed
+    since it was last inserted.
+
+    Args:
+        dir_name:
+            Directory of the run.
+        runs:
+            Names of subfolders that hold parts of the run.
+        hash_contents:
+            Whether to also hash (SHA-1) the contents of each file. Slower,
+            but does not rely on mtimes.
+        run_dir:
+            The :class:`matgendb.discovery.RunDir` for dir_name, if any, to
+            avoid listing the directory again.
+
+    Returns:
+        Dict with "files", a sorted list of [path relative to dir_name,
+        size, mtime (, hash)], and "digest", a hash of that list.
+    """
+    if run_dir is not None:
+        listings = [("", run_dir.files)] + sorted(run_dir.listing.items())
+    else:
+        listings = []
+        for sub in [""] + list(runs):
+            subdir = os.path.join(dir_name, sub)
+            if not sub or os.path.isdir(subdir):
+                listings.append((sub, os.listdir(subdir)))
+    files = []
+    for sub, names in listings:
+        subdir = os.path.join(dir_name, sub)
+        for f in names:
+            if not any(fnmatch(f, p) for p in FINGERPRINT_PATTERNS):
+                continue
+            filename = os.path.join(subdir, f)
+            st = os.stat(filename)
+            entry = [os.path.join(sub, f), st.st_size, st.st_mtime]
+            if hash_contents:
+                h = hashlib.sha1()
+                with open(filename, "rb") as fobj:
+                    for block in iter(lambda: fobj.read(1 << 20), b""):
+                        h.update(block)
+                entry.append(h.hexdigest())
+            files.append(entry)
+    files.sort()
+    digest = hashlib.sha1(json.dumps(files).encode("utf-8")).hexdigest()
+    return {"files": files, "digest": digest}
+
+
+#: Top-level fields of a task doc left out of its content hash: the fields
+#: set on every write, and the timings, which vary from parse to parse
+HASH_EXCLUDED_FIELDS = ("_id", "task_id", "last_updated", "content_hash",
+                        "field_hashes", "analysis_timings")
+
+
+def get_field_hashes(d):
+    """
+    Hash the contents of each top-level field of a task doc, except for
+    HASH_EXCLUDED_FIELDS.
+
+    The hash is the SHA-1 of the JSON of the field with sorted keys. Large
+    fields, such as the calculations with their DOS, are encoded and hashed
+    in chunks (see :func:`matgendb.blobs.iter_json`), so their JSON is
+    never held whole.
+
+    Args:
+        d:
+            Task doc.
+
+    Returns:
+        Dict of field name to hex digest.
+    """
+    encoder = MontyEncoder(sort_keys=True, separators=(",", ":"))
+    hashes = {}
+    for k, v in d.items():
+        if k in HASH_EXCLUDED_FIELDS:
+            continue
+        sha1 = hashlib.sha1()
+        for piece in blobs.iter_json(v, encoder):
+            sha1.update(piece.encode("utf-8"))
+        hashes[k] = sha1.hexdigest()
+    return hashes
+
+
+def get_content_hash(field_hashes):
+    """
+    Hash of the whole contents of a task doc, from its field hashes.
+    """
+    return hashlib.sha1(json.dumps(field_hashes, sort_keys=True)
+                        .encode("utf-8")).hexdigest()
+
+
+#: Extensions of the files of reference entries for stability_ref
+STABILITY_REF_EXTENSIONS = (".json", ".yaml", ".yml", ".mpk", ".gz", ".bz2")
+
+
+def get_stability_ref_file(ref):
+    """
+    The file of reference entries named by the stability_ref option of
+    VaspToDbTaskDrone, or None if it names a collection.
+
+    Args:
+        ref:
+            Value of stability_ref.
+
+    Returns:
+        The path, or None.
+
+    Raises:
+        ValueError: If ref looks like a path, i.e. has a directory part or
+            one of STABILITY_REF_EXTENSIONS, but is not a file.
+    """
+    if os.path.isfile(ref):
+        return ref
+    if os.path.dirname(ref) or ref.lower().endswith(STABILITY_REF_EXTENSIONS):
+        raise ValueError("No stability reference file {}".format(ref))
+    return None
+
+
+_hostname = None
+
+
+def relocate_doc(d, run_dir, dir_name):
+    """
+    Point a task doc parsed from the files of an archived run, extracted to
+    a scratch directory, to the location of the run in its archive.
+
+    Args:
+        d:
+            Task doc.
+        run_dir:
+            The :class:`matgendb.archive.ArchiveRun` it was parsed from.
+        dir_name:
+            dir_name of the run, as from VaspToDbTaskDrone.get_dir_name().
+    """
+    d["dir_name"] = dir_name
+    for calc in d.get("calculations", []):
+        calc["dir_name"] = run_dir.location
 
 
 def get_uri(dir_name):
@@ -747,9 +1475,144 @@ def get_uri(dir_name):
     Returns:
         Full URI path, e.g., fileserver.host.com:/full/path/of/dir_name.
     """
+    global _hostname
     fullpath = os.path.abspath(dir_name)
-    try:
-        hostname = socket.gethostbyaddr(socket.gethostname())[0]
-    except:
-        hostname = socket.gethostname()
-    return "{}:{}".format(hostname, fullpath)
+    if _hostname is None:
+        # The reverse lookup is slow, and called for every run.
+        try:
+            _hostname = socket.gethostbyaddr(socket.gethostname())[0]
+        except:
+            _hostname = socket.gethostname()
+    return "{}:{}".format(_hostname, fullpath)
+
+
+_efermi_pattern = re.compile(br'<i name="efermi">\s*(\S+)\s*</i>')
+
+
+def _read_efermi(filename):
+    """
+    Fermi level of a vasprun.xml, for the runs whose DOS, where it is
+    stored, is not parsed. The file is scanned as bytes up to the efermi of
+    the DOS, which is the only one, so the (projected) DOS after it is not
+    read. None if not found.
+    """
+    with zopen(filename, "rb") as f:
+        for line in f:
+            if b"efermi" in line:
+                m = _efermi_pattern.search(line)
+                if m:
+                    try:
+                        return float(m.group(1))
+                    except ValueError:
+                        return None
+    return None
+
+
+class IngestProfile(object):
+    """
+    What to keep of a vasprun.xml in the task doc, to bound the size of the
+    docs and the memory used to build them.
+    """
+
+    def __init__(self, name="custom", max_ionic_steps=None,
+                 electronic_steps=True, eigenvalues=True):
+        """
+        Args:
+            name:
+                Name of the profile, recorded in the task docs.
+            max_ionic_steps:
+                Number of ionic steps to keep, counting back from the last
+                one. Defaults to None, i.e. all of them.
+            electronic_steps:
+                Whether to keep the electronic steps of each ionic step.
+            eigenvalues:
+                Whether to keep the eigenvalues. The band gap, CBM and VBM
+                derived from them are always kept. Eigenvalues are also kept
+                along with projected eigenvalues.
+        """
+        self.name = name
+        self.max_ionic_steps = max_ionic_steps
+        self.electronic_steps = electronic_steps
+        self.eigenvalues = eigenvalues
+
+    @staticmethod
+    def get(profile):
+        """
+        The IngestProfile for a name in INGEST_PROFILES, a dict of
+        constructor arguments, or an IngestProfile (returned as is).
+        """
+        if profile is None or isinstance(profile, IngestProfile):
+            return profile
+        if isinstance(profile, dict):
+            return IngestProfile(**profile)
+        if profile not in INGEST_PROFILES:
+            raise ValueError("Unknown ingest profile: {}".format(profile))
+        return INGEST_PROFILES[profile]
+
+    def as_dict(self):
+        return {"name": self.name, "max_ionic_steps": self.max_ionic_steps,
+                "electronic_steps": self.electronic_steps,
+                "eigenvalues": self.eigenvalues}
+
+    def parse(self, filename, parse_dos=True, parse_projected_eigen=False):
+        """
+        Parse a vasprun.xml. The DOS, which is a large part of the file, is
+        parsed only if parse_dos is True; otherwise only the Fermi level is
+        read from it.
+        """
+        r = Vasprun(filename, parse_dos=parse_dos,
+                    parse_projected_eigen=parse_projected_eigen)
+        if not parse_dos:
+            r.efermi = _read_efermi(filename)
+        return r
+
+    def vasprun_to_dict(self, r):
+        """
+        Vasprun.as_dict(), without the parts the profile drops. The parts are
+        dropped from the Vasprun before it is converted, so they are never
+        copied.
+
+        Returns:
+            The dict, with "ingest_profile" holding the name of the profile,
+            the total number of ionic steps and an estimate of the size in
+            bytes of the JSON of the dropped data.
+        """
+        dropped = {}
+        # Convergence checks look at the number of ionic steps.
+        completed = r.converged
+        nionic_steps = len(r.ionic_steps)
+        if self.max_ionic_steps and nionic_steps > self.max_ionic_steps:
+            dropped["ionic_steps"] = r.ionic_steps[:-self.max_ionic_steps]
+            r.ionic_steps = r.ionic_steps[-self.max_ionic_steps:]
+        band_properties = None
+        if not self.eigenvalues and r.eigenvalues and \
+                not r.projected_eigenvalues:
+            band_properties = r.eigenvalue_band_properties
+            dropped["eigenvalues"] = {str(spin): v for spin, v
+                                      in r.eigenvalues.items()}
+            r.eigenvalues = None
+        d = r.as_dict()
+        d["has_vasp_completed"] = completed
+        if band_properties is not None:
+            gap, cbm, vbm, is_direct = band_properties
+            d["output"].update(bandgap=gap, cbm=cbm, vbm=vbm,
+                               is_gap_direct=is_direct)
+        if not self.electronic_steps:
+            dropped["electronic_steps"] = [
+                step.pop("electronic_steps", None)
+                for step in d["output"]["ionic_steps"]]
+        bytes_saved = blobs.estimate_json_size(dropped) if dropped else 0
+        d["ingest_profile"] = {"name": self.name,
+                               "nionic_steps": nionic_steps,
+                               "bytes_saved": bytes_saved}
+        return d
+
+
+#: Predefined ingest profiles, for the ingest_profile drone option
+INGEST_PROFILES = {
+    "full": IngestProfile("full"),
+    "compact": IngestProfile("compact", max_ionic_steps=10,
+                             electronic_steps=False, eigenvalues=False),
+    "minimal": IngestProfile("minimal", max_ionic_steps=1,
+                             electronic_steps=False, eigenvalues=False),
+}
@@ -0,0 +1,260 @@
+"""
+Process-wide registry of shared MongoDB clients.
+
+Every MongoClient owns a connection pool and a set of monitoring threads,
+so creating one per query engine, per configuration or (worse) per inserted
+document wastes a lot of time on connection setup. Code in this package
+should instead ask the registry for a client::
+
+    from matgendb import dbclient
+    client = dbclient.get_client("localhost", 27017)
+    db = dbclient.get_database("localhost", 27017, "vasp",
+                               user="admin", password="secret")
+    print(dbclient.stats())
+
+Clients are keyed by (host, port, replicaset, credentials), so all callers
+pointing at the same server with the same identity share one pool.
+
+MongoClient objects are not fork-safe. The registry remembers the process
+that created its clients and starts over with fresh clients the first time
+it is used in a child process, e.g. in the workers of pymatgen's
+``BorgQueen`` or of :class:`matgendb.builders.core.Builder`.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from pymongo import MongoClient, monitoring
+
+_log = logging.getLogger("mg.dbclient")
+
+
+class PoolStats(object):
+    """Counters for the shared clients of one registry.
+
+    Registry-level counters are always available. Connection-level
+    counters (pool size and checkout wait time) need a pymongo version that
+    supports connection pool monitoring, and are zero otherwise.
+    """
+    FIELDS = ("clients_created", "clients_reused", "forks",
+              "client_wait_sec", "connections_created",
+              "connections_closed", "checkouts", "checkout_wait_sec")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            for name in self.FIELDS:
+                setattr(self, name, 0)
+
+    def add(self, name, value=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    @property
+    def pool_size(self):
+        """Number of connections currently open in all shared pools."""
+        return self.connections_created - self.connections_closed
+
+    def as_dict(self):
+        d = {name: getattr(self, name) for name in self.FIELDS}
+        d["pool_size"] = self.pool_size
+        return d
+
+
+if hasattr(monitoring, "ConnectionPoolListener"):
+    class _PoolListener(monitoring.ConnectionPoolListener):
+        """Feed pymongo connection pool events into a :class:`PoolStats`.
+        """
+        def __init__(self, stats):
+            self._stats = stats
+            self._started = threading.local()
+
+        def connection_created(self, event):
+            self._stats.add("connections_created")
+
+        def connection_closed(self, event):
+            self._stats.add("connections_closed")
+
+        def connection_check_out_started(self, event):
+            self._started.t = time.time()
+
+        def connection_checked_out(self, event):
+            self._stats.add("checkouts")
+            t0 = getattr(self._started, "t", None)
+            if t0 is not None:
+                self._stats.add("checkout_wait_sec", time.time() - t0)
+                self._started.t = None
+
+        def connection_check_out_failed(self, event):
+            self._started.t = None
+
+        # Events that are not counted
+        def pool_created(self, event):
+            pass
+
+        def pool_cleared(self, event):
+            pass
+
+        def pool_closed(self, event):
+            pass
+
+        def connection_ready(self, event):
+            pass
+
+        def connection_checked_in(self, event):
+            pass
+else:
+    _PoolListener = None
+
+
+class ClientRegistry(object):
+    """Cache of MongoClient objects, one per server and identity,
+    for the current process.
+    """
+    def __init__(self, client_class=MongoClient):
+        """Constructor.
+
+        :param client_class: Class used to create new clients. Should act
+                             like pymongo.MongoClient, e.g. mongomock.MongoClient
+                             for testing.
+        :type client_class: class
+        """
+        self.client_class = client_class
+        self.stats = PoolStats()
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get_client(self, host="localhost", port=27017, replicaset=None,
+                   user=None, password=None, **kwargs):
+        """Get the shared client for a server and identity, creating
+        it if necessary.
+
+        The credentials are only used to separate clients for different
+        users; authentication is still done by the caller, e.g. with
+        :func:`get_database`.
+
+        :param host: Database server host
+        :param port: Database server port
+        :param replicaset: Replica set name, or None
+        :param user: User name, or None
+        :param password: Password, or None
+        :param kwargs: Other keywords for the client constructor. These
+                       become part of the key.
+        :return: Shared client
+        :rtype: pymongo.MongoClient
+        """
+        self._check_pid()
+        key = (host, port, replicaset, user, password,
+               tuple(sorted(kwargs.items())))
+        t0 = time.time()
+        with self._lock:
+            client = self._clients.get(key, None)
+            if client is None:
+                client = self._create(host, port, replicaset, kwargs)
+                self._clients[key] = client
+                created = True
+            else:
+                created = False
+        self.stats.add("client_wait_sec", time.time() - t0)
+        self.stats.add("clients_created" if created else "clients_reused")
+        return client
+
+    def clear(self, close=True):
+        """Forget all clients, optionally closing them first.
+
+        :param close: Whether to close the clients
+        :type close: bool
+        """
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        if close:
+            for client in clients.values():
+                client.close()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def _create(self, host, port, replicaset, kwargs):
+        _log.debug("create client host={} port={} replicaset={}"
+                   .format(host, port, replicaset))
+        kw = dict(kwargs)
+        # can't pass replicaset=None to MongoClient (fails validation)
+        if replicaset:
+            kw["replicaset"] = replicaset
+        if _PoolListener is not None and issubclass(self.client_class, MongoClient):
+            kw.setdefault("event_listeners", []).append(_PoolListener(self.stats))
+        return self.client_class(host, port, **kw)
+
+    def _check_pid(self):
+        """Drop clients inherited from a parent process.
+
+        They are not closed, since their sockets still belong to the parent.
+        The lock is also replaced, in case it was held during the fork.
+        """
+        pid = os.getpid()
+        if pid != self._pid:
+            _log.debug("fork detected, pid {} -> {}; dropping {:d} clients"
+                       .format(self._pid, pid, len(self._clients)))
+            self._lock = threading.Lock()
+            self._clients = {}
+            self._pid = pid
+            self.stats.add("forks")
+
+
+#: Default registry for this process
+_registry = ClientRegistry()
+
+
+def get_registry():
+    """Return the default registry.
+    """
+    return _registry
+
+
+def set_client_class(client_class):
+    """Change the class used for new clients in the default registry,
+    and drop all existing clients. Mainly useful for testing with mongomock.
+
+    :param client_class: Class that acts like pymongo.MongoClient
+    :type client_class: class
+    """
+    _registry.clear(close=False)
+    _registry.client_class = client_class
+
+
+def get_client(host="localhost", port=27017, replicaset=None, user=None,
+               password=None, **kwargs):
+    """Get a shared client from the default registry.
+    See :meth:`ClientRegistry.get_client`.
+    """
+    return _registry.get_client(host, port, replicaset=replicaset, user=user,
+                                password=password, **kwargs)
+
+
+def get_database(host="localhost", port=27017, database="vasp", user=None,
+                 password=None, replicaset=None, **kwargs):
+    """Get a database from a shared client, authenticated if a user is given.
+
+    :return: Database object
+    :rtype: pymongo.database.Database
+    """
+    client = get_client(host, port, replicaset=replicaset, user=user,
+                        password=password, **kwargs)
+    db = client[database]
+    if user:
+        db.authenticate(user, password)
+    return db
+
+
+def stats():
+    """Counters for the default registry, as a dict.
+    """
+    d = _registry.stats.as_dict()
+    d["clients"] = len(_registry)
+    return d
@@ -127,7 +127,9 @@ class ConfigGroup(object):
 
     def uncache(self, name):
         """Remove all created query engines that match `name` from
-        the cache (this disconnects from MongoDB, which is the point).
+        the cache. The underlying MongoDB clients are shared with other
+        configurations for the same server (see :mod:`matgendb.dbclient`),
+        so this does not by itself disconnect from MongoDB.
 
         :param name: Name used for :meth:`add`, or pattern
         :return: None
@@ -205,6 +207,8 @@ class ConfigGroup(object):
 
     def _get_qe(self, key, obj):
         """Instantiate a query engine, or retrieve a cached one.
+        Query engines for configurations that point at the same server
+        share one MongoDB client.
         """
         if key in self._cached:
             return self._cached[key]
@@ -0,0 +1,336 @@
+"""
+Discovery of VASP run directories.
+
+Walking a large tree with ``os.walk`` and then globbing and re-listing every
+run directory costs several metadata calls per directory, which dominates on
+network and parallel filesystems. :class:`RunFinder` lists every directory
+exactly once, with ``os.scandir`` where available, from a pool of threads so
+that many listings are in flight at once. Each run directory is classified
+while it is listed, and comes out as a :class:`RunDir` work unit that carries
+its file listing, so that parsing it needs no further directory listings::
+
+    finder = RunFinder(runs=drone.runs, nthreads=16)
+    for run in finder.find("/path/to/runs"):
+        d = drone.get_task_doc(run.path, run_dir=run)
+
+The directories accepted are the same as for
+``VaspToDbTaskDrone.get_valid_paths``. With ``archives=True``, the runs in
+the tar and zip files of the tree are also found, see
+:mod:`matgendb.archive`.
+"""
+
+import logging
+import os
+from collections import OrderedDict
+from fnmatch import fnmatch
+from multiprocessing.pool import ThreadPool
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+_log = logging.getLogger("mg.discovery")
+
+#: Ways in which the parts of a run are laid out in its directory
+SCHEMA_SUBFOLDER = "subfolder"  # relax1/vasprun.xml, relax2/vasprun.xml
+SCHEMA_EXTENSION = "extension"  # vasprun.xml.relax1, vasprun.xml.relax2
+SCHEMA_STANDARD = "standard"    # vasprun.xml
+SCHEMA_KILLED = "killed"        # VASP input, but no vasprun.xml
+
+#: Input files that a killed run must have
+VASP_INPUT_FILES = ("INCAR", "POSCAR", "POTCAR", "KPOINTS")
+
+#: Extensions of the archives in which runs are looked for
+ARCHIVE_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".zip")
+
+
+def is_archive(path):
+    """Whether `path` is named like a tar or zip archive."""
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def _list_dir(path):
+    """List a directory.
+
+    :return: (names of files, names of subdirectories, names of the
+             subdirectories that are not symlinks)
+    """
+    files, subdirs, descend = [], [], []
+    if hasattr(os, "scandir"):
+        it = os.scandir(path)
+        try:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    subdirs.append(entry.name)
+                    if not entry.is_symlink():
+                        descend.append(entry.name)
+                else:
+                    files.append(entry.name)
+        finally:
+            if hasattr(it, "close"):
+                it.close()
+    else:
+        for name in os.listdir(path):
+            full = os.path.join(path, name)
+            if os.path.isdir(full):
+                subdirs.append(name)
+                if not os.path.islink(full):
+                    descend.append(name)
+            else:
+                files.append(name)
+    return files, subdirs, descend
+
+
+def has_vasp_input(files):
+    """Whether a directory listing has all four VASP input files, as
+    checked by :func:`matgendb.creator.contains_vasp_input`.
+
+    :param files: Names of the files in the directory
+    :type files: list of str
+    """
+    names = set(files)
+    return all(f in names or f + ".orig" in names for f in VASP_INPUT_FILES)
+
+
+def find_vasprun_files(files, runs, listing):
+    """Find the vasprun.xml files of a run from its directory listing.
+
+    :param files: Names of the files and subdirectories in the run directory
+    :type files: list of str
+    :param runs: Names of the parts of a multi-part run, e.g. relax1, relax2
+    :type runs: list of str
+    :param listing: Names of the files in each subfolder of the run
+                    directory that is named after one of `runs`
+    :type listing: dict
+    :return: Paths of the vasprun.xml files relative to the run directory,
+             keyed by part name ("standard" for a single-part run)
+    :rtype: OrderedDict
+    """
+    vasprun_files = OrderedDict()
+    for r in runs:
+        if r in listing:  # subfolder schema
+            for f in listing[r]:
+                if fnmatch(f, "vasprun.xml*"):
+                    vasprun_files[r] = os.path.join(r, f)
+        else:  # extension schema
+            for f in files:
+                if fnmatch(f, "vasprun.xml.{}*".format(r)):
+                    vasprun_files[r] = f
+    if len(vasprun_files) == 0:
+        for f in files:  # any vasprun in the folder
+            if fnmatch(f, "vasprun.xml*") and \
+                    f not in vasprun_files.values():
+                vasprun_files["standard"] = f
+    return vasprun_files
+
+
+class RunDir(object):
+    """A run directory, classified and listed, ready to be parsed.
+    """
+    def __init__(self, path, files, listing, runs=("relax1", "relax2")):
+        """Constructor.
+
+        :param path: Run directory
+        :type path: str
+        :param files: Names of the files in `path`, and of the subfolders
+                      named after `runs`
+        :type files: list of str
+        :param listing: Names of the files in each subfolder named after
+                        one of `runs`
+        :type listing: dict
+        :param runs: Names of the parts of a multi-part run
+        :type runs: list of str
+        """
+        self.path = path
+        self.files = files
+        self.listing = listing
+        self.vasprun_files = find_vasprun_files(files, runs, listing)
+        if not self.vasprun_files:
+            self.schema = SCHEMA_KILLED
+        elif listing:
+            self.schema = SCHEMA_SUBFOLDER
+        elif "standard" in self.vasprun_files:
+            self.schema = SCHEMA_STANDARD
+        else:
+            self.schema = SCHEMA_EXTENSION
+
+    @property
+    def has_vasp_input(self):
+        return has_vasp_input(self.files)
+
+    def all_files(self):
+        """Paths of all files of the run, relative to its directory."""
+        names = [f for f in self.files if f not in self.listing]
+        for sub, sub_files in self.listing.items():
+            names.extend(os.path.join(sub, f) for f in sub_files)
+        return names
+
+    def __repr__(self):
+        return "RunDir({!r}, schema={})".format(self.path, self.schema)
+
+
+class RunFinder(object):
+    """Find run directories in a tree, listing directories in parallel.
+    """
+    def __init__(self, runs=("relax1", "relax2"), nthreads=8, archives=False):
+        """Constructor.
+
+        :param runs: Names of the parts of a multi-part run, as for the drone
+        :type runs: list of str
+        :param nthreads: Number of directories listed concurrently
+        :type nthreads: int
+        :param archives: Whether to also find the runs in the archives of
+                         the tree (see :func:`is_archive`), after the others
+        :type archives: bool
+        """
+        self.runs = list(runs)
+        self.nthreads = max(nthreads, 1)
+        self.archives = archives
+        self.ndirs = 0  # directories listed by the last find()
+
+    def find(self, rootpath):
+        """Generate the run directories under `rootpath`.
+
+        Directories are yielded as soon as they are listed, so the order is
+        not defined. Directories that cannot be listed are skipped, as
+        ``os.walk`` does.
+
+        :param rootpath: Top of the tree, or an archive
+        :type rootpath: str
+        :return: Run directories, ArchiveRun objects for those in archives
+        :rtype: generator of RunDir
+        """
+        self.ndirs = 0
+        if os.path.isfile(rootpath) and is_archive(rootpath):
+            for run in self._find_in_archive(rootpath):
+                yield run
+            return
+        results = Queue.Queue()
+        pool = ThreadPool(self.nthreads)
+        pending = 0
+        archives = []
+        try:
+            pool.apply_async(self._scan, (rootpath,), callback=results.put)
+            pending += 1
+            while pending:
+                run, children, found, ndirs = results.get()
+                pending -= 1
+                self.ndirs += ndirs
+                archives.extend(found)
+                for child in children:
+                    pool.apply_async(self._scan, (child,), callback=results.put)
+                    pending += 1
+                if run is not None:
+                    yield run
+        finally:
+            pool.terminate()
+            pool.join()
+        for archive in sorted(archives):
+            for run in self._find_in_archive(archive):
+                yield run
+
+    def get_run(self, path):
+        """Classify one directory, without looking below it.
+
+        :param path: Directory
+        :type path: str
+        :return: The run in `path`, or None if it is not a run directory
+        :rtype: RunDir
+        """
+        return self._scan(path)[0]
+
+    def is_run(self, path, files, subdirs):
+        """Whether a directory is a run directory, from its listing.
+
+        :param path: Directory
+        :type path: str
+        :param files: Names of the files in it
+        :type files: list of str
+        :param subdirs: Names of its subdirectories
+        :type subdirs: list of str
+        :rtype: bool
+        """
+        return self._is_run(path, files, set(self.runs).intersection(subdirs))
+
+    def _find_in_archive(self, archive):
+        from matgendb.archive import iter_archive_runs
+        try:
+            for run in iter_archive_runs(archive, runs=self.runs):
+                yield run
+        except Exception as err:
+            # Corrupt or truncated archive: keep what was found before.
+            _log.warning("Cannot read {}: {}".format(archive, err))
+
+    def _scan(self, path):
+        """List one directory, and the run subfolders in it.
+
+        :return: (RunDir or None, directories to scan next, archives found,
+                  number of directories listed)
+        """
+        try:
+            return self._scan_dir(path)
+        except Exception as err:
+            # find() waits for one result per directory: never raise,
+            # e.g. for a name that cannot be decoded.
+            _log.warning("Cannot scan {}: {}".format(path, err))
+            return None, [], [], 0
+
+    def _scan_dir(self, path):
+        try:
+            files, subdirs, descend = _list_dir(path)
+        except OSError as err:
+            _log.warning("Cannot list {}: {}".format(path, err))
+            return None, [], [], 0
+        ndirs, children, listing = 1, [], {}
+        run_subdirs = set(self.runs).intersection(subdirs)
+        for name in descend:
+            full = os.path.join(path, name)
+            if name not in run_subdirs:
+                children.append(full)
+                continue
+            # List run subfolders here, as part of the run, and carry on
+            # with what is below them.
+            try:
+                sub_files, _, sub_descend = _list_dir(full)
+            except OSError as err:
+                _log.warning("Cannot list {}: {}".format(full, err))
+                continue
+            ndirs += 1
+            listing[name] = sub_files
+            children.extend(os.path.join(full, d) for d in sub_descend)
+        for name in run_subdirs.difference(listing):
+            # Symlinked run subfolders: listed, but not descended into.
+            try:
+                listing[name] = _list_dir(os.path.join(path, name))[0]
+                ndirs += 1
+            except OSError:
+                pass
+        run = None
+        if self._is_run(path, files, run_subdirs):
+            run = RunDir(path, files + sorted(run_subdirs), listing,
+                         runs=self.runs)
+        archives = []
+        if self.archives:
+            archives = [os.path.join(path, f) for f in files if is_archive(f)]
+        return run, children, archives, ndirs
+
+    def _is_run(self, path, files, run_subdirs):
+        # Same rules as VaspToDbTaskDrone.get_valid_paths
+        if run_subdirs:
+            return True
+        if any(path.endswith(os.sep + r) for r in self.runs):
+            return False
+        return any(fnmatch(f, "vasprun.xml*") for f in files)
+
+
+def find_runs(rootpath, runs=("relax1", "relax2"), nthreads=8,
+              archives=False):
+    """Generate the run directories under `rootpath`, or in the archive
+    `rootpath`. See :meth:`RunFinder.find`.
+    """
+    return RunFinder(runs=runs, nthreads=nthreads,
+                     archives=archives).find(rootpath)
@@ -0,0 +1,416 @@
+"""
+Binary storage format for densities of states.
+
+Task docs used to store a DOS in GridFS as the JSON of
+``CompleteDos.as_dict()``, optionally zlib-compressed. That is several times
+larger than the numbers it holds, and slow to read back. This module writes
+the DOS as contiguous arrays instead, with a small JSON index, and reads the
+arrays back with ``numpy.frombuffer``. Legacy JSON blobs are still read.
+
+Layout of a file (all integers little-endian)::
+
+    MAGIC (8 bytes)
+    array 0
+    array 1
+    ...
+    index (JSON, utf-8)
+    length of the index (uint64)
+    MAGIC (8 bytes)
+
+The index sits at the end so that a file can be written in one pass. It
+holds the format version, the Fermi energy, the structure (as a dict), and
+for each array its name, byte offset, size, dtype, shape and compression.
+The arrays are:
+
+* ``energies``: shape (nedos,)
+* ``total``: shape (nedos, nspins), columns in the order of ``spins``
+* ``site/<i>`` for each site i with projections: shape
+  (nedos, norbitals * nspins), columns (orbital, spin) in the order of
+  ``orbitals[i]`` and ``spins``
+
+Energy is the leading axis, so an energy window is one contiguous range of
+bytes of each uncompressed array. :class:`DosReader` reads only the index
+and the parts of the arrays that are asked for, so reading e.g. the total
+DOS near the Fermi level from GridFS fetches only a few chunks.
+"""
+
+import io
+import json
+import struct
+import zlib
+
+import numpy as np
+
+from monty.json import MontyEncoder
+from pymatgen.core.structure import Structure
+from pymatgen.electronic_structure.core import Orbital, Spin
+from pymatgen.electronic_structure.dos import CompleteDos, Dos
+
+MAGIC = b"\x89MGDBDOS"
+VERSION = 1
+_TRAILER = struct.Struct("<Q")
+
+#: Values of the `dos_format` drone option, with the dtype of the arrays
+FORMATS = {"binary": "<f8", "binary32": "<f4"}
+
+
+class DosFormatError(Exception):
+    pass
+
+
+def is_binary(data):
+    """Whether `data`, the start of a DOS file, is in the binary format."""
+    return data[:len(MAGIC)] == MAGIC
+
+
+def _spin_keys(densities):
+    # Spin up (1) first, as in Vasprun
+    return sorted(densities.keys(), key=lambda k: -int(k))
+
+
+class DosWriter(object):
+    """Write a DOS in the binary format to a file-like object, one array at
+    a time.
+    """
+    def __init__(self, fobj, dtype="<f8", compress=0):
+        """Constructor.
+
+        :param fobj: Binary file-like object to write to, e.g. a GridIn
+        :param dtype: Type of the stored numbers
+        :type dtype: str
+        :param compress: zlib compression level for each array, 0 for none
+        :type compress: int
+        """
+        self._f = fobj
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.compress = int(compress or 0)
+        self._pos = 0
+        self._arrays = []
+        self._write(MAGIC)
+
+    def _write(self, data):
+        self._f.write(data)
+        self._pos += len(data)
+
+    def add_array(self, name, values, **meta):
+        """Append an array.
+
+        :param name: Name of the array in the index
+        :type name: str
+        :param values: Array data, converted to the writer's dtype
+        :param meta: Extra entries for the index of this array
+        """
+        arr = np.ascontiguousarray(values, dtype=self.dtype)
+        data = arr.tobytes()
+        entry = {"name": name, "offset": self._pos, "shape": list(arr.shape),
+                 "dtype": self.dtype.str, "compression": None,
+                 "nbytes": len(data)}
+        if self.compress:
+            data = zlib.compress(data, self.compress)
+            entry["compression"] = "zlib"
+            entry["nbytes"] = len(data)
+        entry.update(meta)
+        self._write(data)
+        self._arrays.append(entry)
+
+    def close(self, **header):
+        """Write the index.
+
+        :param header: Entries for the index, e.g. efermi, structure
+        :return: Total number of bytes written
+        :rtype: int
+        """
+        index = dict(header, version=VERSION, arrays=self._arrays)
+        data = json.dumps(index, cls=MontyEncoder).encode("utf-8")
+        self._write(data)
+        self._write(_TRAILER.pack(len(data)))
+        self._write(MAGIC)
+        return self._pos
+
+
+def write_dos(d, fobj, dtype="<f8", compress=0):
+    """Write a DOS dict, as from ``CompleteDos.as_dict()``, in the binary
+    format. The derived "atom_dos" and "spd_dos" are not stored.
+
+    :param d: DOS dict
+    :type d: dict
+    :param fobj: Binary file-like object to write to
+    :param dtype: Type of the stored numbers
+    :type dtype: str
+    :param compress: zlib compression level for each array, 0 for none
+    :type compress: int
+    :return: Number of bytes written
+    :rtype: int
+    """
+    writer = DosWriter(fobj, dtype=dtype, compress=compress)
+    spins = _spin_keys(d["densities"])
+    energies = np.asarray(d["energies"], dtype=float)
+    writer.add_array("energies", energies)
+    writer.add_array("total", np.column_stack(
+        [np.asarray(d["densities"][s], dtype=float) for s in spins]))
+    orbitals = []
+    for i, site_pdos in enumerate(d.get("pdos") or []):
+        orbs = list(site_pdos.keys())
+        orbitals.append(orbs)
+        columns = [np.asarray(site_pdos[o]["densities"][s], dtype=float)
+                   for o in orbs for s in spins]
+        if columns:
+            writer.add_array("site/{:d}".format(i), np.column_stack(columns))
+    return writer.close(efermi=d["efermi"], structure=d.get("structure"),
+                        spins=[int(s) for s in spins], orbitals=orbitals,
+                        nedos=len(energies))
+
+
+def dumps(d, dtype="<f8", compress=0):
+    """Encode a DOS dict in the binary format. See :func:`write_dos`.
+
+    :rtype: bytes
+    """
+    buf = io.BytesIO()
+    write_dos(d, buf, dtype=dtype, compress=compress)
+    return buf.getvalue()
+
+
+class DosReader(object):
+    """Read the arrays of a binary DOS file, from a seekable file-like object
+    (e.g. a GridOut) or a bytes object. Only the index and the arrays that
+    are asked for are read.
+    """
+    def __init__(self, source):
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self._data = memoryview(source)
+            self._f = None
+            size = len(source)
+        else:
+            self._data = None
+            self._f = source
+            self._f.seek(0, 2)
+            size = self._f.tell()
+        tail_len = _TRAILER.size + len(MAGIC)
+        if size < len(MAGIC) + tail_len:
+            raise DosFormatError("Too short for a binary DOS")
+        tail = self._read(size - tail_len, tail_len)
+        if bytes(tail[_TRAILER.size:]) != MAGIC or \
+                bytes(self._read(0, len(MAGIC))) != MAGIC:
+            raise DosFormatError("Not a binary DOS")
+        index_len = _TRAILER.unpack(bytes(tail[:_TRAILER.size]))[0]
+        index = self._read(size - tail_len - index_len, index_len)
+        self.index = json.loads(bytes(index).decode("utf-8"))
+        if self.index.get("version", 0) > VERSION:
+            raise DosFormatError("Unsupported binary DOS version {}".format(
+                self.index.get("version")))
+        self._arrays = {a["name"]: a for a in self.index["arrays"]}
+
+    def _read(self, offset, nbytes):
+        if self._data is not None:
+            return self._data[offset:offset + nbytes]
+        self._f.seek(offset)
+        return self._f.read(nbytes)
+
+    @property
+    def efermi(self):
+        return self.index["efermi"]
+
+    @property
+    def structure(self):
+        """Structure as a dict."""
+        return self.index.get("structure")
+
+    @property
+    def spins(self):
+        return self.index["spins"]
+
+    @property
+    def orbitals(self):
+        """Names of the projected orbitals of each site."""
+        return self.index["orbitals"]
+
+    def has_array(self, name):
+        return name in self._arrays
+
+    def read_array(self, name, start=None, stop=None):
+        """Read an array, or a range of its rows (energies).
+
+        For uncompressed arrays only the bytes of the rows are read.
+
+        :param name: Name of the array, e.g. "total" or "site/0"
+        :type name: str
+        :param start: First row, default is 0
+        :type start: int
+        :param stop: Row after the last, default is all rows
+        :type stop: int
+        :return: Read-only array
+        :rtype: numpy.ndarray
+        """
+        meta = self._arrays[name]
+        dtype = np.dtype(meta["dtype"])
+        shape = list(meta["shape"])
+        nrows = shape[0]
+        start = 0 if start is None else max(0, min(start, nrows))
+        stop = nrows if stop is None else max(start, min(stop, nrows))
+        if meta["compression"] is None:
+            row_bytes = dtype.itemsize * int(np.prod(shape[1:]))
+            data = self._read(meta["offset"] + start * row_bytes,
+                              (stop - start) * row_bytes)
+            shape[0] = stop - start
+            return np.frombuffer(data, dtype=dtype).reshape(shape)
+        if meta["compression"] != "zlib":
+            raise DosFormatError("Unknown compression {}".format(
+                meta["compression"]))
+        data = zlib.decompress(self._read(meta["offset"], meta["nbytes"]))
+        return np.frombuffer(data, dtype=dtype).reshape(shape)[start:stop]
+
+    def read_dict(self, energy_range=None, sites=None, orbitals=None):
+        """Read the DOS, or part of it, as the arrays of a DOS dict.
+
+        :param energy_range: (min, max) energies to read, default is all
+        :type energy_range: tuple
+        :param sites: Indices of the sites whose projections are read,
+                      default is all
+        :type sites: list of int
+        :param orbitals: Orbitals of the projections to read, by name
+                         (e.g. "px") or type ("p"), default is all
+        :type orbitals: list of str
+        :return: {"efermi", "structure", "energies": array,
+                  "densities": {spin: array},
+                  "pdos": [{orbital: {spin: array}} or None per site]}.
+                  Sites not read have None in "pdos".
+        :rtype: dict
+        """
+        spins = self.spins
+        sites = None if sites is None else set(sites)
+        energies = self.read_array("energies")
+        start, stop = energy_window(energies, energy_range)
+        total = self.read_array("total", start, stop)
+        d = {"efermi": self.efermi, "structure": self.structure,
+             "energies": energies[start:stop],
+             "densities": {s: total[:, j] for j, s in enumerate(spins)},
+             "pdos": []}
+        for i, orbs in enumerate(self.orbitals):
+            name = "site/{:d}".format(i)
+            if sites is not None and i not in sites:
+                d["pdos"].append(None)
+                continue
+            wanted = [k for k, orb in enumerate(orbs)
+                      if orbital_matches(orb, orbitals)]
+            site = self.read_array(name, start, stop) \
+                if wanted and self.has_array(name) else None
+            pdos = {}
+            for k in wanted:
+                pdos[orbs[k]] = {s: site[:, k * len(spins) + j]
+                                 for j, s in enumerate(spins)}
+            d["pdos"].append(pdos)
+        return d
+
+
+def energy_window(energies, energy_range):
+    """Rows of `energies` (sorted) within `energy_range`.
+
+    :return: (start, stop) row indices
+    :rtype: tuple
+    """
+    if energy_range is None:
+        return 0, len(energies)
+    emin, emax = energy_range
+    start = 0 if emin is None else \
+        int(np.searchsorted(energies, emin, side="left"))
+    stop = len(energies) if emax is None else \
+        int(np.searchsorted(energies, emax, side="right"))
+    return start, max(start, stop)
+
+
+def orbital_matches(name, orbitals):
+    """Whether orbital `name` (e.g. "px") is selected by `orbitals`, a list
+    of orbital names and types (e.g. ["s", "p"]), or None for all.
+    """
+    return orbitals is None or name in orbitals or name[0] in orbitals
+
+
+def sites_with_elements(structure, elements):
+    """Indices of the sites of a structure dict that hold any of `elements`.
+
+    :param structure: Structure, as a dict
+    :type structure: dict
+    :param elements: Element symbols
+    :type elements: list of str
+    :rtype: list of int
+    """
+    elements = set(elements)
+    return [i for i, site in enumerate(structure["sites"])
+            if any(sp["element"] in elements for sp in site["species"])]
+
+
+def select(d, energy_range=None, sites=None, orbitals=None):
+    """Apply the selection of :meth:`DosReader.read_dict` to a DOS dict that
+    was read in full, e.g. from a legacy blob.
+
+    :rtype: dict
+    """
+    start, stop = energy_window(d["energies"], energy_range)
+    sites = None if sites is None else set(sites)
+    pdos = []
+    for i, site_pdos in enumerate(d["pdos"]):
+        if site_pdos is None or (sites is not None and i not in sites):
+            pdos.append(None)
+            continue
+        pdos.append({orb: {s: dens[start:stop] for s, dens in spins.items()}
+                     for orb, spins in site_pdos.items()
+                     if orbital_matches(orb, orbitals)})
+    return {"efermi": d["efermi"], "structure": d["structure"],
+            "energies": d["energies"][start:stop],
+            "densities": {s: dens[start:stop]
+                          for s, dens in d["densities"].items()},
+            "pdos": pdos}
+
+
+def loads_legacy(data):
+    """Decode a legacy JSON DOS blob, possibly zlib-compressed, into the
+    same form as :meth:`DosReader.read_dict`.
+
+    :rtype: dict
+    """
+    try:
+        d = json.loads(data)
+    except Exception:
+        d = json.loads(zlib.decompress(data).decode("utf-8"))
+    return {"efermi": d["efermi"], "structure": d.get("structure"),
+            "energies": np.asarray(d["energies"]),
+            "densities": {int(s): np.asarray(v)
+                          for s, v in d["densities"].items()},
+            "pdos": [{orb: {int(s): np.asarray(v)
+                            for s, v in odos["densities"].items()}
+                      for orb, odos in site_pdos.items()}
+                     for site_pdos in d.get("pdos", [])]}
+
+
+def loads(data):
+    """Decode a DOS blob in either format, as :meth:`DosReader.read_dict`.
+
+    :param data: Contents of the GridFS file
+    :type data: bytes
+    :rtype: dict
+    """
+    if is_binary(data):
+        return DosReader(data).read_dict()
+    return loads_legacy(data)
+
+
+def to_complete_dos(d, structure=None):
+    """Build a CompleteDos from the output of :meth:`DosReader.read_dict`.
+
+    :param structure: Structure, if not taken from `d`
+    :type structure: pymatgen.core.structure.Structure
+    :rtype: pymatgen.electronic_structure.dos.CompleteDos
+    """
+    if structure is None:
+        structure = Structure.from_dict(d["structure"])
+    tdos = Dos(d["efermi"], d["energies"],
+               {Spin(int(s)): dens for s, dens in d["densities"].items()})
+    pdoss = {}
+    for i, site_pdos in enumerate(d["pdos"]):
+        if site_pdos is None:
+            continue
+        pdoss[structure[i]] = {
+            Orbital[orb]: {Spin(int(s)): dens for s, dens in spins.items()}
+            for orb, spins in site_pdos.items()}
+    return CompleteDos(structure, tdos, pdoss)
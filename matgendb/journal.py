@@ -0,0 +1,186 @@
+"""
+Journals of the run directories handled by an ingestion.
+
+A journal records the status of every run directory as it goes through
+:class:`matgendb.pipeline.IngestPipeline`: written, or skipped (unchanged
+or duplicate), or failed, with the traceback. When an
+ingestion is interrupted, running it again with the same journal skips the
+directories already written or skipped, and redoes only the others::
+
+    journal = get_journal("insert.journal")
+    pipeline = IngestPipeline(drone, journal=journal)
+    pipeline.run(find_runs("/path/to/runs", runs=drone.runs))
+
+The journal is either an append-only file of JSON lines, one per status
+change, or a MongoDB collection with one document per directory.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from pymongo import UpdateOne
+
+_log = logging.getLogger("mg.journal")
+
+#: Statuses of a directory. IngestPipeline does not record QUEUED or
+#: PARSED, which are not needed to resume, to save a write per directory.
+QUEUED = "queued"
+PARSED = "parsed"
+WRITTEN = "written"
+SKIPPED = "skipped"
+FAILED = "failed"
+STATUSES = (QUEUED, PARSED, WRITTEN, SKIPPED, FAILED)
+
+#: Statuses of the directories that need no more work
+FINISHED = (WRITTEN, SKIPPED)
+
+
+class Journal(object):
+    """Base class of journals.
+    """
+    def record(self, path, status, error=None):
+        """Record the status of a directory.
+
+        :param path: Absolute path of the run directory
+        :type path: str
+        :param status: One of STATUSES
+        :type status: str
+        :param error: Traceback or message, for FAILED
+        :type error: str
+        """
+        self.record_many([path], status, error=error)
+
+    def record_many(self, paths, status, error=None):
+        """Record the same status for several directories."""
+        raise NotImplementedError()
+
+    def get_status(self):
+        """Last status of each directory.
+
+        :return: Map of path to status
+        :rtype: dict
+        """
+        raise NotImplementedError()
+
+    def finished(self):
+        """Directories that need no more work.
+
+        :rtype: set
+        """
+        return {path for path, status in self.get_status().items()
+                if status in FINISHED}
+
+    def counts(self):
+        """Number of directories with each status.
+
+        :rtype: dict
+        """
+        counts = dict.fromkeys(STATUSES, 0)
+        for status in self.get_status().values():
+            counts[status] += 1
+        return counts
+
+    def close(self):
+        pass
+
+
+class FileJournal(Journal):
+    """Journal in a local file of JSON lines, appended to and flushed at
+    every status change, so that it survives the death of the process.
+    """
+    def __init__(self, filename):
+        """Constructor. Reads the file back, if there is one.
+
+        :param filename: Path of the journal file
+        :type filename: str
+        """
+        self.filename = filename
+        self._status = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line cut short by a crash
+                        continue
+                    self._status[entry["path"]] = entry["status"]
+        self._lock = threading.Lock()
+        self._f = open(filename, "a")
+        if self._f.tell() > 0:
+            with open(filename, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._f.write("\n")
+
+    def record_many(self, paths, status, error=None):
+        now = time.time()
+        lines = []
+        for path in paths:
+            entry = {"path": path, "status": status, "time": now}
+            if error is not None:
+                entry["error"] = error
+            lines.append(json.dumps(entry) + "\n")
+        with self._lock:
+            self._f.write("".join(lines))
+            self._f.flush()
+            for path in paths:
+                self._status[path] = status
+
+    def get_status(self):
+        with self._lock:
+            return dict(self._status)
+
+    def close(self):
+        self._f.close()
+
+
+class MongoJournal(Journal):
+    """Journal in a MongoDB collection, with one document per directory:
+    ``{"_id": path, "status": ..., "time": ..., "error": ...}``.
+    """
+    def __init__(self, collection):
+        """Constructor.
+
+        :param collection: Collection of the journal
+        :type collection: pymongo.collection.Collection
+        """
+        self.collection = collection
+
+    def record_many(self, paths, status, error=None):
+        if not paths:
+            return
+        update = {"$set": {"status": status, "time": time.time(),
+                           "error": error}}
+        self.collection.bulk_write(
+            [UpdateOne({"_id": path}, update, upsert=True) for path in paths],
+            ordered=False)
+
+    def get_status(self):
+        return {r["_id"]: r["status"]
+                for r in self.collection.find({}, ["status"])}
+
+    def finished(self):
+        return {r["_id"] for r in self.collection.find(
+            {"status": {"$in": list(FINISHED)}}, ["_id"])}
+
+
+def get_journal(spec, db=None):
+    """Open a journal.
+
+    :param spec: "mongo:<collection>" for a collection of `db`, else the
+        path of a journal file
+    :type spec: str
+    :param db: Database of the journal collection
+    :type db: pymongo.database.Database
+    :rtype: Journal
+    """
+    if spec.startswith("mongo:"):
+        if db is None:
+            raise ValueError("A database is needed for journal {}".format(
+                spec))
+        return MongoJournal(db[spec[len("mongo:"):]])
+    return FileJournal(spec)
@@ -0,0 +1,177 @@
+"""
+Lazily decoded query results.
+
+pymongo decodes every field of every document it returns, including large
+arrays such as "calculations" that a query over full task docs may never
+look at. With ``QueryEngine.query(..., raw=True)``, documents are read as
+``bson.raw_bson.RawBSONDocument`` and wrapped in the classes here, which
+decode a field only when it is accessed, and then only the part of the
+document on the path to it::
+
+    for r in qe.query(["task_id", "analysis.e_above_hull"], raw=True):
+        if r["analysis.e_above_hull"] < 0.05:  # decodes analysis only
+            ...
+
+Accessed values are plain Python objects, as with ``raw=False``, and fields
+can be set and deleted as in a dict.
+"""
+
+import bson
+from bson.raw_bson import RawBSONDocument
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+#: Errors that map a property missing from a record to None
+_MISSING = (IndexError, KeyError, ValueError)
+
+# Value of a deleted field
+_DELETED = object()
+
+
+def to_python(value):
+    """Decode a value read from a RawBSONDocument, recursively.
+    """
+    if isinstance(value, RawBSONDocument):
+        return bson.BSON(value.raw).decode()
+    if isinstance(value, list):
+        return [to_python(v) for v in value]
+    return value
+
+
+class LazyRecord(MutableMapping):
+    """A document of the database, decoded field by field as they are
+    accessed. Fields can be set or deleted, e.g. by the result_post
+    functions of a QueryEngine, without touching the raw document.
+    """
+    __slots__ = ("_raw", "_fields")
+
+    def __init__(self, raw):
+        """Constructor.
+
+        :param raw: Raw document
+        :type raw: bson.raw_bson.RawBSONDocument
+        """
+        self._raw = raw
+        self._fields = {}  # decoded, set or deleted fields
+
+    @property
+    def raw(self):
+        """The raw BSON bytes of the document, as read: fields set or
+        deleted since are not reflected in them.
+        """
+        return self._raw.raw
+
+    def get_raw(self, key):
+        """Value of a field, with its subdocuments not decoded."""
+        if key in self._fields:
+            value = self._fields[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+        return self._raw[key]
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            self._fields[key] = to_python(self._raw[key])
+        value = self._fields[key]
+        if value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._fields[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        # The raw document is left as is: the field is marked as deleted
+        self._fields[key] = _DELETED
+
+    def __iter__(self):
+        fields = self._fields
+        for key in self._raw:
+            if fields.get(key) is not _DELETED:
+                yield key
+        for key, value in fields.items():
+            if key not in self._raw and value is not _DELETED:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self):
+        """Decode the whole document."""
+        return {key: self[key] for key in self}
+
+    def __repr__(self):
+        return "LazyRecord({})".format(self.to_dict())
+
+
+class LazyResult(MutableMapping):
+    """A mapped query result: properties keyed by name, as in the dicts of
+    QueryResults, read from a :class:`LazyRecord` when first accessed.
+    """
+    __slots__ = ("_record", "_prop_dict", "_values")
+
+    def __init__(self, record, prop_dict):
+        """Constructor.
+
+        :param record: Record the properties are read from
+        :type record: LazyRecord
+        :param prop_dict: Map of property name to its keys in the record, as
+            made by QueryEngine._parse_properties()
+        :type prop_dict: dict
+        """
+        self._record = record
+        self._prop_dict = prop_dict
+        self._values = {}
+
+    def _read(self, path):
+        try:
+            data = self._record.get_raw(path[0])
+            for key in path[1:]:
+                if isinstance(data, list):
+                    data = [d[key] for d in data]
+                else:
+                    data = data[key]
+        except _MISSING:
+            return None
+        return to_python(data)
+
+    def __getitem__(self, name):
+        if name not in self._values:
+            # KeyError for names that are not properties, as for a dict
+            self._values[name] = self._read(self._prop_dict[name])
+        value = self._values[name]
+        if value is _DELETED:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        self._values[name] = value
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._values[name] = _DELETED
+
+    def __iter__(self):
+        values = self._values
+        for name in self._prop_dict:
+            if values.get(name) is not _DELETED:
+                yield name
+        for name, value in values.items():
+            if name not in self._prop_dict and value is not _DELETED:
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self):
+        """Read all the properties."""
+        return {name: self[name] for name in self}
+
+    def __repr__(self):
+        return "LazyResult({})".format(self.to_dict())
@@ -0,0 +1,362 @@
+"""
+Staged ingestion of VASP runs into a database.
+
+The work of a drone's ``assimilate`` is split into two stages that run
+concurrently:
+
+1. *parse*: a pool of processes parses and analyzes run directories
+   (``drone.process_path``), which is CPU-bound. Runs that are unchanged
+   since they were last inserted are skipped here.
+2. *write*: a few threads in the parent process write the resulting task docs
+   to MongoDB/GridFS in batches (``drone.insert_docs``), which is I/O-bound.
+
+The stages are connected by a bounded queue. When the writers fall behind,
+no new directories are handed to the parsers until there is room again, so
+the number of task docs held in memory stays bounded no matter how many
+directories there are. Usage::
+
+    drone = VaspToDbTaskDrone(..., batch_size=100)
+    pipeline = IngestPipeline(drone, nprocs=16, nwriters=2)
+    pipeline.run(find_runs("/path/to/runs", runs=drone.runs))
+    print(pipeline.stats)
+
+With a journal (see :mod:`matgendb.journal`), the status of every directory
+is recorded as it goes, and the directories already written or skipped by an
+earlier, interrupted run are not parsed again.
+"""
+
+import functools
+import logging
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+import traceback
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+import six
+
+from matgendb import journal as jrnl
+from matgendb.archive import ArchiveRun
+from matgendb.discovery import RunDir
+
+_log = logging.getLogger("mg.pipeline")
+
+
+class StageStats(object):
+    """Throughput counters for one stage of the pipeline.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.count = 0      # items done
+        self.errors = 0     # items failed
+        self.skipped = 0    # items that needed no work
+        self.seconds = 0.0  # time spent on the items
+        self._lock = threading.Lock()
+
+    def add(self, count=1, seconds=0.0, errors=0, skipped=0):
+        with self._lock:
+            self.count += count
+            self.seconds += seconds
+            self.errors += errors
+            self.skipped += skipped
+
+    @property
+    def rate(self):
+        """Items per second of stage time."""
+        return self.count / self.seconds if self.seconds > 0 else 0.0
+
+    def as_dict(self):
+        return {"count": self.count, "errors": self.errors,
+                "skipped": self.skipped, "seconds": self.seconds,
+                "rate": self.rate}
+
+    def __str__(self):
+        return "{}: {:d} done, {:d} skipped, {:d} failed, {:.1f}s, " \
+               "{:.2f}/s".format(self.name, self.count, self.skipped,
+                                 self.errors, self.seconds, self.rate)
+
+
+class PipelineStats(object):
+    """Counters for all stages of a pipeline run.
+    """
+    STAGES = ("parse", "write")
+
+    def __init__(self):
+        self.stages = {name: StageStats(name) for name in self.STAGES}
+        # Time spent in each analysis stage of the parse stage, from the
+        # "analysis_timings" of the task docs
+        self.analysis = {}
+        self.max_queued = 0     # high-water mark of the queue
+        self.wall_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        return self.stages[name]
+
+    def add_analysis_timings(self, timings):
+        """Add the analysis stage timings of one task doc."""
+        for name, seconds in timings.items():
+            with self._lock:
+                if name not in self.analysis:
+                    self.analysis[name] = StageStats(name)
+            self.analysis[name].add(seconds=seconds)
+
+    def as_dict(self):
+        d = {name: s.as_dict() for name, s in self.stages.items()}
+        d["analysis"] = {name: s.as_dict() for name, s in self.analysis.items()}
+        d["max_queued"] = self.max_queued
+        d["wall_seconds"] = self.wall_seconds
+        return d
+
+    def __str__(self):
+        lines = [str(self.stages[name]) for name in self.STAGES]
+        for name in sorted(self.analysis):
+            lines.append("  " + str(self.analysis[name]))
+        lines.append("max. queued: {:d}, wall time: {:.1f}s".format(
+            self.max_queued, self.wall_seconds))
+        return "\n".join(lines)
+
+
+def find_valid_paths(drone, rootpath):
+    """Generate the run directories under `rootpath` that `drone` accepts.
+
+    This lists every directory serially and the drone lists each run again;
+    :func:`matgendb.discovery.find_runs` is faster for large trees.
+    """
+    for path in os.walk(rootpath):
+        for valid_path in drone.get_valid_paths(path):
+            yield valid_path
+
+
+def _item_path(item):
+    if isinstance(item, ArchiveRun):
+        return item.location
+    return item.path if isinstance(item, RunDir) else item
+
+
+# Drone of the current worker process, set once by the pool initializer
+# so that it is not pickled again for every directory.
+_worker_drone = None
+
+
+def _init_worker(drone):
+    global _worker_drone
+    _worker_drone = drone
+
+
+def _parse(item):
+    """Parse stage, run in a worker process.
+
+    :param item: Run directory, or a RunDir from :mod:`matgendb.discovery`
+    :return: (path, task doc or None, seconds, traceback or None). The doc
+             is None without a traceback if the run was skipped.
+    """
+    t0 = time.time()
+    path = item
+    try:
+        if isinstance(item, RunDir):
+            path = _item_path(item)
+            d = _worker_drone.process_path(item.path, run_dir=item)
+        else:
+            d = _worker_drone.process_path(path)
+        result = path, d, time.time() - t0, None
+        if six.PY2:
+            # Python 2 pools have no error_callback: a result that cannot
+            # be sent back would never reach the pipeline.
+            pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        return result
+    except Exception:
+        return path, None, time.time() - t0, traceback.format_exc()
+
+
+class IngestPipeline(object):
+    """Parse run directories in a process pool and write the task docs
+    from a few writer threads, with a bounded queue in between.
+    """
+    # Marks the end of the input for the writers
+    _DONE = None
+
+    def __init__(self, drone, nprocs=None, nwriters=2, queue_size=100,
+                 batch_size=None, flush_interval=1.0, journal=None):
+        """Constructor.
+
+        :param drone: Drone that parses (process_path) and writes (insert_docs)
+        :type drone: matgendb.creator.VaspToDbTaskDrone
+        :param nprocs: Number of parser processes, default is the number of CPUs
+        :type nprocs: int
+        :param nwriters: Number of writer threads
+        :type nwriters: int
+        :param queue_size: Max. number of parsed docs waiting to be written
+        :type queue_size: int
+        :param batch_size: Docs per write, default is the drone's batch_size
+        :type batch_size: int
+        :param flush_interval: Seconds a writer waits for the next doc before
+                               writing a partial batch
+        :type flush_interval: float
+        :param journal: Journal in which to record the status of each
+                        directory, and whose finished directories to skip
+        :type journal: matgendb.journal.Journal
+        """
+        self.drone = drone
+        self.nprocs = nprocs or multiprocessing.cpu_count()
+        self.nwriters = max(nwriters, 1)
+        self.queue_size = max(queue_size, 1)
+        self.batch_size = batch_size or getattr(drone, "batch_size", 1)
+        self.flush_interval = flush_interval
+        self.journal = journal
+        self.stats = PipelineStats()
+        self._queue = None
+        self._slots = None
+
+    def run(self, paths):
+        """Ingest all run directories in `paths`.
+
+        :param paths: Run directories, as paths or RunDir objects; may be a
+                      generator
+        :type paths: iterable
+        :return: Number of task docs written
+        :rtype: int
+        """
+        t0 = time.time()
+        finished = self.journal.finished() if self.journal else set()
+        if finished:
+            _log.info("Resuming: {:d} directories already done".format(
+                len(finished)))
+        self._queue = Queue.Queue(maxsize=self.queue_size)
+        # Every path holds a slot from the time it is handed to the parsers
+        # until a writer takes it off the queue. This is the back-pressure.
+        self._slots = threading.BoundedSemaphore(self.queue_size + self.nprocs)
+        # Fork the parsers before starting any threads.
+        pool = multiprocessing.Pool(self.nprocs, initializer=_init_worker,
+                                    initargs=(self.drone,))
+        writers = [threading.Thread(target=self._write_loop,
+                                    name="writer-{:d}".format(i))
+                   for i in range(self.nwriters)]
+        for w in writers:
+            w.daemon = True
+            w.start()
+        try:
+            for path in paths:
+                if self.journal is not None:
+                    abspath = os.path.abspath(_item_path(path))
+                    if abspath in finished:
+                        self.stats["parse"].add(count=0, skipped=1)
+                        if isinstance(path, ArchiveRun):
+                            path.cleanup()
+                        continue
+                self._slots.acquire()
+                kwargs = {"callback": self._parsed}
+                if not six.PY2:
+                    # e.g. a doc that cannot be pickled back from the worker
+                    kwargs["error_callback"] = functools.partial(
+                        self._parse_failed, _item_path(path))
+                pool.apply_async(_parse, (path,), **kwargs)
+        finally:
+            pool.close()
+            pool.join()
+            for _ in writers:
+                self._queue.put(self._DONE)
+            for w in writers:
+                w.join()
+        self.stats.wall_seconds = time.time() - t0
+        _log.info("Pipeline done:\n{}".format(self.stats))
+        return self.stats["write"].count
+
+    def _parsed(self, result):
+        """Pool callback: account for a parse result and queue it."""
+        path, d, seconds, tb = result
+        if d is None and tb is None:
+            self.stats["parse"].add(count=0, seconds=seconds, skipped=1)
+            self._record([path], jrnl.SKIPPED)
+            self._slots.release()
+            return
+        if d is None:
+            self.stats["parse"].add(count=0, seconds=seconds, errors=1)
+            _log.error("Failed to parse {}:\n{}".format(path, tb))
+            self._record([path], jrnl.FAILED, error=tb)
+            self._slots.release()
+            return
+        self.stats["parse"].add(seconds=seconds)
+        self.stats.add_analysis_timings(d.get("analysis_timings", {}))
+        self._queue.put((path, d))
+        self.stats.max_queued = max(self.stats.max_queued, self._queue.qsize())
+
+    def _parse_failed(self, path, err):
+        """Pool error callback: the parse result never came back."""
+        tb = "".join(traceback.format_exception_only(type(err), err))
+        self.stats["parse"].add(count=0, errors=1)
+        _log.error("Failed to parse {}:\n{}".format(path, tb))
+        self._record([path], jrnl.FAILED, error=tb)
+        self._slots.release()
+
+    def _write_loop(self):
+        """Body of a writer thread."""
+        batch, done = [], False
+        while not done:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+                if item is self._DONE:
+                    done = True
+                else:
+                    self._slots.release()
+                    batch.append(item)
+                idle = False
+            except Queue.Empty:
+                idle = True
+            if batch and (done or idle or len(batch) >= self.batch_size):
+                self._write(batch)
+                batch = []
+
+    def _write(self, batch):
+        """Write a batch of (path, task doc)."""
+        t0 = time.time()
+        paths = [path for path, d in batch]
+        try:
+            written = self.drone.insert_docs([d for path, d in batch])
+            self.stats["write"].add(count=len(written),
+                                    seconds=time.time() - t0)
+        except Exception:
+            tb = traceback.format_exc()
+            self.stats["write"].add(count=0, seconds=time.time() - t0,
+                                    errors=len(batch))
+            _log.error("Failed to write {:d} docs:\n{}".format(
+                len(batch), tb))
+            self._record(paths, jrnl.FAILED, error=tb)
+            return
+        if self.journal is None:
+            return
+        # Docs that got a task_id but were not written failed; docs that
+        # never got one were skipped as duplicates. In simulate mode, the
+        # docs themselves come back.
+        if getattr(self.drone, "simulate", False):
+            self._record(paths, jrnl.WRITTEN)
+            return
+        written = set(written)
+        status = {jrnl.WRITTEN: [], jrnl.SKIPPED: [], jrnl.FAILED: []}
+        for path, d in batch:
+            if d.get("task_id") in written:
+                status[jrnl.WRITTEN].append(path)
+            elif d.get("task_id"):
+                status[jrnl.FAILED].append(path)
+            else:
+                status[jrnl.SKIPPED].append(path)
+        for name, group in status.items():
+            if group:
+                self._record(group, name, error="Write failed"
+                             if name == jrnl.FAILED else None)
+
+    def _record(self, paths, status, error=None):
+        """Record the status of directories in the journal, if any."""
+        if self.journal is None:
+            return
+        try:
+            self.journal.record_many([os.path.abspath(p) for p in paths],
+                                     status, error=error)
+        except Exception:
+            _log.error("Cannot record {} in the journal:\n{}".format(
+                status, traceback.format_exc()))
@@ -13,22 +13,36 @@ __email__ = "shyuep@gmail.com"
 __status__ = "Production"
 __date__ = "Mar 2 2013"
 
+import base64
+import binascii
 import json
 import itertools
 import logging
+import numbers
 import os
+import sys
+import threading
 import gridfs
-import zlib
+import numpy as np
+import six
 from collections import OrderedDict, Iterable
+from multiprocessing.pool import ThreadPool
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 
 import pymongo
-from pymongo import MongoClient
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 from pymatgen import Structure, Composition
-from pymatgen.electronic_structure.core import Orbital, Spin
-from pymatgen.electronic_structure.dos import CompleteDos, Dos
 from pymatgen.entries.computed_entries import ComputedEntry,\
     ComputedStructureEntry
 
+from matgendb import blobs, dbclient, dosio
+from matgendb.lazydoc import LazyRecord, LazyResult, _MISSING
+
 _log = logging.getLogger('mg.' + __name__)
 
 
@@ -67,6 +81,8 @@ class QueryEngine(object):
     # Post-processing operations
     query_post = None         #: See `query_post` arg to constructor
     result_post = None        #: See `result_post` arg to constructor
+    # Whether `connection` comes from the shared client registry
+    _shared_connection = False
 
     def __init__(self, host="127.0.0.1", port=27017, database="vasp",
                  user=None, password=None, collection="tasks",
@@ -83,7 +99,10 @@ class QueryEngine(object):
             password (str): Password for db access. `None` means no auth.
             collection (str): Collection to query. Defaults to "tasks".
             connection (pymongo.Connection): If given, ignore 'host' and 'port'
-                and use existing connection.
+                and use existing connection. Otherwise, a client shared
+                with all other users of the same host, port, replicaset and
+                credentials in this process is used (see
+                :mod:`matgendb.dbclient`).
             aliases_config(dict):
                 An alias dict to use. Defaults to None, which means the default
                 aliases defined in "aliases.json" is used. The aliases config
@@ -125,12 +144,10 @@ class QueryEngine(object):
         self.replicaset = replicaset
         self.database_name = database
         if connection is None:
-            # can't pass replicaset=None to MongoClient (fails validation)
-            if self.replicaset:
-                self.connection = MongoClient(self.host, self.port,
-                                              replicaset=self.replicaset)
-            else:
-                self.connection = MongoClient(self.host, self.port)
+            self.connection = dbclient.get_client(
+                self.host, self.port, replicaset=self.replicaset,
+                user=user, password=password)
+            self._shared_connection = True
         else:
             self.connection = connection
         self.db = self.connection[database]
@@ -214,8 +231,11 @@ class QueryEngine(object):
         self.close()
 
     def close(self):
-        """Disconnects the connection."""
-        self.connection.disconnect()
+        """Disconnects the connection.
+        Shared connections are left open for the other engines using them.
+        """
+        if not self._shared_connection:
+            self.connection.disconnect()
 
     def get_entries_in_system(self, elements, inc_structure=False,
                               optional_data=None, additional_criteria=None):
@@ -367,7 +387,7 @@ class QueryEngine(object):
         return self.collection.ensure_index(key, unique=unique)
 
     def query(self, properties=None, criteria=None, distinct_key=None,
-              **kwargs):
+              raw=False, **kwargs):
         """
         Convenience method for database access.  All properties and criteria
         can be specified using simplified names defined in Aliases.  You can
@@ -392,6 +412,9 @@ class QueryEngine(object):
         :param properties: Properties to query for. Defaults to None which means all supported properties.
         :param criteria: Criteria to query for as a dict.
         :param distinct_key: If not None, the key for which to get distinct results
+        :param raw: If True, records are read as raw BSON and only the fields
+            that are accessed are decoded (see :mod:`matgendb.lazydoc`).
+            Results are then lazily decoded mappings instead of dicts.
         :param \*\*kwargs: Other kwargs supported by pymongo.collection.find.
             Useful examples are limit, skip, sort, etc.
         :return: A QueryResults Iterable, which is somewhat like pymongo's
@@ -408,13 +431,19 @@ class QueryEngine(object):
         if self.query_post:
             for func in self.query_post:
                 func(crit, props)
-        cur = self.collection.find(filter=crit, projection=props, **kwargs)
+        coll = self.collection
+        raw = raw and distinct_key is None
+        if raw:
+            coll = coll.with_options(codec_options=CodecOptions(
+                document_class=RawBSONDocument))
+        cur = coll.find(filter=crit, projection=props, **kwargs)
 
         if distinct_key is not None:
             cur = cur.distinct(distinct_key)
             return QueryListResults(prop_dict, cur, postprocess=self.result_post)
         else:
-            return QueryResults(prop_dict, cur, postprocess=self.result_post)
+            return QueryResults(prop_dict, cur, postprocess=self.result_post,
+                                raw=raw)
 
     def _parse_properties(self, properties):
         """Make list of properties into 2 things:
@@ -448,6 +477,136 @@ class QueryEngine(object):
         props = OrderedDict(sorted(props.items(), reverse=True))
         return props, prop_dict
 
+    def query_columns(self, properties, criteria=None, dtypes=None,
+                      batch_size=10000, **kwargs):
+        """Query scalar properties into one NumPy array per property, without
+        making a dict per record.
+
+        The cursor is read in batches, whose values are copied into arrays
+        that grow geometrically. Each array is a masked array, whose mask
+        marks the records that lack the property::
+
+            cols = qe.query_columns(["task_id", "energy", "nsites"],
+                                    {"nelements": 2}, dtypes={"nsites": int})
+            stable = cols["energy"] < -5   # masked where energy is missing
+
+        The arrays can be handed to pandas, e.g. ``pandas.DataFrame(cols)``.
+
+        :param properties: Properties, as for query()
+        :type properties: list of str
+        :param criteria: Criteria, as for query()
+        :type criteria: dict
+        :param dtypes: NumPy dtype of some properties. By default, the dtype
+            is inferred from the first value: float64 for numbers, bool for
+            booleans, object otherwise
+        :type dtypes: dict
+        :param batch_size: Number of records per batch
+        :type batch_size: int
+        :param kwargs: Other arguments of pymongo.collection.find, e.g. sort
+        :return: Map of property to its values, in the order of `properties`
+        :rtype: OrderedDict of numpy.ma.MaskedArray
+        :raises QueryError: If a value cannot be stored with the dtype of
+            its property
+        """
+        props, prop_dict = self._parse_properties(properties)
+        crit = self._parse_criteria(criteria)
+        if self.query_post:
+            for func in self.query_post:
+                func(crit, props)
+        cur = self.collection.find(filter=crit, projection=props,
+                                   batch_size=batch_size, **kwargs)
+        dtypes = dtypes or {}
+        names = list(prop_dict)
+        columns = [_ColumnBuffer(name, dtypes.get(name)) for name in names]
+        get_values = compile_mapper(prop_dict, as_list=True)
+        it = iter(cur)
+        while True:
+            records = list(itertools.islice(it, batch_size))
+            if not records:
+                break
+            if self.result_post:
+                for r in records:
+                    for func in self.result_post:
+                        func(r)
+            rows = [get_values(r) for r in records]
+            for j, column in enumerate(columns):
+                column.extend([row[j] for row in rows])
+        return OrderedDict((name, column.get_array())
+                           for name, column in zip(names, columns))
+
+    def iter_pages(self, criteria=None, properties=None, key="task_id",
+                   page_size=1000, resume_token=None, descending=False):
+        """Page through the results of a query in the order of `key`.
+
+        Unlike paging with `skip`, which makes the server scan all the
+        skipped documents again, each page is read with a range predicate
+        on `key`, starting after the last value of the previous page, so
+        that every page costs the same with an index on `key`::
+
+            for page, token in qe.iter_pages({"nelements": 2}, ["energy"]):
+                process(page)
+                save(token)   # to resume after the page with resume_token
+
+        `key` should have a unique value in every document, e.g. task_id;
+        documents where it is missing or null are skipped. Unlike query(), the
+        default criteria apply when no `criteria` are given.
+
+        :param criteria: Criteria, as for query()
+        :type criteria: dict
+        :param properties: Properties, as for query(). Default is the whole
+            documents
+        :type properties: list of str
+        :param key: Property to page on, which may be an alias
+        :type key: str
+        :param page_size: Max. number of results per page
+        :type page_size: int
+        :param resume_token: Token yielded with a page of a previous scan,
+            to resume after that page
+        :type resume_token: str
+        :param descending: Whether to go in decreasing order of `key`
+        :type descending: bool
+        :return: Pages of results, each with the token to resume after it
+        :rtype: generator of (list of dict, str)
+        :raises QueryError: If the resume token is invalid, or was made
+            for another key or order
+        """
+        field = self.aliases.get(key, key)
+        direction = pymongo.DESCENDING if descending else pymongo.ASCENDING
+        last = _NO_VALUE
+        if resume_token is not None:
+            last = _decode_page_token(resume_token, field, direction)
+        if properties is not None:
+            props, prop_dict = self._parse_properties(properties)
+        else:
+            props, prop_dict = None, None
+        crit = self._parse_criteria({} if criteria is None else criteria)
+        if self.query_post:
+            for func in self.query_post:
+                func(crit, props)
+        if props and field not in props and any(props.values()):
+            # the key is needed to resume, even if not asked for
+            props[field] = 1
+            props = OrderedDict(sorted(props.items(), reverse=True))
+        mapper = compile_mapper(prop_dict) if prop_dict else None
+        path = field.split(".")
+        op = "$lt" if descending else "$gt"
+        while True:
+            if last is _NO_VALUE:
+                bound = {field: {"$ne": None}}
+            else:
+                bound = {field: {op: last}}
+            page_crit = {"$and": [crit, bound]} if crit else bound
+            records = list(self.collection.find(
+                filter=page_crit, projection=props, sort=[(field, direction)],
+                limit=page_size, batch_size=page_size))
+            if not records:
+                return
+            last = _walk(records[-1], path)
+            yield (_map_records(records, mapper, self.result_post),
+                   _encode_page_token(field, direction, last))
+            if len(records) < page_size:
+                return
+
     def query_one(self, *args, **kwargs):
         """Return first document from :meth:`query`, with same parameters.
         """
@@ -477,6 +636,27 @@ class QueryEngine(object):
         c = results[0]
         return Structure.from_dict(c[field])
 
+    def get_structures_from_ids(self, task_ids, final_structure=True):
+        """
+        Returns the structures of many tasks, fetched with one query.
+
+        Args:
+            task_ids:
+                The task_ids to query for.
+            final_structure:
+                Whether to obtain the final or initial structures. Defaults
+                to True.
+
+        Returns:
+            Generator of (task_id, Structure), in database order. Task ids
+            with no structure are left out.
+        """
+        key = 'output' if final_structure else 'input'
+        crit = self._parse_criteria({'task_id': {'$in': list(task_ids)}})
+        for r in self.collection.find(crit, ['task_id', key + '.crystal']):
+            if 'crystal' in r.get(key, {}):
+                yield r['task_id'], Structure.from_dict(r[key]['crystal'])
+
     def __repr__(self):
         return "QueryEngine: {}:{}/{}".format(self.host, self.port,
                                               self.database_name)
@@ -517,37 +697,350 @@ class QueryEngine(object):
     def get_dos_from_id(self, task_id):
         """
         Overrides the get_dos_from_id for the MIT gridfs format.
+
+        Reads both the binary format of :mod:`matgendb.dosio` and the
+        legacy (optionally zlib-compressed) JSON.
         """
-        args = {'task_id': task_id}
-        fields = ['calculations']
-        structure = self.get_structure_from_id(task_id)
-        dosid = None
-        for r in self.query(fields, args):
-            dosid = r['calculations'][-1]['dos_fs_id']
+        # Only fetch the DOS ids and the final structure, not the whole
+        # calculations.
+        r = self.collection.find_one(
+            self._parse_criteria({'task_id': task_id}),
+            ['calculations.dos_fs_id', 'output.crystal'])
+        dosid, structure = self._dos_source(r)
         if dosid is not None:
             self._fs = gridfs.GridFS(self.db, 'dos_fs')
             with self._fs.get(dosid) as dosfile:
-                s = dosfile.read()
-                try:
-                    d = json.loads(s)
-                except:
-                    s = zlib.decompress(s)
-                    d = json.loads(s.decode("utf-8"))
-                tdos = Dos.from_dict(d)
-                pdoss = {}
-                for i in range(len(d['pdos'])):
-                    ados = d['pdos'][i]
-                    all_ados = {}
-                    for j in range(len(ados)):
-                        orb = Orbital(j)
-                        odos = ados[str(orb)]
-                        all_ados[orb] = {Spin(int(k)): v
-                                         for k, v
-                                         in odos['densities'].items()}
-                    pdoss[structure[i]] = all_ados
-                return CompleteDos(structure, tdos, pdoss)
+                d = dosio.loads(dosfile.read())
+            return dosio.to_complete_dos(
+                d, structure=Structure.from_dict(structure))
         return None
 
+    @staticmethod
+    def _dos_source(r):
+        """(gridfs id of the DOS of the last calculation, final structure
+        dict) of a task record, or (None, None) if the task has no DOS, e.g.
+        a killed run without calculations or output.
+        """
+        calcs = (r or {}).get('calculations') or []
+        dosid = calcs[-1].get('dos_fs_id') if calcs else None
+        structure = (r or {}).get('output', {}).get('crystal')
+        if dosid is None or structure is None:
+            return None, None
+        return dosid, structure
+
+    def get_dos_from_ids(self, task_ids, nthreads=8):
+        """
+        Get the DOS of many tasks.
+
+        All the DOS ids are found with one query. The gridfs files are then
+        read and decoded concurrently by a pool of threads, and results are
+        yielded as soon as they are ready, so the order is not that of
+        task_ids.
+
+        Args:
+            task_ids:
+                The task_ids to query for.
+            nthreads:
+                Number of concurrent gridfs reads. Defaults to 8.
+
+        Returns:
+            Generator of (task_id, CompleteDos). The DOS is None for tasks
+            that have none; unknown task ids are left out.
+        """
+        crit = self._parse_criteria({'task_id': {'$in': list(task_ids)}})
+        items = [(r['task_id'],) + self._dos_source(r)
+                 for r in self.collection.find(
+                     crit, ['task_id', 'calculations.dos_fs_id',
+                            'output.crystal'])]
+        if not items:
+            return
+        self._fs = gridfs.GridFS(self.db, 'dos_fs')
+        pool = ThreadPool(min(nthreads, len(items)))
+        try:
+            for result in pool.imap_unordered(self._read_dos, items):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _read_dos(self, item):
+        """Read and decode one DOS for get_dos_from_ids()."""
+        task_id, dosid, structure = item
+        if dosid is None:
+            return task_id, None
+        with self._fs.get(dosid) as dosfile:
+            d = dosio.loads(dosfile.read())
+        return task_id, dosio.to_complete_dos(
+            d, structure=Structure.from_dict(structure))
+
+    def get_dos(self, task_id, energy_range=None, sites=None, elements=None,
+                orbitals=None, as_arrays=False):
+        """
+        Get part of the DOS of the last calculation of a task.
+
+        For DOS stored in the binary format (see :mod:`matgendb.dosio`),
+        only the requested energies, sites and orbitals are read from
+        gridfs, and only the needed arrays are decompressed. Legacy JSON DOS
+        are read in full and then cut down.
+
+        Args:
+            task_id:
+                The task_id to query for.
+            energy_range:
+                (min, max) energies in eV, absolute (not relative to the
+                Fermi level). Either may be None. Defaults to all energies.
+            sites:
+                Indices of the sites whose projected DOS are wanted. Defaults
+                to all sites, unless elements is given.
+            elements:
+                Element symbols; the projected DOS of the sites holding any of
+                them are wanted.
+            orbitals:
+                Orbitals of the projected DOS wanted, by name ("px") or by
+                type ("p"). Defaults to all.
+            as_arrays:
+                If True, return a dict of numpy arrays as from
+                :meth:`matgendb.dosio.DosReader.read_dict` instead of a
+                CompleteDos. Use sites=[] for the total DOS only.
+
+        Returns:
+            CompleteDos with only the requested projected DOS, or dict, or
+            None if the task has no DOS.
+        """
+        r = self.collection.find_one(
+            self._parse_criteria({'task_id': task_id}),
+            ['calculations.dos_fs_id', 'output.crystal'])
+        dosid, structure = self._dos_source(r)
+        if dosid is None:
+            return None
+        if elements is not None:
+            el_sites = dosio.sites_with_elements(structure, elements)
+            sites = el_sites if sites is None else \
+                sorted(set(sites).intersection(el_sites))
+        self._fs = gridfs.GridFS(self.db, 'dos_fs')
+        with self._fs.get(dosid) as dosfile:
+            if dosio.is_binary(dosfile.read(len(dosio.MAGIC))):
+                d = dosio.DosReader(dosfile).read_dict(
+                    energy_range=energy_range, sites=sites, orbitals=orbitals)
+            else:
+                dosfile.seek(0)
+                d = dosio.select(dosio.loads_legacy(dosfile.read()),
+                                 energy_range=energy_range, sites=sites,
+                                 orbitals=orbitals)
+        if as_arrays:
+            return d
+        return dosio.to_complete_dos(d, structure=Structure.from_dict(structure))
+
+    def get_payload(self, task_id, field, calc_index=-1):
+        """
+        Get a large output field of a calculation of a task, whether it is
+        in the task doc or was stored in gridfs (see the gridfs_payloads
+        option of VaspToDbTaskDrone).
+
+        Args:
+            task_id:
+                The task_id to query for.
+            field:
+                Name of the field of the calculation output, e.g.
+                "projected_eigenvalues".
+            calc_index:
+                Index of the calculation. Defaults to -1, the last one.
+
+        Returns:
+            The field, or None if there is no such field.
+        """
+        prefix = 'calculations.output.'
+        r = self.collection.find_one(
+            self._parse_criteria({'task_id': task_id}),
+            [prefix + field, prefix + field + '_fs_id'])
+        if r is None or not r.get('calculations'):
+            return None
+        output = r['calculations'][calc_index].get('output', {})
+        if field + '_fs_id' in output:
+            fs = gridfs.GridFS(self.db, blobs.PAYLOAD_FS)
+            return blobs.get_json(fs, output[field + '_fs_id'])
+        return output.get(field)
+
+
+def _walk(r, path):
+    """Value at `path` in record `r`, fanning out over lists: a list met
+    on the way is replaced by the list of the next key in each of its
+    items. Missing keys map to None.
+    """
+    try:
+        data = r[path[0]]
+        for key in path[1:]:
+            if isinstance(data, list):
+                data = [d[key] for d in data]
+            else:
+                data = data[key]
+        return data
+    except _MISSING:
+        return None
+
+
+# Paging key value before the first page of QueryEngine.iter_pages()
+_NO_VALUE = object()
+
+
+def _encode_page_token(field, direction, value):
+    """Resume token of QueryEngine.iter_pages(): the last value of the
+    paging key, as URL-safe base64 of its extended JSON.
+    """
+    doc = json_util.dumps({"key": field, "dir": direction, "after": value})
+    return base64.urlsafe_b64encode(doc.encode("utf-8")).decode("ascii")
+
+
+def _decode_page_token(token, field, direction):
+    """Last value of the paging key in a resume token.
+
+    :raises QueryError: If the token is invalid or not for this key and order
+    """
+    try:
+        doc = json_util.loads(base64.urlsafe_b64decode(
+            str(token)).decode("utf-8"))
+        key, dir_, value = doc["key"], doc["dir"], doc["after"]
+    except (binascii.Error, TypeError, ValueError, KeyError):
+        raise QueryError("Invalid resume token: {}".format(token))
+    if (key, dir_) != (field, direction):
+        raise QueryError("Resume token is for key {} in order {:d}, "
+                         "not {} in order {:d}".format(key, dir_, field,
+                                                       direction))
+    return value
+
+
+def compile_mapper(prop_dict, as_list=False):
+    """Compile a property map, as made by QueryEngine._parse_properties(),
+    into a function that maps a record to a dict of its properties.
+
+    The function is generated once per query, with each property read by
+    plain indexing, e.g. ``r['output']['final_energy']``. Only the properties
+    whose path goes through a list, which makes plain indexing raise a
+    TypeError, are read again with the fan-out walk of :func:`_walk`.
+
+    :param prop_dict: Map of property name to its keys in a record, e.g.
+        {"energy": ["output", "final_energy"]}
+    :type prop_dict: dict
+    :param as_list: Whether the function returns the list of the values, in
+        the order of `prop_dict`, instead of a dict
+    :type as_list: bool
+    :return: Function of a record returning a dict keyed by property name,
+        with None for the properties missing from the record
+    """
+    paths = []
+    if as_list:
+        lines = ["def map_record(r):",
+                 "    result = [None] * {:d}".format(len(prop_dict))]
+    else:
+        lines = ["def map_record(r):", "    result = {}"]
+    for i, (name, path) in enumerate(prop_dict.items()):
+        name = "{:d}".format(i) if as_list else repr(name)
+        lines += ["    try:",
+                  "        result[{}] = r{}".format(
+                      name, "".join("[{!r}]".format(k) for k in path))]
+        if not as_list:
+            lines += ["    except _MISSING:",
+                      "        result[{}] = None".format(name)]
+        else:
+            lines += ["    except _MISSING:",
+                      "        pass"]
+        if len(path) > 1:
+            lines += ["    except TypeError:",
+                      "        result[{}] = _walk(r, _paths[{:d}])".format(
+                          name, len(paths))]
+            paths.append(list(path))
+    lines.append("    return result")
+    namespace = {"_MISSING": _MISSING, "_walk": _walk, "_paths": paths}
+    exec("\n".join(lines), namespace)
+    return namespace["map_record"]
+
+
+def _map_records(records, mapper, postprocess):
+    """Apply the result_post functions to records, in place, then map them.
+
+    :param records: Records, as returned by the pymongo cursor
+    :type records: list of dict
+    :param mapper: Function made by compile_mapper(), or None to return
+        the records themselves
+    :param postprocess: result_post functions
+    :type postprocess: list
+    :rtype: list of dict
+    """
+    if postprocess:
+        for r in records:
+            for func in postprocess:
+                func(r)
+    if mapper is None:
+        return list(records)
+    return [mapper(r) for r in records]
+
+
+class _ColumnBuffer(object):
+    """Values of one property, in a NumPy array that grows geometrically,
+    with a mask of the missing values.
+    """
+    def __init__(self, name, dtype=None):
+        self.name = name
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.data = None  # allocated at the first value that is not None
+        self.mask = np.ones(0, dtype=bool)
+        self.n = 0
+
+    def _reserve(self, size):
+        capacity = len(self.mask)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity, 1024)
+        mask = np.ones(capacity, dtype=bool)
+        mask[:self.n] = self.mask[:self.n]
+        self.mask = mask
+        if self.data is not None:
+            data = np.zeros(capacity, dtype=self.data.dtype)
+            data[:self.n] = self.data[:self.n]
+            self.data = data
+
+    def extend(self, values):
+        """Append values, None for the missing ones."""
+        n, k = self.n, len(values)
+        self._reserve(n + k)
+        missing = [v is None for v in values]
+        if self.data is None:
+            first = next((v for v in values if v is not None), None)
+            if first is None:
+                self.n += k  # still all missing
+                return
+            self.data = np.zeros(len(self.mask),
+                                 dtype=self.dtype or _infer_dtype(first))
+        if any(missing):
+            fill = np.zeros(1, dtype=self.data.dtype)[0]
+            values = [fill if m else v for v, m in zip(values, missing)]
+        try:
+            self.data[n:n + k] = values
+        except (TypeError, ValueError) as err:
+            raise QueryError("Cannot store values of {} as {}: {}".format(
+                self.name, self.data.dtype, err))
+        self.mask[n:n + k] = missing
+        self.n += k
+
+    def get_array(self):
+        """The values so far, as a masked array."""
+        if self.data is None:
+            data = np.zeros(self.n, dtype=self.dtype or float)
+        else:
+            data = self.data[:self.n]
+        return np.ma.MaskedArray(data, mask=self.mask[:self.n])
+
+
+def _infer_dtype(value):
+    """Dtype of a column, from its first value: numbers are stored as
+    float64, so that a float after an int is not truncated.
+    """
+    if isinstance(value, (bool, np.bool_)):
+        return np.dtype(bool)
+    if isinstance(value, numbers.Real):
+        return np.dtype(float)
+    return np.dtype(object)
+
 
 class QueryResults(Iterable):
     """
@@ -558,17 +1051,24 @@ class QueryResults(Iterable):
     support nearly all cursor like attributes such as count(), explain(),
     hint(), etc. Please see pymongo cursor documentation for details.
     """
-    def __init__(self, prop_dict, result_cursor, postprocess=None):
+    def __init__(self, prop_dict, result_cursor, postprocess=None,
+                 raw=False):
         """Constructor.
 
         :param prop_dict: Properties
         :param result_cursor: Iterable returning records
         :param postprocess: List of functions, each taking a record and
             modifying it in-place, or None, or an empty list
+        :param raw: Whether the records are RawBSONDocuments, to be decoded
+            lazily (see :mod:`matgendb.lazydoc`)
         """
         self._results = result_cursor
         self._prop_dict = prop_dict
         self._pproc = postprocess or []  # make empty values iterable
+        self._raw = raw
+        self._mapper = None
+        if prop_dict and not raw:
+            self._mapper = compile_mapper(prop_dict)
 
 
     def _wrapper(self, func):
@@ -600,13 +1100,15 @@ class QueryResults(Iterable):
             return ret_val
 
     def clone(self):
-        return QueryResults(self._prop_dict, self._results.clone())
+        return QueryResults(self._prop_dict, self._results.clone(),
+                            raw=self._raw)
 
     def from_cursor(self, cursor):
         """
         Create a QueryResults object from a cursor object
         """
-        return QueryResults(self._prop_dict, cursor, self._pproc)
+        return QueryResults(self._prop_dict, cursor, self._pproc,
+                            raw=self._raw)
 
 
     def __len__(self):
@@ -623,40 +1125,120 @@ class QueryResults(Iterable):
     def _mapped_result(self, r):
         """Transform/map a result.
         """
+        if self._raw:
+            return self._lazy_result(r)
         # Apply result_post funcs for pulling out sandbox properties
         for func in self._pproc:
             func(r)
         # If we haven't asked for specific properties, just return object
+        if self._mapper is None:
+            return r
+        # Map aliased keys back to original key
+        return self._mapper(r)
+
+    def map_batch(self, records):
+        """Transform/map a list of raw records at once, as iterating over
+        the results does for each record.
+
+        :param records: Records, as returned by the pymongo cursor
+        :type records: list of dict
+        :return: Mapped records
+        :rtype: list of dict
+        """
+        if self._raw:
+            return [self._lazy_result(r) for r in records]
+        return _map_records(records, self._mapper, self._pproc)
+
+    def _lazy_result(self, r):
+        record = LazyRecord(r)
+        for func in self._pproc:
+            func(record)
         if not self._prop_dict:
-            result = r
-        else:
-            result = dict()
-            # Map aliased keys back to original key
-            for k, v in self._prop_dict.items():
-                try:
-                    data = r[v[0]]
-                    for j in range(1, len(v)):
-                        if isinstance(data, list):
-                            data = [d[v[j]] for d in data]
-                        else:
-                            data = data[v[j]]
-                    result[k] = data
-                except (IndexError, KeyError, ValueError):
-                    result[k] = None
+            return record
+        return LazyResult(record, self._prop_dict)
 
+    def batches(self, batch_size=1000):
+        """Generate the results in lists of `batch_size`, each mapped at
+        once with :meth:`map_batch`.
 
-        return result
+        :param batch_size: Number of results per list
+        :type batch_size: int
+        :rtype: generator of list of dict
+        """
+        it = iter(self._results)
+        while True:
+            records = list(itertools.islice(it, batch_size))
+            if not records:
+                return
+            yield self.map_batch(records)
+
+    def prefetch(self, batch_size=1000, depth=2):
+        """Iterate over the results while a background thread fetches and
+        maps the next batches, so that the round trips to the server overlap
+        with the processing of the current batch::
+
+            for r in qe.query(props, crit).prefetch(batch_size=500):
+                analyze(r)
+
+        :param batch_size: Number of records per batch, also used as the
+            batch size of the cursor
+        :type batch_size: int
+        :param depth: Max. number of batches fetched ahead
+        :type depth: int
+        :return: Results, in order
+        :rtype: generator of dict
+        """
+        if isinstance(self._results, pymongo.cursor.Cursor):
+            self._results.batch_size(batch_size)
+        buf = Queue.Queue(maxsize=max(depth, 1))
+        stop = threading.Event()
+
+        def put(item):
+            # Give up when the consumer is gone
+            while not stop.is_set():
+                try:
+                    buf.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def fetch():
+            try:
+                for batch in self.batches(batch_size):
+                    if not put((batch, None)):
+                        return
+                put((None, None))
+            except Exception:
+                put((None, sys.exc_info()))
+
+        thread = threading.Thread(target=fetch, name="prefetch")
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                batch, exc_info = buf.get()
+                if exc_info is not None:
+                    six.reraise(*exc_info)
+                if batch is None:
+                    return
+                for r in batch:
+                    yield r
+        finally:
+            stop.set()
+            thread.join()
 
     def _result_generator(self):
+        mapped = self._mapped_result
         for r in self._results:
-            yield self._mapped_result(r)
+            yield mapped(r)
 
 
 class QueryListResults(QueryResults):
     """Set of QueryResults on a list instead of a MongoDB cursor.
     """
     def clone(self):
-        return QueryResults(self._prop_dict, self._results[:])
+        return QueryResults(self._prop_dict, self._results[:], raw=self._raw)
 
     def __len__(self):
         """Return length of iterable, as a list if possible; otherwise,
@@ -0,0 +1,231 @@
+"""
+Local phase stability of task docs.
+
+With a Materials API key, the drone asks the Materials Project for the
+stability of every successful run it inserts, one round trip per doc.
+:class:`StabilityService` computes the same "e_above_hull" and
+"decomposes_to" locally, against a reference set of entries read from a
+file or from a collection of task docs. Reference entries are loaded once
+per chemical system, each convex hull is built once and reused, and a batch
+of entries is evaluated system by system::
+
+    compat = get_compatibility("MaterialsProjectCompatibility")
+    service = StabilityService.from_file("refs.json", compatibility=compat)
+    for data in service.get_stability([entry_from_doc(d) for d in docs]):
+        ...
+
+As with the Materials API, the energies must be corrected with a
+compatibility scheme for hulls that mix GGA and GGA+U runs.
+"""
+
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+
+from monty.serialization import loadfn
+from pymatgen.analysis.phase_diagram import PhaseDiagram, \
+    PhaseDiagramError
+from pymatgen.core.composition import Composition
+from pymatgen.core.periodic_table import Element
+from pymatgen.entries import compatibility as pmg_compatibility
+from pymatgen.entries.computed_entries import ComputedEntry
+
+_log = logging.getLogger("mg.stability")
+
+
+def get_chemsys(elements):
+    """Chemical system of a sequence of element symbols, e.g. "Fe-Li-O".
+    """
+    return "-".join(sorted(set(elements)))
+
+
+def get_subsystems(chemsys):
+    """All the chemical systems spanned by a chemical system, itself
+    included, e.g. Fe, Li, Fe-Li for Fe-Li.
+    """
+    elements = chemsys.split("-")
+    return [get_chemsys(combi) for n in range(1, len(elements) + 1)
+            for combi in itertools.combinations(elements, n)]
+
+
+def _entry_chemsys(entry):
+    return get_chemsys(el.symbol for el in entry.composition.elements)
+
+
+def entry_from_doc(d):
+    """ComputedEntry of a task doc, as used for stability.
+
+    :param d: Task doc
+    :type d: dict
+    :rtype: ComputedEntry
+    """
+    functional = d["pseudo_potential"]["functional"]
+    syms = ["{} {}".format(functional, l)
+            for l in d["pseudo_potential"]["labels"]]
+    return ComputedEntry(Composition(d["unit_cell_formula"]),
+                         d["output"]["final_energy"],
+                         parameters={"run_type": d.get("run_type"),
+                                     "is_hubbard": d.get("is_hubbard"),
+                                     "hubbards": d["hubbards"],
+                                     "potcar_symbols": syms},
+                         entry_id=d.get("task_id"))
+
+
+def get_compatibility(name):
+    """Compatibility scheme of :mod:`pymatgen.entries.compatibility`, by
+    class name.
+
+    :param name: Class name, e.g. "MaterialsProjectCompatibility", or None
+        or "none" for no scheme
+    :type name: str
+    :return: Instance of the scheme, or None
+    :raises ValueError: If there is no such scheme
+    """
+    if name is None or name.lower() == "none":
+        return None
+    cls = getattr(pmg_compatibility, name, None)
+    if not isinstance(cls, type) or \
+            not issubclass(cls, pmg_compatibility.Compatibility):
+        raise ValueError("Unknown compatibility scheme: {}".format(name))
+    return cls()
+
+
+class StabilityService(object):
+    """Energy above hull and decomposition of entries, against a local
+    reference set.
+    """
+    def __init__(self, entries=None, qe=None, compatibility=None,
+                 max_systems=256):
+        """Constructor. Give the reference entries, or a QueryEngine to get
+        them from, system by system, as they are needed.
+
+        :param entries: Reference entries
+        :type entries: list of ComputedEntry
+        :param qe: QueryEngine on a collection of reference task docs
+        :type qe: QueryEngine
+        :param compatibility: If given, its process_entry() is applied to
+            the reference entries and to the entries evaluated, e.g. a
+            MaterialsProjectCompatibility
+        :param max_systems: Number of convex hulls kept
+        :type max_systems: int
+        """
+        self._qe = qe
+        self._compat = compatibility
+        self.max_systems = max_systems
+        # chemsys -> list of reference entries with exactly those elements
+        self._refs = {}
+        self._complete = entries is not None
+        for entry in filter(None, self._process(entries or [])):
+            self._refs.setdefault(_entry_chemsys(entry), []).append(entry)
+        self._diagrams = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, filename, **kwargs):
+        """Service with the reference entries in a JSON (or YAML, MessagePack)
+        file, e.g. one written with monty.serialization.dumpfn().
+        """
+        return cls(entries=loadfn(filename), **kwargs)
+
+    def _process(self, entries):
+        # Entries rejected by the compatibility scheme become None
+        if self._compat is None:
+            return list(entries)
+        return [self._compat.process_entry(e) for e in entries]
+
+    def _load(self, systems):
+        """Fetch the reference entries of systems not seen yet."""
+        missing = [s for s in systems if s not in self._refs]
+        if self._complete or not missing:
+            return
+        entries = self._qe.get_entries({"chemsys": {"$in": missing}})
+        for chemsys in missing:
+            self._refs[chemsys] = []
+        for entry in filter(None, self._process(entries)):
+            self._refs[_entry_chemsys(entry)].append(entry)
+        _log.debug("Loaded {:d} reference entries for {}".format(
+            len(entries), missing))
+
+    def get_phase_diagram(self, chemsys):
+        """Phase diagram of the reference entries of a chemical system, or
+        None if the references lack an element of the system.
+
+        :param chemsys: Chemical system, e.g. "Fe-Li-O"
+        :type chemsys: str
+        :rtype: PhaseDiagram
+        """
+        with self._lock:
+            if chemsys in self._diagrams:
+                self._diagrams[chemsys] = self._diagrams.pop(chemsys)
+                return self._diagrams[chemsys]
+            systems = get_subsystems(chemsys)
+            self._load(systems)
+            entries = [e for s in systems for e in self._refs.get(s, [])]
+            try:
+                pd = PhaseDiagram(entries, elements=[
+                    Element(el) for el in chemsys.split("-")])
+            except (PhaseDiagramError, ValueError) as err:
+                _log.warning("No phase diagram for {}: {}".format(chemsys,
+                                                                  err))
+                pd = None
+            self._diagrams[chemsys] = pd
+            while len(self._diagrams) > self.max_systems:
+                self._diagrams.popitem(last=False)
+            return pd
+
+    def get_stability(self, entries):
+        """Stability of entries, as returned by MPRester.get_stability().
+
+        The entries are grouped by chemical system, so that each convex
+        hull is looked up once per batch.
+
+        :param entries: Entries to evaluate
+        :type entries: list of ComputedEntry
+        :return: For each entry, in order, a dict with "e_above_hull" (eV
+            per atom, negative below the hull) and "decomposes_to" (list of
+            dicts with "entry_id", "formula" and "amount"), or None if there
+            is no phase diagram for its chemical system or the compatibility
+            scheme rejects the entry
+        :rtype: list
+        """
+        processed = self._process(entries)
+        results = [None] * len(entries)
+        by_system = OrderedDict()
+        for i, entry in enumerate(processed):
+            if entry is None:
+                continue
+            by_system.setdefault(_entry_chemsys(entry), []).append(i)
+        for chemsys, indices in by_system.items():
+            pd = self.get_phase_diagram(chemsys)
+            if pd is None:
+                continue
+            for i in indices:
+                decomp, e_above_hull = pd.get_decomp_and_e_above_hull(
+                    processed[i], allow_negative=True)
+                results[i] = {
+                    "e_above_hull": e_above_hull,
+                    "decomposes_to": [
+                        {"entry_id": e.entry_id,
+                         "formula": e.composition.reduced_formula,
+                         "amount": amount}
+                        for e, amount in decomp.items()]}
+        return results
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_stability_service(key, factory):
+    """Get the StabilityService of this process for a reference set, made
+    with `factory()` the first time.
+
+    :param key: Hashable identifying the reference set
+    :param factory: Function returning a new StabilityService
+    :rtype: StabilityService
+    """
+    with _services_lock:
+        if key not in _services:
+            _services[key] = factory()
+        return _services[key]
@@ -0,0 +1,124 @@
+"""
+Tests for matgendb.analysis
+"""
+import unittest
+
+import numpy as np
+
+from matgendb import analysis
+from matgendb.analysis import StructureCache, AnalysisContext, StageTimer, \
+    structure_key
+
+
+class FakeLattice(object):
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+
+class FakeStructure(object):
+    """Just enough of a Structure for structure_key()."""
+    def __init__(self, a=3.0, species=("Li", "O"), magmom=None):
+        self.lattice = FakeLattice(np.eye(3) * a)
+        self.frac_coords = np.array([[0, 0, 0], [0.5, 0.5, 0.5]])
+        self.species = list(species)
+        self.site_properties = {} if magmom is None else {"magmom": magmom}
+
+
+class StructureKeyTestCase(unittest.TestCase):
+    def test_key(self):
+        self.assertEqual(structure_key(FakeStructure()),
+                         structure_key(FakeStructure()))
+        self.assertEqual(structure_key(FakeStructure(a=3.0)),
+                         structure_key(FakeStructure(a=3.0 + 1e-9)))
+        self.assertNotEqual(structure_key(FakeStructure(a=3.0)),
+                            structure_key(FakeStructure(a=3.1)))
+        self.assertNotEqual(structure_key(FakeStructure()),
+                            structure_key(FakeStructure(species=("Na", "O"))))
+        self.assertNotEqual(structure_key(FakeStructure()),
+                            structure_key(FakeStructure(magmom=[1, 0])))
+
+
+class StructureCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return {"n": self.calls}
+
+    def test_get(self):
+        cache = StructureCache()
+        self.assertEqual(cache.get("k", "a", self.compute), {"n": 1})
+        value = cache.get("k", "a", self.compute)
+        self.assertEqual(value, {"n": 1})
+        self.assertEqual(self.calls, 1)
+        # results are copies
+        value["n"] = 42
+        self.assertEqual(cache.get("k", "a", self.compute), {"n": 1})
+        cache.get("k", "b", self.compute)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_lru(self):
+        cache = StructureCache(maxsize=2)
+        cache.get("k1", "a", self.compute)
+        cache.get("k2", "a", self.compute)
+        cache.get("k1", "a", self.compute)  # k2 is now least recently used
+        cache.get("k3", "a", self.compute)
+        self.assertEqual(len(cache), 2)
+        cache.get("k1", "a", self.compute)
+        self.assertEqual(self.calls, 3)
+        cache.get("k2", "a", self.compute)
+        self.assertEqual(self.calls, 4)
+
+    def test_disabled(self):
+        cache = StructureCache(maxsize=0)
+        cache.get("k", "a", self.compute)
+        cache.get("k", "a", self.compute)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(len(cache), 0)
+
+
+class StageTestCase(unittest.TestCase):
+    def test_registry(self):
+        names = analysis.get_stage_names()
+        for name in ("cif", "spacegroup", "bond_valence",
+                     "coordination_numbers", "outcar", "run_stats"):
+            self.assertIn(name, names)
+        analysis.check_stage_names(["cif", "outcar"])
+        self.assertRaises(ValueError, analysis.check_stage_names, ["foo"])
+
+    def test_register(self):
+        stage = analysis.register_stage("test_extra", "Extra",
+                                        func=lambda dir_name, d: None)
+        try:
+            self.assertIn(stage, analysis.get_stages())
+            analysis.check_stage_names(["test_extra"])
+        finally:
+            del analysis._stages["test_extra"]
+
+    def test_timer(self):
+        timings = {"cif": 1.0}
+        timer = StageTimer(skip=["bond_valence"], timings=timings)
+        self.assertTrue(timer.enabled("cif"))
+        self.assertFalse(timer.enabled("bond_valence"))
+        self.assertEqual(timer.run("cif", lambda x: x + 1, 1), 2)
+        self.assertTrue(timings["cif"] >= 1.0)
+        self.assertIsNone(timer.run("bond_valence", lambda: 1))
+        self.assertNotIn("bond_valence", timings)
+        self.assertRaises(ZeroDivisionError, timer.run, "spacegroup",
+                          lambda: 1 / 0)
+        self.assertIn("spacegroup", timings)
+
+
+class AnalysisContextTestCase(unittest.TestCase):
+    def test_key(self):
+        ctx = AnalysisContext(FakeStructure(), cache=StructureCache())
+        key = ctx.key
+        self.assertEqual(key, structure_key(FakeStructure()))
+        ctx.structure = FakeStructure(a=4.0)
+        self.assertNotEqual(ctx.key, key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+"""
+Tests for matgendb.archive
+
+These tests use `mongomock` instead of a real MongoDB server.
+"""
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+import mongomock
+
+from matgendb import dbclient, discovery
+from matgendb.archive import ArchiveRun, iter_archive_runs, split_location
+from matgendb.creator import VaspToDbTaskDrone
+
+DATABASE = "archive_unittest"
+
+FILES = ["top/Li2O/vasprun.xml.gz", "top/Li2O/OUTCAR", "top/Li2O/CHGCAR",
+         "top/Fe/relax1/vasprun.xml", "top/Fe/relax2/vasprun.xml",
+         "top/Fe/INCAR", "top/Fe/relax2/WAVECAR",
+         "top/inputs/INCAR",
+         "top/Fe/relax1/nested/vasprun.xml"]
+
+
+class ArchiveFixture(object):
+    """A tree of runs, and archives of it."""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.tree = os.path.join(self.dir, "tree")
+        for name in FILES:
+            path = os.path.join(self.tree, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as f:
+                f.write(name)
+            os.utime(path, (1000000000, 1000000000))
+        self.scratch = os.path.join(self.dir, "scratch")
+        os.mkdir(self.scratch)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_tar(self, name="runs.tar.gz"):
+        path = os.path.join(self.dir, name)
+        with tarfile.open(path, "w:gz") as tf:
+            tf.add(os.path.join(self.tree, "top"), arcname="top")
+        return path
+
+    def make_zip(self, name="runs.zip"):
+        path = os.path.join(self.dir, name)
+        with zipfile.ZipFile(path, "w") as zf:
+            for root, dirs, files in os.walk(self.tree):
+                dirs.sort()
+                for f in sorted(files):
+                    full = os.path.join(root, f)
+                    zf.write(full, os.path.relpath(full, self.tree))
+        return path
+
+    def runs(self, archive):
+        return {r.inner: r for r in iter_archive_runs(archive,
+                                                      scratch=self.scratch)}
+
+
+class ArchiveTestCase(ArchiveFixture, unittest.TestCase):
+    def check_runs(self, runs, archive):
+        self.assertEqual(sorted(runs), ["top/Fe", "top/Fe/relax1/nested",
+                                        "top/Li2O"])
+        li2o = runs["top/Li2O"]
+        self.assertEqual(li2o.schema, discovery.SCHEMA_STANDARD)
+        self.assertEqual(sorted(li2o.files), ["OUTCAR", "vasprun.xml.gz"])
+        self.assertEqual(li2o.location, archive + "!/top/Li2O")
+        with open(os.path.join(li2o.path, "OUTCAR")) as f:
+            self.assertEqual(f.read(), "top/Li2O/OUTCAR")
+        self.assertAlmostEqual(
+            os.path.getmtime(os.path.join(li2o.path, "OUTCAR")),
+            1000000000, delta=1)
+        fe = runs["top/Fe"]
+        self.assertEqual(fe.schema, discovery.SCHEMA_SUBFOLDER)
+        self.assertEqual(list(fe.vasprun_files), ["relax1", "relax2"])
+        self.assertEqual(sorted(fe.all_files()),
+                         ["INCAR", os.path.join("relax1", "vasprun.xml"),
+                          os.path.join("relax2", "vasprun.xml")])
+        for run in runs.values():
+            run.cleanup()
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_tar(self):
+        archive = self.make_tar()
+        self.check_runs(self.runs(archive), archive)
+
+    def test_zip(self):
+        archive = self.make_zip()
+        self.check_runs(self.runs(archive), archive)
+
+    def test_stop_early(self):
+        it = iter_archive_runs(self.make_tar(), scratch=self.scratch)
+        next(it).cleanup()
+        it.close()
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_find_runs(self):
+        archive = self.make_tar()
+        runs = list(discovery.find_runs(archive))
+        self.assertEqual(len(runs), 3)
+        self.assertTrue(all(isinstance(r, ArchiveRun) for r in runs))
+        for run in runs:
+            run.cleanup()
+        # archives in a tree are only searched on request
+        paths = [r.path for r in discovery.find_runs(self.dir)]
+        self.assertEqual(len(paths), 3)
+        runs = list(discovery.find_runs(self.dir, archives=True))
+        self.assertEqual(len(runs), 6)
+        self.assertEqual(sum(isinstance(r, ArchiveRun) for r in runs), 3)
+        for run in runs:
+            if isinstance(run, ArchiveRun):
+                run.cleanup()
+
+    def test_split_location(self):
+        self.assertEqual(split_location("/a/runs.tgz!/top/Fe"),
+                         ("/a/runs.tgz", "top/Fe"))
+        self.assertEqual(split_location("/a/b!/c"), ("/a/b!/c", None))
+
+
+class DroneArchiveTestCase(ArchiveFixture, unittest.TestCase):
+    def setUp(self):
+        ArchiveFixture.setUp(self)
+        dbclient.set_client_class(mongomock.MongoClient)
+
+    def fake_task_doc(self, path, run_dir=None):
+        self.parsed.append(sorted(run_dir.all_files()))
+        return {"dir_name": os.path.abspath(path), "state": "failed",
+                "calculations": [{"dir_name": os.path.abspath(path)}]}
+
+    def test_process_path(self):
+        archive = self.make_tar()
+        drone = VaspToDbTaskDrone(database=DATABASE, fingerprint="stat",
+                                  update_duplicates=True)
+        drone.get_task_doc = self.fake_task_doc
+        self.parsed = []
+        run = self.runs(archive)["top/Li2O"]
+        d = drone.process_path(run.path, run_dir=run)
+        self.assertEqual(self.parsed, [["OUTCAR", "vasprun.xml.gz"]])
+        self.assertFalse(os.path.exists(run.path))
+        self.assertTrue(d["dir_name"].endswith(archive + "!/top/Li2O"))
+        self.assertEqual(d["calculations"][0]["dir_name"],
+                         archive + "!/top/Li2O")
+        self.assertEqual(d["dir_name"],
+                         drone.get_dir_name(run.path, run_dir=run))
+        drone.insert_docs([d])
+        # Same archive again: the run is recognized and skipped
+        run = self.runs(archive)["top/Li2O"]
+        self.assertIsNone(drone.process_path(run.path, run_dir=run))
+        self.assertEqual(len(self.parsed), 1)
+        self.assertFalse(os.path.exists(run.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
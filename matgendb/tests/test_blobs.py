@@ -0,0 +1,140 @@
+"""
+Tests for matgendb.blobs
+"""
+import io
+import json
+import unittest
+
+import mongomock
+import numpy as np
+from monty.json import MontyEncoder
+
+from matgendb import blobs, query_engine
+from matgendb.query_engine import QueryEngine
+
+
+class FakeGridIn(io.BytesIO):
+    def __init__(self, fs, **kwargs):
+        io.BytesIO.__init__(self)
+        self.fs, self.kwargs, self.writes = fs, kwargs, 0
+        self._id = len(fs.files) + 1
+
+    def write(self, data):
+        assert isinstance(data, bytes)
+        self.writes += 1
+        return io.BytesIO.write(self, data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.fs.files[self._id] = (self.getvalue(), self.kwargs)
+        self.fs.last = self
+
+
+class FakeGridOut(io.BytesIO):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FakeGridFS(object):
+    """In-memory stand-in for gridfs.GridFS, which does not accept
+    mongomock databases."""
+    files = {}
+
+    def __init__(self, db=None, collection="fs"):
+        pass
+
+    def new_file(self, **kwargs):
+        return FakeGridIn(self, **kwargs)
+
+    def get(self, file_id):
+        return FakeGridOut(self.files[file_id][0])
+
+
+def make_calc():
+    steps = [{"e_wo_entrp": -1.0 * i, "forces": [[0.1 * i] * 3] * 4}
+             for i in range(200)]
+    return {"output": {"ionic_steps": steps, "final_energy": -199.0,
+                       "projected_eigenvalues": {"1": [[0.5] * 8] * 30}}}
+
+
+class BlobsTestCase(unittest.TestCase):
+    def setUp(self):
+        FakeGridFS.files = {}
+        self.fs = FakeGridFS()
+
+    def test_put_get(self):
+        calc = make_calc()
+        for level in 0, 1:
+            file_id = blobs.put_json(self.fs, calc, compress=level)
+            self.assertEqual(blobs.get_json(self.fs, file_id), calc)
+        self.assertEqual(self.fs.files[file_id][1], {"compression": "zlib"})
+
+    def test_streaming(self):
+        write_buffer = blobs.WRITE_BUFFER
+        blobs.WRITE_BUFFER = 1000
+        try:
+            calc = make_calc()
+            file_id = blobs.put_json(self.fs, calc)
+            self.assertTrue(self.fs.last.writes > 10)
+            self.assertEqual(blobs.get_json(self.fs, file_id), calc)
+        finally:
+            blobs.WRITE_BUFFER = write_buffer
+
+    def test_iter_json(self):
+        calc = make_calc()
+        calc["output"]["dos"] = {"energies": np.linspace(-5, 5, 400),
+                                 "densities": {"1": [0.25] * 400}}
+        for encoder in (MontyEncoder(),
+                        MontyEncoder(sort_keys=True, separators=(",", ":"))):
+            pieces = list(blobs.iter_json(calc, encoder, size=500))
+            self.assertEqual("".join(pieces), encoder.encode(calc))
+            self.assertTrue(len(pieces) > 10)
+            self.assertTrue(max(len(p) for p in pieces) < 1000)
+        self.assertEqual(list(blobs.iter_json([])), ["[]"])
+        self.assertEqual(json.loads("".join(blobs.iter_json(calc))),
+                         json.loads(json.dumps(calc, cls=MontyEncoder)))
+
+    def test_offload(self):
+        calc = make_calc()
+        moved = blobs.offload(self.fs, calc, ["ionic_steps", "eigenvalues"],
+                              compress=1)
+        self.assertEqual(moved, ["ionic_steps"])
+        self.assertEqual(sorted(calc["output"]),
+                         ["final_energy", "ionic_steps_fs_id",
+                          "projected_eigenvalues"])
+        blobs.restore(self.fs, calc)
+        self.assertEqual(calc, make_calc())
+
+
+class QueryEnginePayloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self._gridfs = query_engine.gridfs.GridFS
+        query_engine.gridfs.GridFS = FakeGridFS
+        FakeGridFS.files = {}
+        conn = mongomock.MongoClient()
+        self.qe = QueryEngine(connection=conn, database="blobs_unittest")
+        calc = make_calc()
+        blobs.offload(FakeGridFS(), calc, ["projected_eigenvalues"])
+        self.qe.collection.insert_one({"task_id": 1, "state": "successful",
+                                       "calculations": [make_calc(), calc]})
+
+    def tearDown(self):
+        query_engine.gridfs.GridFS = self._gridfs
+
+    def test_get_payload(self):
+        expected = make_calc()["output"]
+        self.assertEqual(self.qe.get_payload(1, "projected_eigenvalues"),
+                         expected["projected_eigenvalues"])
+        self.assertEqual(self.qe.get_payload(1, "ionic_steps", calc_index=0),
+                         expected["ionic_steps"])
+        self.assertIsNone(self.qe.get_payload(1, "eigenvalues"))
+        self.assertIsNone(self.qe.get_payload(2, "eigenvalues"))
+
+
+if __name__ == '__main__':
+    unittest.main()
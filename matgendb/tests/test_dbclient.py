@@ -0,0 +1,55 @@
+"""
+Tests for matgendb.dbclient
+
+These tests use `mongomock` instead of a real MongoDB server.
+"""
+import unittest
+
+import mongomock
+
+from matgendb import dbclient
+
+
+class ClientRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reg = dbclient.ClientRegistry(client_class=mongomock.MongoClient)
+
+    def test_shared(self):
+        c1 = self.reg.get_client("localhost", 27017)
+        c2 = self.reg.get_client("localhost", 27017)
+        self.assertIs(c1, c2)
+        self.assertEqual(len(self.reg), 1)
+        self.assertEqual(self.reg.stats.clients_created, 1)
+        self.assertEqual(self.reg.stats.clients_reused, 1)
+
+    def test_keyed(self):
+        c1 = self.reg.get_client("localhost", 27017)
+        c2 = self.reg.get_client("localhost", 27018)
+        c3 = self.reg.get_client("localhost", 27017, user="u", password="p")
+        c4 = self.reg.get_client("localhost", 27017, replicaset="rs0")
+        self.assertEqual(len(set(map(id, (c1, c2, c3, c4)))), 4)
+        self.assertEqual(self.reg.stats.clients_created, 4)
+
+    def test_fork(self):
+        c1 = self.reg.get_client("localhost", 27017)
+        self.reg._pid = -1  # pretend we are in a forked child
+        c2 = self.reg.get_client("localhost", 27017)
+        self.assertIsNot(c1, c2)
+        self.assertEqual(self.reg.stats.forks, 1)
+        self.assertIs(c2, self.reg.get_client("localhost", 27017))
+
+    def test_clear(self):
+        self.reg.get_client("localhost", 27017)
+        self.reg.clear(close=False)
+        self.assertEqual(len(self.reg), 0)
+
+    def test_stats(self):
+        self.reg.get_client("localhost", 27017)
+        d = self.reg.stats.as_dict()
+        for key in ("clients_created", "clients_reused", "client_wait_sec",
+                    "pool_size", "checkout_wait_sec"):
+            self.assertIn(key, d)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Tests for matgendb.discovery
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from matgendb import discovery
+
+test_dir = os.path.join(os.path.dirname(__file__), "..", "..",
+                        'test_files')
+
+
+class RunFinderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def touch(self, *names):
+        for name in names:
+            path = os.path.join(self.dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "w").close()
+
+    def find(self, root=None, **kw):
+        runs = discovery.find_runs(root or self.dir, **kw)
+        return {os.path.relpath(r.path, root or self.dir): r for r in runs}
+
+    def test_db_test(self):
+        runs = self.find(os.path.join(test_dir, "db_test"), nthreads=3)
+        self.assertEqual(len(runs), 6)
+        self.assertEqual(runs["success_mp_aflow"].schema,
+                         discovery.SCHEMA_SUBFOLDER)
+        self.assertEqual(list(runs["success_mp_aflow"].vasprun_files),
+                         ["relax1", "relax2"])
+        self.assertEqual(runs["Li2O_aflow"].schema,
+                         discovery.SCHEMA_EXTENSION)
+        self.assertEqual(runs["Li2O"].schema, discovery.SCHEMA_STANDARD)
+        self.assertIn("STOPCAR", runs["stopped_mp_aflow"].files)
+
+    def test_schemas(self):
+        self.touch("a/vasprun.xml.gz",
+                   "b/relax1/vasprun.xml", "b/relax2/OUTCAR",
+                   "c/relax1/INCAR", "c/INCAR", "c/POSCAR", "c/POTCAR",
+                   "c/KPOINTS.orig",
+                   "d/vasprun.xml.relax1", "d/vasprun.xml.relax2",
+                   "e/INCAR",
+                   "f/relax1/nested/vasprun.xml")
+        runs = self.find()
+        self.assertEqual(sorted(runs),
+                         ["a", "b", "c", "d", "f", os.path.join(
+                             "f", "relax1", "nested")])
+        self.assertEqual(runs["a"].schema, discovery.SCHEMA_STANDARD)
+        self.assertEqual(runs["b"].vasprun_files,
+                         {"relax1": os.path.join("relax1", "vasprun.xml")})
+        self.assertEqual(runs["c"].schema, discovery.SCHEMA_KILLED)
+        self.assertTrue(runs["c"].has_vasp_input)
+        self.assertEqual(runs["d"].schema, discovery.SCHEMA_EXTENSION)
+        self.assertEqual(sorted(runs["b"].all_files()),
+                         [os.path.join("relax1", "vasprun.xml"),
+                          os.path.join("relax2", "OUTCAR")])
+
+    def test_unreadable(self):
+        runs = self.find(os.path.join(self.dir, "missing"))
+        self.assertEqual(runs, {})
+
+    def test_scan_error(self):
+        self.touch("a/vasprun.xml", "b/c/vasprun.xml")
+        list_dir = discovery._list_dir
+
+        def bad_list_dir(path):
+            if os.path.basename(path) == "b":
+                raise UnicodeDecodeError("ascii", b"\xe9", 0, 1, "bad name")
+            return list_dir(path)
+
+        discovery._list_dir = bad_list_dir
+        try:
+            runs = self.find(nthreads=2)
+        finally:
+            discovery._list_dir = list_dir
+        self.assertEqual(sorted(runs), ["a"])
+
+    def test_ndirs(self):
+        self.touch("a/b/c/vasprun.xml", "a/relax1/vasprun.xml")
+        finder = discovery.RunFinder(nthreads=2)
+        runs = list(finder.find(self.dir))
+        self.assertEqual(len(runs), 2)
+        self.assertEqual(finder.ndirs, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+"""
+Tests for matgendb.dosio
+"""
+import io
+import json
+import unittest
+import zlib
+
+import mongomock
+import numpy as np
+
+from matgendb import dosio, query_engine
+from matgendb.query_engine import QueryEngine
+
+NEDOS = 50
+
+
+def make_dos(spins=("1", "-1"), nsites=2):
+    """DOS dict in the form of CompleteDos.as_dict()."""
+    rng = np.random.RandomState(42)
+    energies = np.linspace(-10, 10, NEDOS)
+    pdos = []
+    for i in range(nsites):
+        pdos.append({orb: {"densities": {s: list(rng.rand(NEDOS))
+                                         for s in spins}}
+                     for orb in ("s", "py", "pz", "px")})
+    return {"@module": "pymatgen.electronic_structure.dos",
+            "@class": "CompleteDos", "efermi": 1.5,
+            "structure": {"sites": [{"species": [{"element": el}]}
+                                    for el in ("Li", "O") * nsites][:nsites]},
+            "energies": list(energies),
+            "densities": {s: list(rng.rand(NEDOS)) for s in spins},
+            "pdos": pdos,
+            "atom_dos": {}, "spd_dos": {}}
+
+
+class DosIOTestCase(unittest.TestCase):
+    def check(self, d, r, rtol=1e-12):
+        self.assertEqual(r["efermi"], d["efermi"])
+        self.assertEqual(r["structure"], d["structure"])
+        np.testing.assert_allclose(r["energies"], d["energies"], rtol=rtol)
+        for s, dens in d["densities"].items():
+            np.testing.assert_allclose(r["densities"][int(s)], dens, rtol=rtol)
+        self.assertEqual(len(r["pdos"]), len(d["pdos"]))
+        for site, rsite in zip(d["pdos"], r["pdos"]):
+            self.assertEqual(sorted(site), sorted(rsite))
+            for orb, odos in site.items():
+                for s, dens in odos["densities"].items():
+                    np.testing.assert_allclose(rsite[orb][int(s)], dens,
+                                               rtol=rtol)
+
+    def test_roundtrip(self):
+        d = make_dos()
+        data = dosio.dumps(d)
+        self.assertTrue(dosio.is_binary(data))
+        self.check(d, dosio.loads(data))
+        # smaller than the JSON
+        self.assertTrue(len(data) < len(json.dumps(d)))
+
+    def test_spin_unpolarized(self):
+        d = make_dos(spins=("1",))
+        self.check(d, dosio.loads(dosio.dumps(d)))
+
+    def test_no_pdos(self):
+        d = make_dos(nsites=0)
+        self.check(d, dosio.loads(dosio.dumps(d)))
+
+    def test_compressed(self):
+        d = make_dos()
+        data = dosio.dumps(d, compress=1)
+        reader = dosio.DosReader(data)
+        self.assertEqual(reader.index["arrays"][0]["compression"], "zlib")
+        self.check(d, reader.read_dict())
+
+    def test_float32(self):
+        d = make_dos()
+        data = dosio.dumps(d, dtype="<f4")
+        self.assertTrue(len(data) < len(dosio.dumps(d)))
+        self.check(d, dosio.loads(data), rtol=1e-6)
+
+    def test_file(self):
+        d = make_dos()
+        f = io.BytesIO()
+        n = dosio.write_dos(d, f)
+        self.assertEqual(n, len(f.getvalue()))
+        reader = dosio.DosReader(io.BytesIO(f.getvalue()))
+        self.assertEqual(reader.spins, [1, -1])
+        self.assertEqual(reader.orbitals[0], list(d["pdos"][0].keys()))
+        self.assertEqual(reader.read_array("site/1").shape, (NEDOS, 8))
+        self.check(d, reader.read_dict())
+
+    def test_legacy(self):
+        d = make_dos()
+        data = json.dumps(d).encode("utf-8")
+        self.assertFalse(dosio.is_binary(data))
+        self.check(d, dosio.loads(data))
+        self.check(d, dosio.loads(zlib.compress(data, 1)))
+        self.assertRaises(dosio.DosFormatError, dosio.DosReader, data)
+
+
+class CountingFile(io.BytesIO):
+    """File that counts the bytes read from it."""
+    nread = 0
+
+    def read(self, n=-1):
+        data = io.BytesIO.read(self, n)
+        self.nread += len(data)
+        return data
+
+
+class PartialReadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.d = make_dos(nsites=4)
+        self.full = dosio.loads(dosio.dumps(self.d))
+
+    def test_energy_range(self):
+        f = CountingFile(dosio.dumps(self.d))
+        r = dosio.DosReader(f).read_dict(energy_range=(-1, 1), sites=[])
+        e = np.asarray(self.d["energies"])
+        mask = (e >= -1) & (e <= 1)
+        np.testing.assert_allclose(r["energies"], e[mask])
+        np.testing.assert_allclose(r["densities"][-1],
+                                   np.asarray(self.d["densities"]["-1"])[mask])
+        self.assertEqual(r["pdos"], [None] * 4)
+        # index, energies and a few rows of the total DOS only
+        self.assertTrue(f.nread < len(f.getvalue()) / 4)
+
+    def test_sites_orbitals(self):
+        reader = dosio.DosReader(dosio.dumps(self.d, compress=1))
+        r = reader.read_dict(sites=[1, 3], orbitals=["p"])
+        self.assertIsNone(r["pdos"][0])
+        self.assertEqual(sorted(r["pdos"][1]), ["px", "py", "pz"])
+        np.testing.assert_allclose(r["pdos"][3]["px"][1],
+                                   self.d["pdos"][3]["px"]["densities"]["1"])
+        sel = dosio.select(self.full, sites=[1, 3], orbitals=["p"])["pdos"]
+        self.assertEqual([p is None for p in r["pdos"]],
+                         [p is None for p in sel])
+        np.testing.assert_allclose(r["pdos"][1]["py"][-1],
+                                   sel[1]["py"][-1])
+
+    def test_select(self):
+        r = dosio.select(self.full, energy_range=(0, None), orbitals=["s"])
+        self.assertEqual(len(r["energies"]), NEDOS // 2)
+        self.assertEqual(list(r["pdos"][0]), ["s"])
+        self.assertEqual(len(r["pdos"][0]["s"][1]), NEDOS // 2)
+
+    def test_sites_with_elements(self):
+        self.assertEqual(dosio.sites_with_elements(self.d["structure"], ["O"]),
+                         [1, 3])
+
+
+class FakeGridOut(io.BytesIO):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FakeGridFS(object):
+    """In-memory stand-in for gridfs.GridFS, which does not accept
+    mongomock databases."""
+    files = {}
+
+    def __init__(self, db, collection="fs"):
+        pass
+
+    def put(self, data):
+        file_id = len(self.files) + 1
+        self.files[file_id] = data
+        return file_id
+
+    def get(self, file_id):
+        return FakeGridOut(self.files[file_id])
+
+
+class FakeStructure(object):
+    @staticmethod
+    def from_dict(d):
+        return d
+
+
+class QueryEngineDosTestCase(unittest.TestCase):
+    def setUp(self):
+        self._gridfs = query_engine.gridfs.GridFS
+        query_engine.gridfs.GridFS = FakeGridFS
+        conn = mongomock.MongoClient()
+        self.qe = QueryEngine(connection=conn, database="dos_unittest")
+        fs = FakeGridFS(self.qe.db, "dos_fs")
+        self.d = make_dos(nsites=4)
+        binary_id = fs.put(dosio.dumps(self.d))
+        legacy_id = fs.put(json.dumps(self.d).encode("utf-8"))
+        crystal = self.d["structure"]
+        self.qe.collection.insert_many([
+            {"task_id": 1, "state": "successful",
+             "output": {"crystal": crystal},
+             "calculations": [{}, {"dos_fs_id": binary_id}]},
+            {"task_id": 2, "state": "successful",
+             "output": {"crystal": crystal},
+             "calculations": [{"dos_fs_id": legacy_id}]},
+            {"task_id": 3, "state": "successful",
+             "output": {"crystal": crystal}, "calculations": [{}]},
+            {"task_id": 4, "state": "successful"}])
+
+    def tearDown(self):
+        query_engine.gridfs.GridFS = self._gridfs
+
+    def test_get_dos(self):
+        e = np.asarray(self.d["energies"])
+        mask = (e >= -5) & (e <= 5)
+        for task_id in 1, 2:
+            r = self.qe.get_dos(task_id, energy_range=(-5, 5),
+                                elements=["Li"], orbitals=["s"],
+                                as_arrays=True)
+            np.testing.assert_allclose(r["energies"], e[mask])
+            self.assertEqual([p is not None for p in r["pdos"]],
+                             [True, False, True, False])
+            np.testing.assert_allclose(
+                r["pdos"][2]["s"][1],
+                np.asarray(self.d["pdos"][2]["s"]["densities"]["1"])[mask])
+        self.assertIsNone(self.qe.get_dos(3, as_arrays=True))
+        self.assertIsNone(self.qe.get_dos(4))
+        self.assertIsNone(self.qe.get_dos_from_id(4))
+
+    def test_get_dos_from_ids(self):
+        to_complete_dos = dosio.to_complete_dos
+        structure = query_engine.Structure
+        dosio.to_complete_dos = lambda d, structure: d
+        query_engine.Structure = FakeStructure
+        try:
+            r = dict(self.qe.get_dos_from_ids([1, 2, 3, 4, 42], nthreads=2))
+            self.assertEqual(sorted(r), [1, 2, 3, 4])
+            np.testing.assert_allclose(r[1]["densities"][1],
+                                       self.d["densities"]["1"])
+            np.testing.assert_allclose(r[2]["densities"][1],
+                                       self.d["densities"]["1"])
+            self.assertIsNone(r[3])
+            self.assertIsNone(r[4])
+            r = list(self.qe.get_structures_from_ids([2, 42]))
+            self.assertEqual(r, [(2, self.d["structure"])])
+        finally:
+            dosio.to_complete_dos = to_complete_dos
+            query_engine.Structure = structure
+
+
+if __name__ == '__main__':
+    unittest.main()
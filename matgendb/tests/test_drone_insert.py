@@ -0,0 +1,333 @@
+"""
+Tests for the db insertion side of matgendb.creator.VaspToDbTaskDrone,
+using hand-made task docs instead of parsed VASP runs.
+
+These tests use `mongomock` instead of a real MongoDB server.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mongomock
+
+from matgendb import dbclient
+from matgendb.creator import VaspToDbTaskDrone, TaskIdAllocator, \
+    IngestProfile, get_fingerprint, get_field_hashes, find_files, \
+    _read_efermi
+from matgendb.discovery import RunDir, find_runs
+
+DATABASE = "drone_insert_unittest"
+
+test_dir = os.path.join(os.path.dirname(__file__), "..", "..",
+                        "test_files", "db_test")
+
+def make_doc(i, **kw):
+    d = {"dir_name": "host:/runs/{:d}".format(i), "state": "successful",
+         "energy": -1.0 * i}
+    d.update(kw)
+    return d
+
+
+class DroneInsertTestCase(unittest.TestCase):
+    def setUp(self):
+        dbclient.set_client_class(mongomock.MongoClient)
+        self.db = dbclient.get_database("127.0.0.1", 27017, DATABASE)
+
+    def tearDown(self):
+        dbclient.set_client_class(mongomock.MongoClient)
+
+    def drone(self, **kw):
+        return VaspToDbTaskDrone(database=DATABASE, **kw)
+
+    def test_insert_docs(self):
+        drone = self.drone()
+        tids = drone.insert_docs([make_doc(i) for i in range(5)])
+        self.assertEqual(sorted(tids), [1, 2, 3, 4, 5])
+        self.assertEqual(self.db.tasks.count(), 5)
+        self.assertEqual(self.db.counter.find_one({"_id": "taskid"})["c"], 6)
+
+    def test_insert_docs_duplicates(self):
+        drone = self.drone(update_duplicates=False)
+        drone.insert_docs([make_doc(i) for i in range(3)])
+        tids = drone.insert_docs([make_doc(i) for i in range(5)])
+        self.assertEqual(sorted(tids), [4, 5])
+        self.assertEqual(self.db.tasks.count(), 5)
+        # updated docs keep their task_id
+        drone = self.drone(update_duplicates=True)
+        tids = drone.insert_docs([make_doc(0, energy=42.0), make_doc(5)])
+        self.assertEqual(sorted(tids), [1, 6])
+        rec = self.db.tasks.find_one({"dir_name": make_doc(0)["dir_name"]})
+        self.assertEqual(rec["task_id"], 1)
+        self.assertEqual(rec["energy"], 42.0)
+
+    def test_insert_docs_same_dir(self):
+        drone = self.drone()
+        tids = drone.insert_docs([make_doc(0), make_doc(0, energy=3.0)])
+        self.assertEqual(len(tids), 1)
+        self.assertEqual(self.db.tasks.count(), 1)
+        self.assertEqual(self.db.tasks.find_one()["energy"], 3.0)
+
+    def test_skip_unchanged(self):
+        drone = self.drone(skip_unchanged=True)
+        drone.insert_docs([make_doc(0, analysis_timings={"cif": 1.0},
+                                    extra=[1, {"a": 2}]),
+                           make_doc(1), make_doc(2)])
+        recs = {r["dir_name"]: r for r in self.db.tasks.find()}
+        # unchanged, apart from the timings: nothing is written
+        tids = drone.insert_docs([make_doc(0, analysis_timings={"cif": 2.0},
+                                          extra=[1, {"a": 2}]),
+                                  make_doc(1, energy=42.0),
+                                  make_doc(2, extra="new")])
+        self.assertEqual(sorted(tids), [2, 3])
+        rec0 = self.db.tasks.find_one({"dir_name": make_doc(0)["dir_name"]})
+        self.assertEqual(rec0, recs[rec0["dir_name"]])
+        # changed: only the changed fields are written
+        rec1 = self.db.tasks.find_one({"dir_name": make_doc(1)["dir_name"]})
+        self.assertEqual(rec1["energy"], 42.0)
+        self.assertNotEqual(rec1["content_hash"],
+                            recs[rec1["dir_name"]]["content_hash"])
+        self.assertTrue(rec1["last_updated"] >
+                        recs[rec1["dir_name"]]["last_updated"])
+        # removed fields are unset
+        d = make_doc(0, analysis_timings={"cif": 2.0})
+        drone.insert_docs([d])
+        self.assertEqual(d["task_id"], 1)
+        rec0 = self.db.tasks.find_one({"dir_name": make_doc(0)["dir_name"]})
+        self.assertNotIn("extra", rec0)
+        self.assertEqual(rec0["analysis_timings"], {"cif": 2.0})
+
+    def test_field_hashes(self):
+        calcs = [{"dos": {"energies": [0.1 * i for i in range(50000)]},
+                  "z": 1, "a": None}]
+        hashes = get_field_hashes(make_doc(0, task_id=1, calculations=calcs))
+        self.assertEqual(sorted(hashes),
+                         ["calculations", "dir_name", "energy", "state"])
+        # the hash of the JSON of the field encoded in one go
+        data = json.dumps(calcs, sort_keys=True, separators=(",", ":"))
+        self.assertEqual(hashes["calculations"],
+                         hashlib.sha1(data.encode("utf-8")).hexdigest())
+
+    def test_rewrite_unchanged(self):
+        drone = self.drone(skip_unchanged=False)
+        drone.insert_docs([make_doc(0)])
+        self.assertEqual(drone.insert_docs([make_doc(0)]), [1])
+        self.assertNotIn("content_hash", self.db.tasks.find_one())
+
+    def test_buffered(self):
+        drone = self.drone(batch_size=3)
+        self.assertEqual(drone._buffer_doc(make_doc(0)), [])
+        self.assertEqual(drone._buffer_doc(make_doc(1)), [])
+        self.assertEqual(self.db.tasks.count(), 0)
+        self.assertEqual(len(drone._buffer_doc(make_doc(2))), 3)
+        self.assertEqual(self.db.tasks.count(), 3)
+        drone._buffer_doc(make_doc(3))
+        self.assertEqual(len(drone.flush()), 1)
+        self.assertEqual(drone.flush(), [])
+        self.assertEqual(self.db.tasks.count(), 4)
+
+    def test_skip_stages(self):
+        drone = self.drone(skip_stages=["coordination_numbers", "cif"])
+        self.assertEqual(drone.as_dict()["init_args"]["skip_stages"],
+                         ["cif", "coordination_numbers"])
+        self.assertRaises(ValueError, self.drone, skip_stages=["voronoi"])
+
+    def test_flush_interval(self):
+        drone = self.drone(batch_size=100, flush_interval=0)
+        self.assertEqual(len(drone._buffer_doc(make_doc(0))), 1)
+
+
+class FingerprintTestCase(unittest.TestCase):
+    def setUp(self):
+        dbclient.set_client_class(mongomock.MongoClient)
+        self.dir = tempfile.mkdtemp()
+        for name in ("vasprun.xml", "OUTCAR.gz", "INCAR"):
+            self.write(name, "x")
+        os.mkdir(os.path.join(self.dir, "relax2"))
+        self.write(os.path.join("relax2", "vasprun.xml"), "y")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        with open(os.path.join(self.dir, name), "w") as f:
+            f.write(data)
+
+    def test_fingerprint(self):
+        fp = get_fingerprint(self.dir)
+        names = [f[0] for f in fp["files"]]
+        self.assertEqual(names, ["OUTCAR.gz", os.path.join("relax2", "vasprun.xml"),
+                                 "vasprun.xml"])
+        self.assertEqual(get_fingerprint(self.dir)["digest"], fp["digest"])
+        # INCAR is not part of the fingerprint
+        self.write("INCAR", "changed")
+        self.assertEqual(get_fingerprint(self.dir)["digest"], fp["digest"])
+        self.write("OUTCAR.gz", "changed")
+        self.assertNotEqual(get_fingerprint(self.dir)["digest"], fp["digest"])
+
+    def test_run_dir(self):
+        run = list(find_runs(self.dir))[0]
+        self.assertEqual(get_fingerprint(self.dir, run_dir=run),
+                         get_fingerprint(self.dir))
+
+    def test_hash_contents(self):
+        fp = get_fingerprint(self.dir, hash_contents=True)
+        self.assertEqual(len(fp["files"][0]), 4)
+        self.write("vasprun.xml", "z")
+        os.utime(os.path.join(self.dir, "vasprun.xml"), (0, 0))
+        fp2 = get_fingerprint(self.dir, hash_contents=True)
+        self.assertNotEqual(fp2["digest"], fp["digest"])
+
+    def test_is_unchanged(self):
+        drone = VaspToDbTaskDrone(database=DATABASE + "_fp", fingerprint="stat",
+                                  update_duplicates=True)
+        fp = get_fingerprint(self.dir)
+        self.assertFalse(drone.is_unchanged(self.dir, fp))
+        drone.insert_docs([{"dir_name": drone.get_dir_name(self.dir),
+                            "fingerprint": fp}])
+        self.assertTrue(drone.is_unchanged(self.dir, fp))
+        self.write("vasprun.xml", "changed")
+        self.assertFalse(drone.is_unchanged(self.dir, get_fingerprint(self.dir)))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, VaspToDbTaskDrone, fingerprint="md5")
+
+
+class FakeVasprun(object):
+    """Just enough of a Vasprun for IngestProfile.vasprun_to_dict()."""
+    def __init__(self, nsteps=20, nsw=20):
+        self.nsw = nsw
+        self.ionic_steps = [{"e_wo_entrp": -1.0 * i,
+                             "electronic_steps": [{"e_0_energy": -1.0}] * 30}
+                            for i in range(nsteps)]
+        self.eigenvalues = {"Spin.up": [[-1.0, 1.0]] * 100}
+        self.projected_eigenvalues = None
+        self.eigenvalue_band_properties = (0.5, 1.0, 0.5, False)
+
+    @property
+    def converged(self):
+        return len(self.ionic_steps) < self.nsw
+
+    def as_dict(self):
+        output = {"ionic_steps": [dict(step) for step in self.ionic_steps]}
+        if self.eigenvalues:
+            output["eigenvalues"] = self.eigenvalues
+            output["bandgap"] = self.eigenvalue_band_properties[0]
+        return {"has_vasp_completed": self.converged, "output": output}
+
+
+class IngestProfileTestCase(unittest.TestCase):
+    def test_full(self):
+        d = IngestProfile.get("full").vasprun_to_dict(FakeVasprun())
+        self.assertEqual(len(d["output"]["ionic_steps"]), 20)
+        self.assertIn("eigenvalues", d["output"])
+        self.assertEqual(d["ingest_profile"]["bytes_saved"], 0)
+
+    def test_compact(self):
+        d = IngestProfile.get("compact").vasprun_to_dict(FakeVasprun())
+        steps = d["output"]["ionic_steps"]
+        self.assertEqual([s["e_wo_entrp"] for s in steps],
+                         [-1.0 * i for i in range(10, 20)])
+        self.assertNotIn("electronic_steps", steps[-1])
+        self.assertNotIn("eigenvalues", d["output"])
+        self.assertEqual(d["output"]["bandgap"], 0.5)
+        self.assertEqual(d["output"]["is_gap_direct"], False)
+        # not converged: all NSW steps were run
+        self.assertFalse(d["has_vasp_completed"])
+        self.assertEqual(d["ingest_profile"]["nionic_steps"], 20)
+        self.assertTrue(d["ingest_profile"]["bytes_saved"] > 1000)
+
+    def test_projections(self):
+        r = FakeVasprun(nsteps=2)
+        r.projected_eigenvalues = {"Spin.up": []}
+        d = IngestProfile.get({"eigenvalues": False}).vasprun_to_dict(r)
+        self.assertIn("eigenvalues", d["output"])
+        self.assertEqual(len(d["output"]["ionic_steps"]), 2)
+
+    def test_find_files(self):
+        li2o = os.path.join(test_dir, "Li2O")
+        self.assertEqual(find_files(li2o, "OUTCAR*"),
+                         [os.path.join(li2o, "OUTCAR")])
+        # from the listing of the run, without listing the directory
+        run_dir = RunDir("/nowhere", ["OUTCAR.relax1", "INCAR",
+                                      "OUTCAR.relax2"], {})
+        self.assertEqual(find_files("/nowhere", "OUTCAR*", run_dir),
+                         ["/nowhere/OUTCAR.relax1", "/nowhere/OUTCAR.relax2"])
+        self.assertEqual(find_files("/nowhere", "custodian.json*", run_dir),
+                         [])
+
+    def test_read_efermi(self):
+        self.assertEqual(_read_efermi(os.path.join(
+            test_dir, "Li2O", "vasprun.xml")), 0.85879747)
+        self.assertEqual(_read_efermi(os.path.join(
+            test_dir, "Li2O_aflow", "vasprun.xml.relax2.gz")), 0.89603553)
+        self.assertIsNone(_read_efermi(os.path.join(
+            test_dir, "killed_mp_aflow", "vasprun.xml")))
+        # the scan stops at the efermi, before the DOS
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "vasprun.xml")
+            with open(filename, "wb") as f:
+                f.write(b'<dos>\n <i name="efermi">  1.5 </i>\n <total>\n')
+                f.write(b'\xff\xfe not text \n <i name="efermi"> 2 </i>\n')
+            self.assertEqual(_read_efermi(filename), 1.5)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_drone(self):
+        self.assertRaises(ValueError, VaspToDbTaskDrone, simulate_mode=True,
+                          ingest_profile="foo")
+        drone = VaspToDbTaskDrone(simulate_mode=True,
+                                  ingest_profile="minimal")
+        self.assertEqual(drone.ingest_profile.max_ionic_steps, 1)
+        drone = VaspToDbTaskDrone.from_dict(drone.as_dict())
+        self.assertEqual(drone.ingest_profile.name, "minimal")
+
+    def test_stability_ref(self):
+        for ref in ("refs.json", os.path.join("refs", "entries")):
+            self.assertRaises(ValueError, VaspToDbTaskDrone,
+                              simulate_mode=True, stability_ref=ref,
+                              stability_compat="none")
+        drone = VaspToDbTaskDrone(simulate_mode=True, stability_ref="refs",
+                                  stability_compat="none")
+        drone = VaspToDbTaskDrone.from_dict(drone.as_dict())
+        self.assertEqual(drone.stability_compat, "none")
+
+
+class TaskIdAllocatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.counter = mongomock.MongoClient().db.counter
+        self.counter.insert_one({"_id": "taskid", "c": 1})
+
+    def test_blocks(self):
+        a1, a2 = TaskIdAllocator(10), TaskIdAllocator(10)
+        ids1 = a1.allocate(self.counter, 3)
+        ids2 = a2.allocate(self.counter, 3)
+        self.assertEqual(ids1, [1, 2, 3])
+        self.assertEqual(ids2, [11, 12, 13])
+        self.assertEqual(a1.allocate(self.counter, 2), [4, 5])
+        self.assertEqual(self.counter.find_one()["c"], 21)
+        # spills over into a new block
+        ids = a1.allocate(self.counter, 7)
+        self.assertEqual(ids, [6, 7, 8, 9, 10, 21, 22])
+        self.assertEqual(a1.remaining, 8)
+
+    def test_large_request(self):
+        a = TaskIdAllocator(2)
+        self.assertEqual(a.allocate(self.counter, 5), [1, 2, 3, 4, 5])
+        self.assertEqual(self.counter.find_one()["c"], 6)
+
+    def test_drone(self):
+        dbclient.set_client_class(mongomock.MongoClient)
+        drone = VaspToDbTaskDrone(database=DATABASE + "_block",
+                                  taskid_block_size=100)
+        tids = [drone._insert_doc(make_doc(i)) for i in range(3)]
+        self.assertEqual(tids, [1, 2, 3])
+        db = dbclient.get_database("127.0.0.1", 27017, DATABASE + "_block")
+        self.assertEqual(db.counter.find_one({"_id": "taskid"})["c"], 101)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+"""
+Tests for matgendb.pipeline
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mongomock
+
+from matgendb import journal
+from matgendb.pipeline import IngestPipeline
+
+
+class FakeDrone(object):
+    """Drone that 'parses' a path into a tiny doc and 'writes' docs into
+    a list. Paths starting with 'bad' fail to parse, paths starting
+    with 'old' are skipped as unchanged and paths starting with 'lambda'
+    give docs that cannot be pickled.
+    """
+    batch_size = 3
+
+    def __init__(self):
+        self.written, self.batches = [], []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def get_task_doc(self, path):
+        if path.startswith("bad"):
+            raise ValueError("cannot parse {}".format(path))
+        return {"dir_name": path, "state": "successful",
+                "analysis_timings": {"cif": 0.5, "outcar": 1.0}}
+
+    def process_path(self, path):
+        if path.startswith("old"):
+            return None
+        d = self.get_task_doc(path)
+        if path.startswith("lambda"):
+            d["func"] = lambda x: x
+        return d
+
+    def insert_docs(self, docs):
+        with self._lock:
+            self.batches.append(len(docs))
+            if any(d["dir_name"].startswith("fail") for d in docs):
+                raise IOError("cannot write")
+            for d in docs:
+                if not d["dir_name"].startswith("dup"):
+                    d["task_id"] = len(self.written) + 1
+                    self.written.append(d["dir_name"])
+        return [d["task_id"] for d in docs if "task_id" in d]
+
+
+class IngestPipelineTestCase(unittest.TestCase):
+    def test_run(self):
+        drone = FakeDrone()
+        paths = ["run{:d}".format(i) for i in range(50)]
+        pipeline = IngestPipeline(drone, nprocs=2, nwriters=2, queue_size=4,
+                                  flush_interval=0.1)
+        n = pipeline.run(iter(paths))
+        self.assertEqual(n, 50)
+        self.assertEqual(sorted(drone.written), sorted(paths))
+        self.assertTrue(max(drone.batches) <= 3)
+        stats = pipeline.stats
+        self.assertEqual(stats["parse"].count, 50)
+        self.assertEqual(stats["write"].count, 50)
+        self.assertTrue(stats.max_queued <= 4 + 2)
+        self.assertAlmostEqual(stats.analysis["cif"].seconds, 25.0)
+        self.assertAlmostEqual(stats.analysis["outcar"].seconds, 50.0)
+
+    def test_parse_errors(self):
+        drone = FakeDrone()
+        paths = ["run1", "bad1", "run2", "bad2"]
+        pipeline = IngestPipeline(drone, nprocs=1, nwriters=1,
+                                  flush_interval=0.1)
+        self.assertEqual(pipeline.run(paths), 2)
+        self.assertEqual(pipeline.stats["parse"].errors, 2)
+        self.assertEqual(sorted(drone.written), ["run1", "run2"])
+
+    def test_unpicklable(self):
+        drone = FakeDrone()
+        paths = ["lambda{:d}".format(i) for i in range(5)] + ["run1"]
+        pipeline = IngestPipeline(drone, nprocs=1, nwriters=1, queue_size=1,
+                                  flush_interval=0.1)
+        # more failures than slots
+        self.assertEqual(pipeline.run(paths), 1)
+        self.assertEqual(pipeline.stats["parse"].errors, 5)
+        self.assertEqual(drone.written, ["run1"])
+
+    def test_skipped(self):
+        drone = FakeDrone()
+        paths = ["run1", "old1", "old2", "run2"]
+        pipeline = IngestPipeline(drone, nprocs=1, nwriters=1,
+                                  flush_interval=0.1)
+        self.assertEqual(pipeline.run(paths), 2)
+        self.assertEqual(pipeline.stats["parse"].skipped, 2)
+        self.assertEqual(pipeline.stats["parse"].errors, 0)
+
+
+class JournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "insert.journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_pipeline(self, paths):
+        drone = FakeDrone()
+        j = journal.get_journal(self.filename)
+        pipeline = IngestPipeline(drone, nprocs=1, nwriters=1,
+                                  flush_interval=0.1, journal=j)
+        pipeline.run(paths)
+        j.close()
+        return drone
+
+    def test_resume(self):
+        paths = ["run1", "bad1", "old1", "dup1", "run2"]
+        self.run_pipeline(paths)
+        status = journal.FileJournal(self.filename).get_status()
+        self.assertEqual(
+            {os.path.basename(p): s for p, s in status.items()},
+            {"run1": "written", "bad1": "failed", "old1": "skipped",
+             "dup1": "skipped", "run2": "written"})
+        # one write per directory, of its final status
+        with open(self.filename) as f:
+            self.assertEqual(len(f.readlines()), len(paths))
+        # only the failed and new directories are done again
+        drone = self.run_pipeline(paths + ["run3"])
+        self.assertEqual(drone.written, ["run3"])
+        counts = journal.FileJournal(self.filename).counts()
+        self.assertEqual(counts["written"], 3)
+        self.assertEqual(counts["failed"], 1)
+
+    def test_write_error(self):
+        self.run_pipeline(["fail1"])
+        j = journal.FileJournal(self.filename)
+        self.assertEqual(list(j.get_status().values()), ["failed"])
+        self.assertEqual(j.finished(), set())
+
+    def test_truncated(self):
+        with open(self.filename, "w") as f:
+            f.write('{"path": "/a", "status": "written"}\n{"path": "/b", "st')
+        j = journal.FileJournal(self.filename)
+        self.assertEqual(j.finished(), {"/a"})
+        j.record("/c", journal.WRITTEN)
+        j.close()
+        self.assertEqual(journal.FileJournal(self.filename).finished(),
+                         {"/a", "/c"})
+
+    def test_mongo(self):
+        coll = mongomock.MongoClient().db.journal
+        j = journal.get_journal("mongo:journal", db=coll.database)
+        self.assertIsInstance(j, journal.MongoJournal)
+        j.collection = coll
+        j.record_many(["/a", "/b"], journal.QUEUED)
+        j.record("/a", journal.WRITTEN)
+        j.record("/b", journal.FAILED, error="Traceback")
+        self.assertEqual(j.finished(), {"/a"})
+        self.assertEqual(coll.find_one({"_id": "/b"})["error"], "Traceback")
+        self.assertEqual(j.counts()["failed"], 1)
+        self.assertRaises(ValueError, journal.get_journal, "mongo:journal")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,315 @@
+"""
+Tests for the mapping of records in matgendb.query_engine.QueryResults,
+for lazily decoded raw results and prefetching, and for
+QueryEngine.query_columns and QueryEngine.iter_pages
+
+These tests use `mongomock` instead of a real MongoDB server.
+"""
+import threading
+import unittest
+from collections import OrderedDict
+
+import bson
+import mongomock
+import numpy as np
+from bson.raw_bson import RawBSONDocument
+
+from matgendb.lazydoc import LazyRecord
+from matgendb.query_engine import QueryEngine, QueryError, \
+    QueryListResults, compile_mapper
+from matgendb.tests import common
+
+
+def reference_map(prop_dict, r):
+    """Record mapping as QueryResults did it before it was compiled."""
+    result = dict()
+    for k, v in prop_dict.items():
+        try:
+            data = r[v[0]]
+            for j in range(1, len(v)):
+                if isinstance(data, list):
+                    data = [d[v[j]] for d in data]
+                else:
+                    data = data[v[j]]
+            result[k] = data
+        except (IndexError, KeyError, ValueError):
+            result[k] = None
+    return result
+
+
+PROPS = OrderedDict([
+    ("task_id", ["task_id"]),
+    ("energy", ["output", "final_energy"]),
+    ("e_above_hull", ["analysis", "e_above_hull"]),
+    ("calc_energies", ["calculations", "output", "final_energy"]),
+    ("sites", ["output", "crystal", "sites", "label"]),
+    ("deep", ["a", "b", "c", "d", "e"]),
+    ("odd 'key'", ["it's", "x\\n"])])
+
+DOCS = [
+    {"task_id": 1, "output": {"final_energy": -1.0,
+                              "crystal": {"sites": [{"label": "Li"},
+                                                    {"label": "O"}]}},
+     "analysis": {"e_above_hull": 0.0},
+     "calculations": [{"output": {"final_energy": -0.5}},
+                      {"output": {"final_energy": -1.0}}],
+     "a": {"b": {"c": {"d": {"e": 5}}}}, "it's": {"x\\n": 2}},
+    {"task_id": 2, "output": {}, "calculations": []},
+    {"output": {"final_energy": -2.0, "crystal": {"sites": []}},
+     "calculations": [{"output": {}}], "a": {"b": [{"c": {"d": {"e": 1}}}]}},
+    {},
+]
+
+
+class CompiledMapperTestCase(unittest.TestCase):
+    def test_same_as_reference(self):
+        mapper = compile_mapper(PROPS)
+        for d in DOCS:
+            self.assertEqual(mapper(d), reference_map(PROPS, d))
+        # same after a record with lists has been seen
+        self.assertEqual(mapper(DOCS[0]), reference_map(PROPS, DOCS[0]))
+
+    def test_errors(self):
+        mapper = compile_mapper(PROPS)
+        # a scalar where a dict is expected is an error, as before
+        self.assertRaises(TypeError, reference_map, PROPS,
+                          {"output": {"final_energy": None, "crystal": 1}})
+        self.assertRaises(TypeError, mapper,
+                          {"output": {"final_energy": None, "crystal": 1}})
+
+    def test_results(self):
+        docs = [dict(d) for d in DOCS]
+
+        def post(r):
+            r["task_id"] = r.get("task_id", 0) + 100
+
+        results = QueryListResults(PROPS, docs, postprocess=[post])
+        mapped = list(results)
+        self.assertEqual([r["task_id"] for r in mapped], [101, 102, 100, 100])
+        docs = [dict(d) for d in DOCS]
+        results = QueryListResults(PROPS, docs, postprocess=[post])
+        batches = list(results.batches(batch_size=3))
+        self.assertEqual([len(b) for b in batches], [3, 1])
+        self.assertEqual(batches[0] + batches[1], mapped)
+
+    def test_no_properties(self):
+        results = QueryListResults(None, list(DOCS))
+        self.assertEqual(results.map_batch(DOCS), DOCS)
+        self.assertEqual(list(results), DOCS)
+
+
+def raw_docs():
+    return [RawBSONDocument(bson.BSON.encode(d)) for d in DOCS]
+
+
+class LazyResultsTestCase(unittest.TestCase):
+    def test_same_as_dicts(self):
+        expected = list(QueryListResults(PROPS, [dict(d) for d in DOCS]))
+        results = list(QueryListResults(PROPS, raw_docs(), raw=True))
+        self.assertEqual([r.to_dict() for r in results], expected)
+        self.assertEqual(results, expected)
+        self.assertEqual(list(QueryListResults(None, raw_docs(), raw=True)),
+                         DOCS)
+
+    def test_lazy(self):
+        r = next(iter(QueryListResults(PROPS, raw_docs(), raw=True)))
+        self.assertEqual(r["calc_energies"], [-0.5, -1.0])
+        self.assertEqual(r["e_above_hull"], 0.0)
+        record = r._record
+        # nothing decoded into the record, only the values read
+        self.assertEqual(record._fields, {})
+        self.assertEqual(sorted(r._values), ["calc_energies", "e_above_hull"])
+        self.assertRaises(KeyError, r.__getitem__, "energies")
+        # values are plain Python objects
+        self.assertEqual(type(record["output"]), dict)
+        self.assertEqual(type(record["calculations"][0]), dict)
+
+    def test_postprocess(self):
+        def post(r):
+            r["task_id"] = r.get("task_id", 0) + 100
+
+        results = QueryListResults(PROPS, raw_docs(), postprocess=[post],
+                                   raw=True)
+        self.assertEqual([r["task_id"] for r in results.map_batch(
+            raw_docs())], [101, 102, 100, 100])
+        record = next(iter(QueryListResults(None, raw_docs(),
+                                            postprocess=[post], raw=True)))
+        self.assertIsInstance(record, LazyRecord)
+        self.assertEqual(record["task_id"], 101)
+        self.assertEqual(len(record), len(DOCS[0]))
+
+    def test_delete(self):
+        def post(r):
+            if "output" in r:
+                del r["output"]
+            r.pop("a", None)
+            r["extra"] = 1
+
+        plain = list(QueryListResults(None, [dict(d) for d in DOCS],
+                                      postprocess=[post]))
+        lazy = list(QueryListResults(None, raw_docs(), postprocess=[post],
+                                     raw=True))
+        self.assertEqual([r.to_dict() for r in lazy], plain)
+        self.assertEqual([len(r) for r in lazy], [len(r) for r in plain])
+        self.assertNotIn("output", lazy[0])
+        self.assertRaises(KeyError, lazy[0].get_raw, "output")
+        self.assertRaises(KeyError, lazy[0].__delitem__, "output")
+        r = next(iter(QueryListResults(PROPS, raw_docs(), raw=True)))
+        del r["energy"]
+        r["extra"] = 1
+        self.assertEqual(sorted(r), sorted(set(PROPS) - {"energy"} |
+                                           {"extra"}))
+        self.assertIsNone(r.get("energy"))
+
+    @unittest.skipUnless(common.has_mongo(), 'requires MongoDB server')
+    def test_query(self):
+        qe = QueryEngine(database="lazy_unittest", aliases={})
+        qe.collection.drop()
+        qe.collection.insert_many([dict(d, state="successful")
+                                   for d in DOCS])
+        r = qe.query_one(["calculations.output.final_energy"],
+                         {"task_id": 1}, raw=True)
+        self.assertEqual(r["calculations.output.final_energy"], [-0.5, -1.0])
+        qe.collection.drop()
+
+
+class PrefetchTestCase(unittest.TestCase):
+    def test_order(self):
+        docs = [{"task_id": i} for i in range(1050)]
+        results = QueryListResults({"task_id": ["task_id"]}, iter(docs))
+        self.assertEqual([r["task_id"] for r in results.prefetch(100)],
+                         list(range(1050)))
+
+    def test_overlap(self):
+        fetched = [threading.Event() for _ in range(3)]
+
+        def records():
+            for i in range(3):
+                fetched[i].set()
+                yield {"i": i}
+
+        results = QueryListResults({"i": ["i"]}, records())
+        for r in results.prefetch(batch_size=1, depth=1):
+            # the next batch is fetched while this one is processed
+            if r["i"] < 2:
+                self.assertTrue(fetched[r["i"] + 1].wait(5))
+
+    def test_error(self):
+        def records():
+            yield {"i": 0}
+            raise ValueError("connection lost")
+
+        results = QueryListResults({"i": ["i"]}, records())
+        it = results.prefetch(batch_size=1)
+        self.assertEqual(next(it), {"i": 0})
+        self.assertRaises(ValueError, next, it)
+
+    def test_close(self):
+        results = QueryListResults(None, ({"i": i} for i in range(10000)))
+        it = results.prefetch(batch_size=10, depth=1)
+        next(it)
+        it.close()
+        self.assertFalse(any(t.name == "prefetch"
+                             for t in threading.enumerate()))
+
+
+class QueryColumnsTestCase(unittest.TestCase):
+    def setUp(self):
+        conn = mongomock.MongoClient()
+        self.qe = QueryEngine(connection=conn, database="columns_unittest",
+                              aliases={"energy": "output.final_energy"})
+        self.qe.collection.drop()
+        docs = []
+        for i in range(2500):
+            d = {"task_id": "mp-{:d}".format(i), "state": "successful",
+                 "nsites": i % 7 + 1, "is_hubbard": i % 2 == 0,
+                 "output": {"final_energy": -0.5 * i}}
+            if i % 10 == 0:
+                del d["output"]
+            docs.append(d)
+        self.qe.collection.insert_many(docs)
+
+    def test_columns(self):
+        cols = self.qe.query_columns(
+            ["task_id", "energy", "nsites", "is_hubbard", "missing"],
+            dtypes={"nsites": np.int32}, batch_size=1000, sort=[("nsites", 1)])
+        self.assertEqual(list(cols), ["task_id", "energy", "nsites",
+                                      "is_hubbard", "missing"])
+        self.assertEqual(len(cols["energy"]), 2500)
+        self.assertEqual(cols["energy"].dtype, np.float64)
+        self.assertEqual(cols["nsites"].dtype, np.int32)
+        self.assertEqual(cols["is_hubbard"].dtype, bool)
+        self.assertEqual(cols["task_id"].dtype, object)
+        self.assertEqual(cols["energy"].count(), 2250)
+        self.assertEqual(cols["missing"].count(), 0)
+        self.assertEqual(list(cols["nsites"][:3]), [1, 1, 1])
+        records = {r["task_id"]: r for r in self.qe.query(
+            ["task_id", "energy"])}
+        for tid, e in zip(cols["task_id"], cols["energy"]):
+            if records[tid]["energy"] is None:
+                self.assertIs(e, np.ma.masked)
+            else:
+                self.assertEqual(e, records[tid]["energy"])
+
+    def test_bad_dtype(self):
+        self.assertRaises(QueryError, self.qe.query_columns, ["task_id"],
+                          dtypes={"task_id": float})
+
+
+class IterPagesTestCase(unittest.TestCase):
+    def setUp(self):
+        conn = mongomock.MongoClient()
+        self.qe = QueryEngine(connection=conn, database="pages_unittest",
+                              aliases_config={
+                                  "aliases": {"energy": "output.final_energy",
+                                              "tid": "task_id"},
+                                  "defaults": {"state": "successful"}})
+        self.qe.collection.drop()
+        ids = [(i * 7) % 25 for i in range(25)]
+        self.qe.collection.insert_many(
+            [{"task_id": i, "output": {"final_energy": -i},
+              "state": "killed" if i % 5 == 4 else "successful"}
+             for i in ids] + [{"state": "successful"}])
+        self.expected = [i for i in range(25) if i % 5 != 4]
+
+    def ids(self, pages):
+        return [r["tid"] for page, token in pages for r in page]
+
+    def test_pages(self):
+        pages = list(self.qe.iter_pages(properties=["tid", "energy"],
+                                        key="tid", page_size=7))
+        self.assertEqual([len(page) for page, token in pages], [7, 7, 6])
+        self.assertEqual(self.ids(pages), self.expected)
+        self.assertEqual(pages[0][0][1], {"tid": 1, "energy": -1})
+        # criteria use aliases and override the defaults
+        pages = self.qe.iter_pages({"state": "killed", "energy": {"$lt": -5}},
+                                   ["tid"], key="energy", page_size=2)
+        self.assertEqual(self.ids(pages), [24, 19, 14, 9])
+
+    def test_resume(self):
+        pages = self.qe.iter_pages(properties=["energy"], page_size=6)
+        first, token = next(pages)
+        self.assertNotIn("task_id", first[0])
+        rest = list(self.qe.iter_pages(properties=["tid"], page_size=6,
+                                       resume_token=token))
+        self.assertEqual([r["energy"] for r in first] + self.ids(rest),
+                         [-i for i in self.expected[:6]] +
+                         self.expected[6:])
+        self.assertEqual(list(self.qe.iter_pages(
+            page_size=6, resume_token=rest[-1][1])), [])
+
+    def test_descending(self):
+        pages = self.qe.iter_pages(properties=["tid"], key="tid",
+                                   page_size=8, descending=True)
+        self.assertEqual(self.ids(pages), self.expected[::-1])
+
+    def test_bad_token(self):
+        token = next(self.qe.iter_pages(page_size=5))[1]
+        for kw in ({"resume_token": "not a token"},
+                   {"resume_token": token, "key": "energy"},
+                   {"resume_token": token, "descending": True}):
+            self.assertRaises(QueryError, next, self.qe.iter_pages(**kw))
+
+
+if __name__ == '__main__':
+    unittest.main()
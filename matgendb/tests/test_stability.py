@@ -0,0 +1,118 @@
+"""
+Tests for matgendb.stability
+
+These tests use fake entries and phase diagrams instead of pymatgen ones.
+"""
+import unittest
+
+from matgendb import stability
+from matgendb.stability import StabilityService, get_compatibility, \
+    get_subsystems
+
+
+class FakeElement(object):
+    def __init__(self, symbol):
+        self.symbol = symbol
+
+
+class FakeComposition(object):
+    def __init__(self, formula):
+        self.reduced_formula = formula
+        self.elements = [FakeElement(el) for el in formula.split("-")]
+
+
+class FakeEntry(object):
+    def __init__(self, formula, entry_id=None):
+        self.composition = FakeComposition(formula)
+        self.entry_id = entry_id
+
+
+class FakePhaseDiagram(object):
+    built = []
+
+    def __init__(self, entries, elements=None):
+        symbols = set(el.symbol for e in entries
+                      for el in e.composition.elements)
+        if len(symbols) != len(elements):
+            raise stability.PhaseDiagramError("missing terminal")
+        self.entries = entries
+        self.built.append(sorted(e.entry_id for e in entries))
+
+    def get_decomp_and_e_above_hull(self, entry, allow_negative=False):
+        return {self.entries[0]: 1.0}, 0.1 * len(self.entries)
+
+
+class FakeQE(object):
+    def __init__(self, entries):
+        self.entries, self.queries = entries, []
+
+    def get_entries(self, criteria):
+        systems = criteria["chemsys"]["$in"]
+        self.queries.append(sorted(systems))
+        return [e for e in self.entries
+                if stability._entry_chemsys(e) in systems]
+
+
+REFS = [FakeEntry("Li", "r1"), FakeEntry("O", "r2"), FakeEntry("Li-O", "r3"),
+        FakeEntry("Fe", "r4")]
+
+
+class StabilityServiceTestCase(unittest.TestCase):
+    def setUp(self):
+        self._pd = stability.PhaseDiagram
+        self._error = stability.PhaseDiagramError
+        stability.PhaseDiagram = FakePhaseDiagram
+        stability.PhaseDiagramError = ValueError
+        FakePhaseDiagram.built = []
+
+    def tearDown(self):
+        stability.PhaseDiagram = self._pd
+        stability.PhaseDiagramError = self._error
+
+    def test_subsystems(self):
+        self.assertEqual(get_subsystems("Fe-Li-O"),
+                         ["Fe", "Li", "O", "Fe-Li", "Fe-O", "Li-O",
+                          "Fe-Li-O"])
+
+    def test_batch(self):
+        service = StabilityService(entries=REFS)
+        entries = [FakeEntry("Li-O", 1), FakeEntry("Na-O", 2),
+                   FakeEntry("Li-O", 3), FakeEntry("Fe-O", 4)]
+        results = service.get_stability(entries)
+        self.assertAlmostEqual(results[0]["e_above_hull"], 0.3)
+        self.assertEqual(results[0]["decomposes_to"],
+                         [{"entry_id": "r1", "formula": "Li",
+                           "amount": 1.0}])
+        self.assertIsNone(results[1])  # no Na reference
+        self.assertEqual(results[2], results[0])
+        self.assertAlmostEqual(results[3]["e_above_hull"], 0.2)
+        # one hull per chemical system, reused by the next batch
+        self.assertEqual(len(FakePhaseDiagram.built), 2)
+        service.get_stability([FakeEntry("Li-O", 5)])
+        self.assertEqual(len(FakePhaseDiagram.built), 2)
+
+    def test_query_engine(self):
+        qe = FakeQE(REFS)
+        service = StabilityService(qe=qe)
+        service.get_stability([FakeEntry("Li-O", 1)])
+        service.get_stability([FakeEntry("Fe-Li-O", 2)])
+        self.assertEqual(qe.queries, [["Li", "Li-O", "O"],
+                                      ["Fe", "Fe-Li", "Fe-Li-O", "Fe-O"]])
+        self.assertEqual(FakePhaseDiagram.built[-1],
+                         ["r1", "r2", "r3", "r4"])
+
+    def test_compatibility(self):
+        self.assertIsNone(get_compatibility(None))
+        self.assertIsNone(get_compatibility("none"))
+        self.assertRaises(ValueError, get_compatibility, "NoCompatibility")
+
+    def test_lru(self):
+        service = StabilityService(entries=REFS, max_systems=1)
+        service.get_phase_diagram("Li-O")
+        service.get_phase_diagram("Fe-O")
+        service.get_phase_diagram("Li-O")
+        self.assertEqual(len(FakePhaseDiagram.built), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+"""
+Tests for matgendb.watch
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from matgendb import discovery, journal, watch
+from matgendb.discovery import RunDir
+from matgendb.watch import RunWatcher, is_run_complete, is_vasprun_closed
+
+CLOSED = "<modeling>\n</modeling>\n"
+OPEN = "<modeling>\n<calculation>\n"
+
+
+class RunWatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(tempfile.mkdtemp(), "watch.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        shutil.rmtree(os.path.dirname(self.state_file))
+
+    def write(self, name, content=""):
+        path = os.path.join(self.dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content)
+
+    def found(self, watcher):
+        return sorted(os.path.relpath(r.path, self.dir)
+                      for r in watcher.scan())
+
+    def test_closed(self):
+        self.write("a/vasprun.xml", CLOSED)
+        self.write("b/vasprun.xml", OPEN)
+        self.write("c.gz/vasprun.xml.gz", OPEN)
+        self.assertTrue(is_vasprun_closed(os.path.join(self.dir, "a",
+                                                       "vasprun.xml")))
+        self.assertFalse(is_vasprun_closed(os.path.join(self.dir, "b",
+                                                        "vasprun.xml")))
+        gz = os.path.join(self.dir, "c.gz", "vasprun.xml.gz")
+        self.assertFalse(is_vasprun_closed(gz))
+        os.utime(gz, (time.time() - 100, time.time() - 100))
+        self.assertTrue(is_vasprun_closed(gz))
+
+    def test_custodian(self):
+        self.write("a/vasprun.xml", OPEN)
+        self.write("a/custodian.json", "[]")
+        run = RunDir(os.path.join(self.dir, "a"),
+                     ["vasprun.xml", "custodian.json"], {})
+        self.assertFalse(is_run_complete(run))
+        self.assertTrue(is_run_complete(run, settle=-1))
+
+    def test_scan(self):
+        self.write("a/vasprun.xml", CLOSED)
+        self.write("b/relax1/vasprun.xml", CLOSED)
+        self.write("b/relax2/vasprun.xml", OPEN)
+        self.write("c/INCAR")
+        watcher = RunWatcher(self.dir, state_file=self.state_file)
+        self.assertEqual(self.found(watcher), ["a"])
+        self.assertEqual(self.found(watcher), [])
+        # b completes, d shows up
+        self.write("b/relax2/vasprun.xml", CLOSED)
+        self.write("d/e/vasprun.xml", CLOSED)
+        self.assertEqual(self.found(watcher), ["b", os.path.join("d", "e")])
+        # only the changed directory is listed again
+        self.write("c/relax1/vasprun.xml", OPEN)
+        self.assertEqual(self.found(watcher), [])
+        self.assertEqual(watcher.pending, {os.path.join(self.dir, "c")})
+        # a run that is removed is forgotten
+        shutil.rmtree(os.path.join(self.dir, "d"))
+        self.assertEqual(self.found(watcher), [])
+        self.assertNotIn(os.path.join(self.dir, "d", "e"), watcher.dirs)
+        self.assertNotIn(os.path.join(self.dir, "d", "e"), watcher.done)
+
+    def test_listed_once(self):
+        self.write("a/vasprun.xml", CLOSED)
+        self.write("b/relax1/vasprun.xml", CLOSED)
+        self.write("b/relax2/vasprun.xml", CLOSED)
+        self.write("c/d/INCAR")
+        listed = []
+        list_dir = discovery._list_dir
+
+        def counting_list_dir(path):
+            listed.append(path)
+            return list_dir(path)
+
+        watch._list_dir = discovery._list_dir = counting_list_dir
+        try:
+            watcher = RunWatcher(self.dir)
+            runs = {os.path.relpath(r.path, self.dir): r
+                    for r in watcher.scan()}
+        finally:
+            watch._list_dir = discovery._list_dir = list_dir
+        self.assertEqual(sorted(runs), ["a", "b"])
+        self.assertEqual(runs["b"].vasprun_files,
+                         {"relax1": os.path.join("relax1", "vasprun.xml"),
+                          "relax2": os.path.join("relax2", "vasprun.xml")})
+        self.assertEqual(sorted(listed), sorted(set(listed)))
+        self.assertEqual(len(listed), 7)
+
+    def test_state(self):
+        self.write("a/vasprun.xml", CLOSED)
+        self.write("c/vasprun.xml", CLOSED)
+        watcher = RunWatcher(self.dir, state_file=self.state_file)
+        j = watcher.get_journal()
+        for run in watcher.watch(max_scans=1):
+            if run.path.endswith("a"):
+                j.record(run.path, journal.WRITTEN)
+        self.write("b/vasprun.xml", CLOSED)
+        watcher = RunWatcher(self.dir, state_file=self.state_file)
+        self.assertEqual(sorted(watcher.dirs),
+                         [self.dir] + [os.path.join(self.dir, name)
+                                       for name in ("a", "c")])
+        # c was handed out, but not written before the restart
+        self.assertEqual(self.found(watcher), ["b", "c"])
+
+    def test_failed(self):
+        self.write("a/vasprun.xml", CLOSED)
+        self.write("b/vasprun.xml", CLOSED)
+        watcher = RunWatcher(self.dir)
+        j = watcher.get_journal()
+        runs = {os.path.basename(r.path): r.path for r in watcher.scan()}
+        j.record_many([runs["a"]], journal.SKIPPED)
+        j.record_many([runs["b"]], journal.FAILED, error="Traceback")
+        self.assertEqual(j.get_status(), {runs["a"]: journal.WRITTEN,
+                                          runs["b"]: journal.QUEUED})
+        self.assertEqual(self.found(watcher), ["b"])
+        self.assertEqual(list(watcher.done), [runs["a"]])
+
+    def test_skip_existing(self):
+        self.write("a/vasprun.xml", CLOSED)
+        watcher = RunWatcher(self.dir)
+        runs = watcher.watch(interval=0, max_scans=2, skip_existing=True)
+        self.assertEqual(next(runs, None), None)
+        self.assertEqual(list(watcher.done), [os.path.join(self.dir, "a")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""
+Tests for matgendb.workqueue
+
+These tests use `mongomock` instead of a real MongoDB server.
+"""
+import datetime
+import os
+import unittest
+
+import mongomock
+
+from matgendb.pipeline import IngestPipeline
+from matgendb.workqueue import WorkQueue, QueueJournal, QUEUED, CLAIMED, \
+    DONE, FAILED
+
+class FakeDrone(object):
+    """Drone that 'parses' a path into a tiny doc. Paths whose basename
+    starts with 'bad' fail to parse.
+    """
+    batch_size = 2
+
+    def process_path(self, path):
+        if os.path.basename(path).startswith("bad"):
+            raise ValueError("cannot parse {}".format(path))
+        return {"dir_name": path}
+
+    def insert_docs(self, docs):
+        for d in docs:
+            d["task_id"] = 1
+        return [1] * len(docs)
+
+
+class WorkQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.coll = mongomock.MongoClient().workqueue_unittest.queue
+        self.coll.drop()
+
+    def queue(self, worker, **kw):
+        return WorkQueue(self.coll, worker=worker, **kw)
+
+    def states(self):
+        return {os.path.basename(d["_id"]): d["state"]
+                for d in self.coll.find()}
+
+    def test_enqueue(self):
+        queue = self.queue("w1")
+        self.assertEqual(queue.enqueue(["/r/a", "/r/b"], chunk_size=1), 2)
+        queue.complete(queue.claim(1))
+        # already queued or done: not queued again, unless asked to
+        self.assertEqual(queue.enqueue(["/r/a", "/r/b", "/r/c"]), 1)
+        self.assertEqual(queue.counts()[DONE], 1)
+        self.assertEqual(queue.enqueue(["/r/a"], requeue=True), 1)
+        self.assertEqual(queue.counts(), {QUEUED: 3, CLAIMED: 0, DONE: 0,
+                                          FAILED: 0})
+
+    def test_claims_are_exclusive(self):
+        w1, w2 = self.queue("w1"), self.queue("w2")
+        w1.enqueue(["/r/{:d}".format(i) for i in range(5)])
+        claimed1, claimed2 = w1.claim(3), w2.claim(3)
+        self.assertEqual(len(claimed1), 3)
+        self.assertEqual(len(claimed2), 2)
+        self.assertFalse(set(claimed1) & set(claimed2))
+        # a worker only completes its own claims
+        w2.complete(claimed1)
+        self.assertEqual(w1.counts()[DONE], 0)
+
+    def test_lease(self):
+        w1, w2 = self.queue("w1", lease=60), self.queue("w2", lease=60)
+        w1.enqueue(["/r/a"])
+        path = w1.claim()[0]
+        self.assertEqual(w2.claim(), [])
+        self.assertEqual(w1.renew(), 1)
+        self.assertFalse(w2.is_drained())
+        # w1 dies: its lease expires and w2 takes over
+        past = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        self.coll.update_one({"_id": path}, {"$set": {"lease_until": past}})
+        self.assertEqual(w2.claim(), [path])
+        self.assertEqual(self.coll.find_one()["attempts"], 2)
+        w1.complete([path])  # too late
+        self.assertEqual(self.coll.find_one()["worker"], "w2")
+
+    def test_retry(self):
+        queue = self.queue("w1", max_attempts=2)
+        queue.enqueue(["/r/a"])
+        queue.fail(queue.claim(), error="boom")
+        self.assertEqual(self.states(), {"a": QUEUED})
+        queue.fail(queue.claim(), error="boom")
+        self.assertEqual(self.states(), {"a": FAILED})
+        self.assertEqual(self.coll.find_one()["error"], "boom")
+        self.assertEqual(queue.claim(), [])
+        self.assertTrue(queue.is_drained())
+
+    def test_release_and_reap(self):
+        queue = self.queue("w1", max_attempts=1)
+        queue.enqueue(["/r/a", "/r/b"])
+        queue.claim(2)
+        queue.release(["/r/a"])
+        self.assertEqual(self.states(), {"a": QUEUED, "b": CLAIMED})
+        past = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        self.coll.update_many({}, {"$set": {"lease_until": past}})
+        self.assertEqual(queue.reap(), 1)
+        self.assertEqual(self.states(), {"a": QUEUED, "b": FAILED})
+
+    def test_pipeline(self):
+        w1 = self.queue("w1", max_attempts=2)
+        w1.enqueue(["/r/run{:d}".format(i) for i in range(7)] + ["/r/bad1"])
+        with w1.heartbeat(interval=0.05):
+            pipeline = IngestPipeline(FakeDrone(), nprocs=2,
+                                      flush_interval=0.05,
+                                      journal=QueueJournal(w1))
+            n = pipeline.run(w1.claims(batch_size=3, poll=0.05))
+        self.assertEqual(n, 7)
+        states = self.states()
+        self.assertEqual(states.pop("bad1"), FAILED)
+        self.assertEqual(set(states.values()), {DONE})
+        self.assertIn("cannot parse", self.coll.find_one(
+            {"state": FAILED})["error"])
+
+
+if __name__ == '__main__':
+    unittest.main()
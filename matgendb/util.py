@@ -14,8 +14,8 @@ import bson
 import datetime
 import json
 import logging
-from pymongo.mongo_client import MongoClient
 
+from matgendb import dbclient
 from matgendb.dbconfig import DBConfig
 
 # Backwards compatibility from refactor to `dbconfig` module
@@ -52,11 +52,16 @@ def get_settings(config_file):
 
 def get_database(config_file=None, settings=None, admin=False, **kwargs):
     d = get_settings(config_file) if settings is None else settings
-    conn = MongoClient(host=d["host"], port=d["port"], **kwargs)
-    db = conn[d["database"]]
     try:
         user = d["admin_user"] if admin else d["readonly_user"]
         passwd = d["admin_password"] if admin else d["readonly_password"]
+    except (KeyError, TypeError):
+        user, passwd = None, None
+    # Use the client shared with everyone else using the same credentials.
+    conn = dbclient.get_client(d["host"], d["port"], user=user,
+                               password=passwd, **kwargs)
+    db = conn[d["database"]]
+    try:
         db.authenticate(user, passwd)
     except (KeyError, TypeError, ValueError):
         _log.warn("No {admin,readonly}_user/password found in config. file, "
@@ -0,0 +1,429 @@
+"""
+Continuous ingestion of the runs that complete under a tree.
+
+Walking a large tree again and again to find new runs costs a listing of
+every directory each time. :class:`RunWatcher` lists the tree once, and keeps
+an index of its directories and their mtimes. Afterwards, each scan only
+stats the known directories, in parallel, and lists again those whose mtime
+changed, i.e. in which files or subdirectories were created, removed or
+renamed. It needs no inotify, so it also works on network filesystems.
+
+A run directory that shows up is handed out once it is complete: all its
+vasprun.xml files are closed, or custodian has finished with it. Until then
+it is checked again at every scan, with a few stats. The runs are meant to
+be fed to the batched insert path, whose journal tells the watcher which
+runs were written::
+
+    watcher = RunWatcher("/path/to/runs", runs=drone.runs,
+                         state_file="watch.json")
+    IngestPipeline(drone, journal=watcher.get_journal()).run(
+        watcher.watch(interval=60))
+
+The index and the state of the runs are saved to `state_file` after every
+scan, so that a restarted watcher carries on where it stopped. A run is
+saved as done only once the pipeline has written or skipped it; runs that
+failed, or were not finished when the watcher stopped, are handed out again.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from fnmatch import fnmatch
+from multiprocessing.pool import ThreadPool
+
+from matgendb import journal as jrnl
+from matgendb.creator import get_fingerprint
+from matgendb.discovery import RunDir, RunFinder, _list_dir
+
+_log = logging.getLogger("mg.watch")
+
+#: Extensions of compressed files, whose completeness is judged by their age
+COMPRESSED_EXTENSIONS = (".gz", ".bz2", ".xz", ".lzma", ".z")
+
+#: Number of bytes at the end of a vasprun.xml searched for its closing tag
+_TAIL_SIZE = 4096
+
+
+def is_vasprun_closed(filename, settle=60.0):
+    """Whether VASP has finished writing a vasprun.xml file: it ends with
+    its closing tag, or, if it is compressed, it is older than `settle`
+    seconds.
+
+    :param filename: Path of the vasprun.xml file
+    :type filename: str
+    :param settle: Seconds after which a compressed file is deemed complete
+    :type settle: float
+    :rtype: bool
+    """
+    try:
+        if filename.lower().endswith(COMPRESSED_EXTENSIONS):
+            return time.time() - os.path.getmtime(filename) > settle
+        with open(filename, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - _TAIL_SIZE, 0))
+            return b"</modeling>" in f.read()
+    except (IOError, OSError):
+        return False
+
+
+def is_run_complete(run, settle=60.0):
+    """Whether a run is complete: all its vasprun.xml files are closed, or
+    custodian has finished with it, i.e. there is a custodian.json and no
+    file of the run changed for `settle` seconds.
+
+    :param run: Run directory
+    :type run: matgendb.discovery.RunDir
+    :param settle: Seconds without changes after which a run with a
+                   custodian.json is complete
+    :type settle: float
+    :rtype: bool
+    """
+    vaspruns = [os.path.join(run.path, f) for f in run.vasprun_files.values()]
+    if vaspruns and all(is_vasprun_closed(f, settle) for f in vaspruns):
+        return True
+    if not any(fnmatch(f, "custodian.json*") for f in run.files):
+        return False
+    try:
+        newest = max(os.path.getmtime(os.path.join(run.path, f))
+                     for f in run.all_files())
+    except (OSError, ValueError):
+        return False
+    return time.time() - newest > settle
+
+
+class RunWatcher(object):
+    """Watch a tree for completed runs, by polling the mtimes of its
+    directories.
+    """
+    def __init__(self, rootpath, runs=("relax1", "relax2"), nthreads=8,
+                 settle=60.0, state_file=None):
+        """Constructor.
+
+        :param rootpath: Top of the tree
+        :type rootpath: str
+        :param runs: Names of the parts of a multi-part run, as for the drone
+        :type runs: list of str
+        :param nthreads: Number of directories stat'ed or listed concurrently
+        :type nthreads: int
+        :param settle: See :func:`is_run_complete`
+        :type settle: float
+        :param state_file: JSON file in which to keep the index and the
+                           state of the runs between scans and restarts
+        :type state_file: str
+        """
+        self.rootpath = os.path.abspath(rootpath)
+        self.runs = list(runs)
+        self.nthreads = max(nthreads, 1)
+        self.settle = settle
+        self.state_file = state_file
+        self._finder = RunFinder(runs=self.runs)
+        # directory -> mtime, for every directory of the tree
+        self.dirs = {}
+        # directory -> names of its subdirectories that are in self.dirs
+        self.children = {}
+        # run directory -> fingerprint digest when it was written
+        self.done = {}
+        # run directory -> fingerprint digest, for the runs handed out but
+        # not written yet
+        self.handed_out = {}
+        # run directories found, but not complete or not written yet
+        self.pending = set()
+        # guards done, handed_out and pending, which the journal updates
+        # from the threads of the pipeline
+        self._lock = threading.RLock()
+        if state_file is not None and os.path.exists(state_file):
+            self.load()
+
+    def load(self):
+        """Read the state back from the state file."""
+        with open(self.state_file) as f:
+            state = json.load(f)
+        if state.get("rootpath") != self.rootpath:
+            _log.warning("Ignoring {}, which is for {}".format(
+                self.state_file, state.get("rootpath")))
+            return
+        self.dirs = state["dirs"]
+        self.children = {path: set(names)
+                         for path, names in state["children"].items()}
+        self.done = state["done"]
+        self.pending = set(state["pending"])
+
+    def save(self):
+        """Write the state to the state file, atomically. Runs handed out
+        but not written yet are saved as pending.
+        """
+        if self.state_file is None:
+            return
+        with self._lock:
+            done = dict(self.done)
+            pending = sorted(self.pending.union(self.handed_out))
+        state = {"rootpath": self.rootpath, "dirs": self.dirs,
+                 "children": {path: sorted(names)
+                              for path, names in self.children.items()},
+                 "done": done, "pending": pending}
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.rename(tmp, self.state_file)
+
+    def scan(self, pool=None):
+        """Bring the index up to date, and find the completed runs that are
+        neither done nor handed out. The first scan lists the whole tree.
+
+        :return: Completed runs, in no particular order
+        :rtype: list of matgendb.discovery.RunDir
+        """
+        own_pool = pool is None
+        pool = pool or ThreadPool(self.nthreads)
+        try:
+            if self.dirs:
+                changed = self._find_changed(pool)
+            else:
+                changed = [self.rootpath]
+            relisted = self._relist(changed, pool)
+            candidates = self._classify(relisted)
+            results = pool.map(self._check, sorted(candidates.items()))
+        finally:
+            if own_pool:
+                pool.terminate()
+                pool.join()
+        completed = []
+        for path, run, complete in results:
+            digest = None
+            if run is not None and complete:
+                try:
+                    digest = get_fingerprint(path, self.runs,
+                                             run_dir=run)["digest"]
+                except OSError:  # files moved away since the check
+                    complete = False
+            with self._lock:
+                self.pending.discard(path)
+                if run is None:
+                    self.done.pop(path, None)
+                elif not complete:
+                    self.pending.add(path)
+                elif digest not in (self.done.get(path),
+                                    self.handed_out.get(path)):
+                    self.handed_out[path] = digest
+                    completed.append(run)
+        _log.info("Scanned {:d} directories: {:d} listed, {:d} runs "
+                  "completed, {:d} pending".format(
+                      len(self.dirs), len(relisted), len(completed),
+                      len(self.pending)))
+        return completed
+
+    def mark_done(self, paths):
+        """Record runs handed out as written, or skipped, i.e. done."""
+        with self._lock:
+            for path in paths:
+                if path in self.handed_out:
+                    self.done[path] = self.handed_out.pop(path)
+
+    def mark_failed(self, paths):
+        """Record runs handed out as failed: they are checked again, and
+        handed out again, at the next scan.
+        """
+        with self._lock:
+            for path in paths:
+                if self.handed_out.pop(path, None) is not None:
+                    self.pending.add(path)
+
+    def get_journal(self):
+        """Journal through which an IngestPipeline reports the runs it
+        handled to this watcher.
+
+        :rtype: WatchJournal
+        """
+        return WatchJournal(self)
+
+    def watch(self, interval=60.0, max_scans=None, skip_existing=False):
+        """Scan every `interval` seconds and generate the runs as they
+        complete. The state is saved after every scan.
+
+        A run is handed out once, and is only saved as done when it is
+        reported as written or skipped, through :meth:`get_journal`.
+
+        :param interval: Seconds from the start of a scan to the next
+        :type interval: float
+        :param max_scans: Stop after this many scans, default is never
+        :type max_scans: int
+        :param skip_existing: Whether to leave out the runs already complete
+                              at the first scan of a new index, e.g. when
+                              they are already in the db
+        :type skip_existing: bool
+        :return: Completed runs
+        :rtype: generator of matgendb.discovery.RunDir
+        """
+        pool = ThreadPool(self.nthreads)
+        nscans = 0
+        try:
+            while True:
+                t0 = time.time()
+                first = not self.dirs
+                completed = self.scan(pool)
+                if first and skip_existing:
+                    _log.info("Skipping {:d} existing runs".format(
+                        len(completed)))
+                    self.mark_done([run.path for run in completed])
+                    completed = []
+                for run in completed:
+                    yield run
+                self.save()
+                nscans += 1
+                if max_scans is not None and nscans >= max_scans:
+                    return
+                time.sleep(max(interval - (time.time() - t0), 0))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _find_changed(self, pool):
+        """Known directories whose mtime changed. Those that are gone are
+        dropped from the index.
+        """
+        paths = list(self.dirs)
+        mtimes = pool.map(_get_mtime, paths, chunksize=256)
+        changed = []
+        for path, mtime in zip(paths, mtimes):
+            if path not in self.dirs:  # dropped with a parent
+                continue
+            if mtime is None:
+                self._drop(path)
+            elif mtime != self.dirs[path]:
+                changed.append(path)
+        return changed
+
+    def _relist(self, paths, pool):
+        """List directories again, and all the new directories below them.
+
+        :return: Map of the directories listed to their (files,
+                 subdirectories)
+        :rtype: dict
+        """
+        listed = {}
+        while paths:
+            results = pool.map(_list_with_mtime, paths)
+            paths = []
+            for path, result in results:
+                if result is None:
+                    self._drop(path)
+                    continue
+                mtime, files, subdirs, descend = result
+                listed[path] = (files, subdirs)
+                self.dirs[path] = mtime
+                old = self.children.get(path, set())
+                new = set(descend)
+                for name in old - new:
+                    self._drop(os.path.join(path, name))
+                self.children[path] = new
+                paths.extend(os.path.join(path, name) for name in new - old)
+        return listed
+
+    def _classify(self, listed):
+        """Directories to check for completion: the pending runs, and the
+        runs among the directories just listed.
+
+        Runs are made from the listings when all their run subfolders were
+        listed too, so that the tree is not listed twice.
+
+        :param listed: Output of _relist()
+        :return: Map of directory to its RunDir, or to None if it has to be
+                 listed again
+        :rtype: dict
+        """
+        candidates = dict.fromkeys(self.pending)
+        for path, (files, subdirs) in listed.items():
+            if os.path.basename(path) in self.runs:
+                # A run subfolder changed: check its run
+                parent = os.path.dirname(path)
+                if parent not in listed:
+                    candidates[parent] = None
+                continue
+            if not self._finder.is_run(path, files, subdirs):
+                with self._lock:
+                    self.done.pop(path, None)
+                continue
+            run_subdirs = sorted(set(self.runs).intersection(subdirs))
+            listing = {}
+            for name in run_subdirs:
+                sub = listed.get(os.path.join(path, name))
+                if sub is None:  # e.g. a symlink, or unchanged
+                    listing = None
+                    break
+                listing[name] = sub[0]
+            candidates[path] = None if listing is None else RunDir(
+                path, files + run_subdirs, listing, runs=self.runs)
+        return candidates
+
+    def _drop(self, path):
+        """Forget a directory and everything below it."""
+        self.dirs.pop(path, None)
+        with self._lock:
+            self.done.pop(path, None)
+            self.handed_out.pop(path, None)
+            self.pending.discard(path)
+        for name in self.children.pop(path, ()):
+            self._drop(os.path.join(path, name))
+
+    def _check(self, item):
+        path, run = item
+        if run is None:
+            run = self._finder.get_run(path)
+        if run is None:
+            return path, None, False
+        return path, run, is_run_complete(run, self.settle)
+
+
+class WatchJournal(jrnl.Journal):
+    """Journal that reports the outcome of each run to a
+    :class:`RunWatcher`, for :class:`matgendb.pipeline.IngestPipeline`.
+    Written and skipped runs are done, failed ones are handed out again.
+    """
+    def __init__(self, watcher):
+        """Constructor.
+
+        :param watcher: Watcher the runs are handed out by
+        :type watcher: RunWatcher
+        """
+        self.watcher = watcher
+
+    def record_many(self, paths, status, error=None):
+        if status in jrnl.FINISHED:
+            self.watcher.mark_done(paths)
+        elif status == jrnl.FAILED:
+            self.watcher.mark_failed(paths)
+
+    def get_status(self):
+        watcher = self.watcher
+        with watcher._lock:
+            status = dict.fromkeys(watcher.pending, jrnl.QUEUED)
+            status.update(dict.fromkeys(watcher.handed_out, jrnl.QUEUED))
+            status.update(dict.fromkeys(watcher.done, jrnl.WRITTEN))
+        return status
+
+    def finished(self):
+        # The watcher itself leaves out the runs that are done.
+        return set()
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _list_with_mtime(path):
+    """(path, (mtime, files, subdirectories, subdirectories to descend
+    into)), or (path, None) if the directory cannot be listed. The mtime is
+    taken before the listing, so that changes made during the listing are
+    seen at the next scan.
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+        return path, (mtime,) + _list_dir(path)
+    except Exception as err:  # e.g. OSError, or a name not decodable
+        _log.warning("Cannot list {}: {}".format(path, err))
+        return path, None
@@ -0,0 +1,316 @@
+"""
+Ingestion spread over many nodes, through a work queue in MongoDB.
+
+A coordinator puts the run directories to ingest in a queue collection, and
+any number of workers, on nodes that share the filesystem, claim them in
+batches and ingest them::
+
+    # coordinator
+    queue = WorkQueue(db.ingest_queue)
+    queue.enqueue(run.path for run in find_runs("/path/to/runs"))
+
+    # each worker
+    queue = WorkQueue(db.ingest_queue)
+    with queue.heartbeat():
+        IngestPipeline(drone, journal=QueueJournal(queue)).run(
+            queue.claims(batch_size=50))
+
+A directory is claimed atomically (``find_one_and_update``) by one worker,
+for a lease of `lease` seconds. A heartbeat thread extends the leases of the
+worker while it is alive; the directories of a worker that died go back to
+the others when their leases expire. A directory whose ingestion fails is
+retried, up to `max_attempts` times, then left as failed with the error.
+
+The documents of the queue are::
+
+    {"_id": path, "state": "queued" | "claimed" | "done" | "failed",
+     "attempts": int, "worker": "host:pid", "lease_until": datetime,
+     "error": str, "last_updated": datetime}
+
+Leases are compared with the clocks of the workers, which should be kept in
+sync, e.g. with NTP, to well below the lease.
+"""
+
+import datetime
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+from matgendb import journal as jrnl
+
+_log = logging.getLogger("mg.workqueue")
+
+#: States of a directory in the queue
+QUEUED = "queued"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+STATES = (QUEUED, CLAIMED, DONE, FAILED)
+
+
+def _now():
+    # Mongo dates have millisecond precision
+    now = datetime.datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+class WorkQueue(object):
+    """Queue of run directories in a MongoDB collection.
+    """
+    def __init__(self, collection, lease=300, max_attempts=3, worker=None):
+        """Constructor.
+
+        :param collection: Collection of the queue
+        :type collection: pymongo.collection.Collection
+        :param lease: Seconds a claim lasts without a heartbeat
+        :type lease: float
+        :param max_attempts: Number of times a directory is claimed before
+                             it is left as failed
+        :type max_attempts: int
+        :param worker: Name of this worker, default is host:pid
+        :type worker: str
+        """
+        self.collection = collection
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.worker = worker or "{}:{:d}".format(socket.gethostname(),
+                                                 os.getpid())
+
+    def ensure_indexes(self):
+        """Create the index used to claim directories."""
+        self.collection.create_index([("state", ASCENDING),
+                                      ("lease_until", ASCENDING)])
+
+    def enqueue(self, paths, requeue=False, chunk_size=1000):
+        """Add directories to the queue.
+
+        :param paths: Run directories; may be a generator
+        :type paths: iterable of str
+        :param requeue: Whether to queue again directories that are already
+                        in the queue, done or failed, with no attempts
+        :type requeue: bool
+        :param chunk_size: Directories per bulk write
+        :type chunk_size: int
+        :return: Number of directories added, or queued again
+        :rtype: int
+        """
+        n, chunk = 0, []
+        for path in paths:
+            chunk.append(os.path.abspath(path))
+            if len(chunk) >= chunk_size:
+                n += self._enqueue(chunk, requeue)
+                chunk = []
+        if chunk:
+            n += self._enqueue(chunk, requeue)
+        _log.info("Queued {:d} directories".format(n))
+        return n
+
+    def _enqueue(self, paths, requeue):
+        now = _now()
+        fields = {"state": QUEUED, "attempts": 0, "worker": None,
+                  "lease_until": None, "error": None, "last_updated": now}
+        if requeue:
+            update = {"$set": fields}
+        else:
+            update = {"$setOnInsert": fields}
+        result = self.collection.bulk_write(
+            [UpdateOne({"_id": path}, update, upsert=True) for path in paths],
+            ordered=False)
+        return result.upserted_count + (result.modified_count if requeue
+                                        else 0)
+
+    def claim(self, n=1):
+        """Claim up to `n` directories: queued ones, or claimed ones whose
+        lease expired.
+
+        :return: Paths claimed, maybe fewer than `n`
+        :rtype: list of str
+        """
+        paths = []
+        while len(paths) < n:
+            now = _now()
+            d = self.collection.find_one_and_update(
+                {"$or": [{"state": QUEUED},
+                         {"state": CLAIMED, "lease_until": {"$lt": now}}],
+                 "attempts": {"$lt": self.max_attempts}},
+                {"$set": {"state": CLAIMED, "worker": self.worker,
+                          "lease_until": self._lease_until(now),
+                          "last_updated": now},
+                 "$inc": {"attempts": 1}},
+                projection=["_id"], return_document=ReturnDocument.AFTER)
+            if d is None:
+                break
+            paths.append(d["_id"])
+        if paths:
+            _log.debug("Claimed {:d} directories".format(len(paths)))
+        return paths
+
+    def _lease_until(self, now):
+        return now + datetime.timedelta(seconds=self.lease)
+
+    def _mine(self, paths):
+        return {"_id": {"$in": list(paths)}, "state": CLAIMED,
+                "worker": self.worker}
+
+    def renew(self):
+        """Extend the leases of all the directories claimed by this worker.
+
+        :return: Number of leases extended
+        :rtype: int
+        """
+        now = _now()
+        return self.collection.update_many(
+            {"state": CLAIMED, "worker": self.worker},
+            {"$set": {"lease_until": self._lease_until(now)}}).matched_count
+
+    def complete(self, paths):
+        """Mark directories claimed by this worker as done."""
+        if paths:
+            self.collection.update_many(
+                self._mine(paths),
+                {"$set": {"state": DONE, "lease_until": None, "error": None,
+                          "last_updated": _now()}})
+
+    def fail(self, paths, error=None):
+        """Give back directories whose ingestion failed. They are queued
+        again, unless they were claimed `max_attempts` times.
+        """
+        if not paths:
+            return
+        now = _now()
+        fields = {"lease_until": None, "error": error, "last_updated": now}
+        criteria = self._mine(paths)
+        criteria["attempts"] = {"$gte": self.max_attempts}
+        self.collection.update_many(criteria,
+                                    {"$set": dict(fields, state=FAILED)})
+        criteria["attempts"] = {"$lt": self.max_attempts}
+        self.collection.update_many(criteria,
+                                    {"$set": dict(fields, state=QUEUED)})
+
+    def release(self, paths=None):
+        """Give back directories claimed by this worker without counting the
+        attempt, e.g. at shutdown.
+
+        :param paths: Directories to give back, default is all of them
+        :type paths: list of str
+        """
+        if paths is None:
+            criteria = {"state": CLAIMED, "worker": self.worker}
+        else:
+            criteria = self._mine(paths)
+        if paths is None or paths:
+            self.collection.update_many(
+                criteria,
+                {"$set": {"state": QUEUED, "lease_until": None,
+                          "last_updated": _now()},
+                 "$inc": {"attempts": -1}})
+
+    def reap(self):
+        """Mark as failed the directories whose last allowed claim expired,
+        i.e. whose worker died on them every time.
+
+        :return: Number of directories marked as failed
+        :rtype: int
+        """
+        now = _now()
+        return self.collection.update_many(
+            {"state": CLAIMED, "lease_until": {"$lt": now},
+             "attempts": {"$gte": self.max_attempts}},
+            {"$set": {"state": FAILED, "error": "lease expired",
+                      "lease_until": None, "last_updated": now}}
+        ).modified_count
+
+    def counts(self):
+        """Number of directories in each state.
+
+        :rtype: dict
+        """
+        return {state: self.collection.find({"state": state}).count()
+                for state in STATES}
+
+    def is_drained(self):
+        """Whether no directory is queued or claimed under a live lease."""
+        return self.collection.find_one(
+            {"$or": [{"state": QUEUED},
+                     {"state": CLAIMED, "lease_until": {"$gte": _now()}}]},
+            ["_id"]) is None
+
+    def claims(self, batch_size=50, poll=10.0):
+        """Generate directories, claiming them `batch_size` at a time as
+        they are consumed, until the queue is drained.
+
+        When nothing can be claimed but other workers still hold
+        directories, which may come back if they die, the queue is polled
+        every `poll` seconds.
+
+        :rtype: generator of str
+        """
+        while True:
+            paths = self.claim(batch_size)
+            if paths:
+                for path in paths:
+                    yield path
+                continue
+            self.reap()
+            if self.is_drained():
+                return
+            time.sleep(poll)
+
+    @contextmanager
+    def heartbeat(self, interval=None):
+        """Context in which a thread extends the leases of this worker
+        every `interval` seconds, by default a third of the lease.
+        """
+        interval = interval or self.lease / 3.0
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                try:
+                    self.renew()
+                except Exception as err:
+                    _log.error("Cannot renew leases: {}".format(err))
+
+        thread = threading.Thread(target=beat, name="heartbeat")
+        thread.daemon = True
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+
+
+class QueueJournal(jrnl.Journal):
+    """Journal that reports the outcome of each directory to a
+    :class:`WorkQueue`, for :class:`matgendb.pipeline.IngestPipeline`.
+    Written and skipped directories are done, failed ones are given back.
+    """
+    def __init__(self, queue):
+        """Constructor.
+
+        :param queue: Queue the directories are claimed from
+        :type queue: WorkQueue
+        """
+        self.queue = queue
+
+    def record_many(self, paths, status, error=None):
+        if status in jrnl.FINISHED:
+            self.queue.complete(paths)
+        elif status == jrnl.FAILED:
+            self.queue.fail(paths, error=error)
+
+    def get_status(self):
+        states = {DONE: jrnl.WRITTEN, FAILED: jrnl.FAILED,
+                  QUEUED: jrnl.QUEUED, CLAIMED: jrnl.QUEUED}
+        return {d["_id"]: states[d["state"]] for d in
+                self.queue.collection.find({}, ["state"])}
+
+    def finished(self):
+        # Claimed directories are never finished.
+        return set()